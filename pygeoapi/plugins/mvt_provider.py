@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from geoalchemy2.functions import ST_Transform, ST_AsMVTGeom, ST_AsMVT, ST_CurveToLine
+from sqlalchemy.sql import select
+from sqlalchemy.orm import Session
+from pygeoapi.provider.mvt_postgresql import MVTPostgreSQLProvider
+from pygeoapi.provider.tile import ProviderTileNotFoundError
+from pygeoapi.util import get_crs_from_uri
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_FEATURES = 10000
+DEFAULT_CACHE_SIZE = 2000
+DEFAULT_CACHE_TTL = 3600
+
+class TileCache:
+    """Thread-safe least recently used cache of encoded tiles that expire after ttl seconds."""
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._tiles.get(key)
+            if entry is None:
+                return None
+            created, tile = entry
+            if time.monotonic() - created > self.ttl:
+                del self._tiles[key]
+                return None
+            self._tiles.move_to_end(key)
+            return tile
+
+    def set(self, key, tile):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._tiles[key] = (time.monotonic(), tile)
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_size:
+                self._tiles.popitem(last=False)
+
+    def __len__(self):
+        return len(self._tiles)
+
+# pygeoapi creates a provider for every request, so the caches are kept per table for the whole process
+_tile_caches = {}
+_tile_caches_lock = threading.Lock()
+
+def get_tile_cache(table, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+    """Returns the tile cache of a table, creating it on first use."""
+    with _tile_caches_lock:
+        if table not in _tile_caches:
+            _tile_caches[table] = TileCache(max_size, ttl)
+        return _tile_caches[table]
+
+class CachedMVTPostgreSQLProvider(MVTPostgreSQLProvider):
+    """
+    Mapbox Vector Tiles rendered with ST_AsMVT from the occurrence tables, with a per-tile cache.
+
+    Tiles hold at most max_features features, the first ones by id_field, and only the configured properties,
+    so that tiles of large areas stay small. Configured with the mvt section of the provider options:
+
+        options:
+            mvt:
+                max_features: 10000
+                cache_size: 2000
+                cache_ttl: 3600
+    """
+
+    def __init__(self, provider_def):
+        super().__init__(provider_def)
+        # Options that are not dicts are passed to the database connection by the SQL provider
+        mvt_options = provider_def.get('options', {}).get('mvt', {})
+        self.max_features = int(mvt_options.get('max_features', DEFAULT_MAX_FEATURES))
+        self.tile_cache = get_tile_cache(
+            self.table,
+            int(mvt_options.get('cache_size', DEFAULT_CACHE_SIZE)),
+            int(mvt_options.get('cache_ttl', DEFAULT_CACHE_TTL))
+        )
+        self.tile_properties = provider_def.get('properties') or []
+
+    def get_tile_columns(self):
+        """
+        Returns the columns that are written to the tile features: the configured properties, or all columns.
+        """
+        fields = self.fields
+        if not self.tile_properties:
+            return list(fields.values())
+        return [fields[name] for name in self.tile_properties if name in fields]
+
+    def get_tiles(self, layer='default', tileset=None, z=None, y=None, x=None, format_=None):
+        """
+        Gets tile from the cache or renders it
+
+        :param layer: mvt tile layer
+        :param tileset: mvt tileset
+        :param z: z index
+        :param y: y index
+        :param x: x index
+        :param format_: tile format
+
+        :returns: an encoded mvt tile
+        """
+        z, y, x = map(int, [z, y, x])
+        key = (tileset, z, x, y)
+        tile = self.tile_cache.get(key)
+        if tile is not None:
+            logger.debug('Tile %s/%s/%s of %s from cache', z, x, y, self.table)
+            return tile or None
+
+        tile = self._render_tile(layer, tileset, z, y, x)
+        if tile is not ProviderTileNotFoundError:
+            # Empty tiles are cached too, as b''
+            self.tile_cache.set(key, tile or b'')
+        return tile
+
+    def _render_tile(self, layer, tileset, z, y, x):
+        schemes = [schema for schema in self.get_tiling_schemes() if tileset == schema.tileMatrixSet]
+        if not schemes or not self.is_in_limits(schemes[0], z, x, y):
+            logger.warning('Tile %s/%s/%s not found', z, x, y)
+            return ProviderTileNotFoundError
+
+        storage_srid = get_crs_from_uri(self.storage_crs).to_string()
+        out_srid = get_crs_from_uri(schemes[0].crs).to_string()
+        envelope = self.get_envelope(z, y, x, tileset)
+
+        geom_column = getattr(self.table_model, self.geom)
+        mvtgeom = ST_AsMVTGeom(
+            ST_Transform(ST_CurveToLine(geom_column), out_srid),
+            ST_Transform(envelope, out_srid)
+        ).label('mvtgeom')
+
+        # Ordered by the id field, so that tiles over max_features hold the same features on every render
+        # and neighbouring tiles agree. The intersecting rows are sorted with a top-N heap sort.
+        mvtrow = (
+            select(mvtgeom, *self.get_tile_columns())
+            .filter(geom_column.intersects(ST_Transform(envelope, storage_srid)))
+            .order_by(getattr(self.table_model, self.id_field))
+            .limit(self.max_features)
+            .cte('mvtrow')
+        )
+
+        with Session(self._engine) as session:
+            result = session.execute(select(ST_AsMVT(mvtrow.table_valued(), layer))).scalar()
+        return bytes(result) if result else None
+
+    def __repr__(self):
+        return f'<CachedMVTPostgreSQLProvider> {self.table}'
@@ -0,0 +1,130 @@
+import logging
+from geoalchemy2 import Geometry
+from sqlalchemy.orm import load_only
+from pygeoapi.provider.sql import PostgreSQLProvider
+from pygeoapi.util import get_crs_from_uri
+
+logger = logging.getLogger(__name__)
+
+# Stored copies of the geometries in other CRSs by EPSG code (see edit_db.PROJECTED_GEOMETRY_COLUMN)
+PROJECTED_GEOMETRY_COLUMNS = {3067: 'geometry_3067'}
+
+class SimplifiedPostgreSQLProvider(PostgreSQLProvider):
+    """
+    PostgreSQL feature provider that serves stored projected geometries and simplified geometries to queries of large areas.
+
+    Features requested in a CRS that the table has a stored copy of the geometries in (PROJECTED_GEOMETRY_COLUMNS)
+    are served from that column, so they need not be transformed one by one.
+
+    The polygon tables have simplified copies of the geometry column (see edit_db.SIMPLIFIED_GEOMETRY_COLUMNS).
+    A query whose bbox is at least as wide or high as the threshold of a simplified column, in the units of the
+    storage CRS, gets the geometries of the coarsest such column. Queries are still filtered with the full
+    geometries. Configured with the simplify section of the provider options:
+
+        options:
+            simplify:
+                geometry_simplified_100m: 0.5
+                geometry_simplified_1km: 2
+
+    Queries without a bbox and single features get the full geometries; simplified geometries are transformed
+    to the requested CRS. Tables without the extra columns are served like with the PostgreSQL provider.
+    """
+
+    def __init__(self, provider_def):
+        # Options that are not dicts are passed to the database connection by the SQL provider
+        self.simplify_thresholds = provider_def.get('options', {}).get('simplify', {})
+        super().__init__(provider_def)
+        self.output_geom = self.geom
+
+    def get_simplified_columns(self):
+        """
+        Returns the names of the geometry columns of the table other than the geometry column: the simplified and
+        projected copies of the geometries.
+        """
+        return [column.name for column in self.table_model.__table__.columns
+                if isinstance(column.type, Geometry) and column.name != self.geom]
+
+    def get_fields(self):
+        """
+        Returns the fields of the table without the simplified and projected geometry columns.
+        """
+        if not self._fields:
+            super().get_fields()
+            for column in self.get_simplified_columns():
+                self._fields.pop(column, None)
+        return self._fields
+
+    def get_geometry_column(self, bbox):
+        """
+        Returns the geometry column to serve for a bbox: the coarsest simplified column whose threshold the bbox
+        reaches, or the geometry column.
+        """
+        if not bbox:
+            return self.geom
+        # bbox is [minx, miny, maxx, maxy] or [minx, miny, minz, maxx, maxy, maxz]
+        half = len(bbox) // 2
+        size = max(bbox[half] - bbox[0], bbox[half + 1] - bbox[1])
+
+        simplified_columns = self.get_simplified_columns()
+        # The thresholds of coarser columns are larger
+        reached = [(float(threshold), column) for column, threshold in self.simplify_thresholds.items()
+                   if column in simplified_columns and size >= float(threshold)]
+        if not reached:
+            return self.geom
+        return max(reached)[1]
+
+    def get_projected_column(self, crs_transform_spec):
+        """
+        Returns the stored geometry column in the target CRS of a transform, or None.
+        """
+        if crs_transform_spec is None:
+            return None
+        column = PROJECTED_GEOMETRY_COLUMNS.get(get_crs_from_uri(crs_transform_spec.target_crs_uri).to_epsg())
+        return column if column in self.get_simplified_columns() else None
+
+    def query(self, bbox=[], crs_transform_spec=None, **kwargs):
+        self.output_geom = self.get_geometry_column(bbox)
+        if self.output_geom == self.geom:
+            self.output_geom = self.get_projected_column(crs_transform_spec) or self.geom
+        if self.output_geom != self.geom:
+            logger.debug('Serving %s of %s for bbox %s', self.output_geom, self.table, bbox)
+        try:
+            return super().query(bbox=bbox, crs_transform_spec=crs_transform_spec, **kwargs)
+        finally:
+            self.output_geom = self.geom
+
+    def get(self, identifier, crs_transform_spec=None, **kwargs):
+        self.output_geom = self.get_projected_column(crs_transform_spec) or self.geom
+        try:
+            return super().get(identifier, crs_transform_spec=crs_transform_spec, **kwargs)
+        finally:
+            self.output_geom = self.geom
+
+    def _get_crs_transform(self, crs_transform_spec=None):
+        # The stored projected geometries are already in the target CRS
+        if self.output_geom in PROJECTED_GEOMETRY_COLUMNS.values():
+            return None
+        return super()._get_crs_transform(crs_transform_spec)
+
+    def _select_properties_clause(self, select_properties, skip_geometry):
+        if skip_geometry or self.output_geom == self.geom:
+            return super()._select_properties_clause(select_properties, skip_geometry)
+
+        # As in the SQL provider, but the simplified column is loaded instead of the full geometry
+        column_names = set(select_properties) if select_properties else set(self.fields.keys())
+        if self.properties:
+            column_names = column_names.intersection(self.properties)
+        column_names.add(self.output_geom)
+        return load_only(*[getattr(self.table_model, name) for name in column_names if hasattr(self.table_model, name)])
+
+    def _sqlalchemy_to_feature(self, item, crs_transform_out=None):
+        item_dict = item.__dict__
+        if self.output_geom != self.geom:
+            item_dict[self.geom] = item_dict.pop(self.output_geom, None)
+        # Geometries are not properties
+        for column in self.get_simplified_columns():
+            item_dict.pop(column, None)
+        return super()._sqlalchemy_to_feature(item, crs_transform_out)
+
+    def __repr__(self):
+        return f'<SimplifiedPostgreSQLProvider> {self.table}'
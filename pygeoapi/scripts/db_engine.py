@@ -0,0 +1,73 @@
+import os
+import logging
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 1800
+
+def database_url():
+    """
+    Builds the URL of the PostGIS database from the POSTGRES_* environment variables.
+
+    Returns:
+    str: SQLAlchemy database URL with the psycopg2 driver.
+    """
+    url = URL.create(
+        'postgresql+psycopg2',
+        username=os.getenv('POSTGRES_USER'),
+        password=os.getenv('POSTGRES_PASSWORD'),
+        host=os.getenv('POSTGRES_HOST'),
+        port=int(os.getenv('POSTGRES_PORT', '5432')),
+        database=os.getenv('POSTGRES_DB')
+    )
+    return url.render_as_string(hide_password=False)
+
+def engine_options(application_name, statement_timeout=None):
+    """
+    Returns the engine options shared by the ingest and the web application.
+
+    The pool is sized with DB_POOL_SIZE and DB_MAX_OVERFLOW, connections are checked before use and recycled, so
+    that connections closed by the server or a proxy are replaced instead of failing the next query.
+
+    Parameters:
+    application_name (str): Name shown for the connections in pg_stat_activity.
+    statement_timeout (str, optional): PostgreSQL statement_timeout of the connections, e.g. '60s'.
+
+    Returns:
+    dict: Keyword arguments for sqlalchemy.create_engine.
+    """
+    connect_args = {"application_name": application_name}
+    if statement_timeout:
+        connect_args["options"] = f'-c statement_timeout={statement_timeout}'
+    return {
+        "pool_size": int(os.getenv('DB_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        "max_overflow": int(os.getenv('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW)),
+        "pool_recycle": int(os.getenv('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE)),
+        "pool_pre_ping": True,
+        "connect_args": connect_args
+    }
+
+def create_db_engine(application_name, statement_timeout=None):
+    """
+    Creates a pooled engine for the PostGIS database.
+
+    The engine can be shared between threads. A process forked from the creating process gets a fresh pool,
+    as pooled connections can't be shared between processes.
+
+    Parameters:
+    application_name (str): Name shown for the connections in pg_stat_activity.
+    statement_timeout (str, optional): PostgreSQL statement_timeout of the connections, e.g. '60s'.
+
+    Returns:
+    engine (sqlalchemy.engine.base.Engine): SQLAlchemy engine for database connection
+    """
+    engine = create_engine(database_url(), **engine_options(application_name, statement_timeout))
+    if hasattr(os, 'register_at_fork'):
+        # Leaves the connections of the parent open for the parent
+        os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+    logger.debug(f"Created database engine for {application_name}")
+    return engine
@@ -1,12 +1,21 @@
-from sqlalchemy import inspect, create_engine, text, MetaData
+from sqlalchemy import inspect, text, MetaData
+from sqlalchemy.exc import OperationalError
 import pandas as pd
+import numpy as np
+import shapely
+import io
 import os
 import logging
 from dotenv import load_dotenv
 import concurrent.futures
+import threading
 from sqlalchemy.dialects.postgresql import base
 from geoalchemy2.types import Geometry
 from datetime import date
+import json
+import time
+import hashlib
+from scripts import db_engine
 
 logger = logging.getLogger(__name__)
 
@@ -18,15 +27,43 @@ postgis_default_tables = [
     'county', 'state', 'place', 'zip_state', 'zip_state_loc', 'cousub',
     'edges', 'addrfeat', 'addr', 'zcta5', 'tabblock20', 'faces',
     'loader_platform', 'loader_variables', 'loader_lookuptables', 'tract',
-    'tabblock', 'bg', 'pagc_gaz', 'pagc_lex', 'pagc_rules', 'last_update'
+    'tabblock', 'bg', 'pagc_gaz', 'pagc_lex', 'pagc_rules', 'last_update',
+    'ingest_runs', 'ingest_checkpoints', 'collection_stats'
 ]
 
+# Suffixes of the tables that incremental updates are loaded into before they are applied to the live tables
+STAGING_SUFFIX = '_staging'
+DELTA_SUFFIX = '_delta'
+
+# Schema where full loads are built before they are published to the public schema
+SHADOW_SCHEMA = 'ingest_shadow'
+
+# Table of the statistics of each occurrence table, maintained by the ingest for the metadata
+COLLECTION_STATS_TABLE = 'collection_stats'
+
+# Grid tables that the occurrences are aggregated to, with their cell size in metres in EUREF-TM35FIN (EPSG:3067)
+GRID_TABLES = {'grid_1km': 1000, 'grid_10km': 10000}
+# Suffix of the grid tables while they are built, before they replace the served ones
+GRID_BUILD_SUFFIX = '_new'
+
+# Copy of the geometries in EUREF-TM35FIN (EPSG:3067), the CRS that most clients request
+PROJECTED_GEOMETRY_COLUMN = 'geometry_3067'
+
+# Simplified copies of the geometries of the polygon tables with their tolerances in metres, for small-scale maps
+SIMPLIFIED_GEOMETRY_COLUMNS = {'geometry_simplified_100m': 100, 'geometry_simplified_1km': 1000}
+
+# Column that occurrence tables are partitioned by (by year) when partitioning is enabled
+PARTITION_COLUMN = 'Keruu_aloitus_pvm'
+
 _engine = None
+_engine_lock = threading.Lock()
 
 def get_engine():
     global _engine
-    if _engine is None:
-        _engine = connect_to_db()
+    # The engine is shared by the loader and maintenance threads, so it must be created only once
+    with _engine_lock:
+        if _engine is None:
+            _engine = connect_to_db()
     return _engine
 
 def get_and_update_last_update():
@@ -65,26 +102,160 @@ def get_and_update_last_update():
 
     return last_update
 
+def create_ingest_checkpoint_tables(connection):
+    """
+    Creates the tables that record ingest runs and their completed batches, if they do not exist.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Open database connection.
+    """
+    connection.execute(text('''
+        CREATE TABLE IF NOT EXISTS ingest_runs (
+            run_id SERIAL PRIMARY KEY,
+            pages_env TEXT NOT NULL,
+            target TEXT,
+            params TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+            run_id INTEGER NOT NULL REFERENCES ingest_runs (run_id) ON DELETE CASCADE,
+            table_base_name TEXT NOT NULL,
+            batch TEXT NOT NULL,
+            startpage INTEGER,
+            endpage INTEGER,
+            completed_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (run_id, table_base_name, batch)
+        );
+    '''))
+
+def get_unfinished_ingest_run(pages_env, target):
+    """
+    Finds the latest ingest run with the same PAGES mode and target that did not finish.
+
+    Parameters:
+    pages_env (str): The PAGES mode of the run (e.g. 'all' or 'latest').
+    target (str): The target of the run (e.g. 'default' or 'virva').
+
+    Returns:
+    tuple: The run id and the stored run parameters (dict), or (None, None) if there is nothing to resume.
+    """
+    with get_engine().connect() as connection:
+        create_ingest_checkpoint_tables(connection)
+        connection.commit()
+        row = connection.execute(text('''
+            SELECT run_id, params FROM ingest_runs
+            WHERE finished_at IS NULL AND pages_env = :pages_env AND target IS NOT DISTINCT FROM :target
+            ORDER BY run_id DESC LIMIT 1
+        '''), {"pages_env": pages_env, "target": target}).fetchone()
+
+    if row:
+        return row[0], json.loads(row[1])
+    return None, None
+
+def start_ingest_run(pages_env, target, run_params):
+    """
+    Records a new ingest run. Unfinished earlier runs with the same PAGES mode and target are removed together with
+    their checkpoints; unfinished runs of other modes and targets are kept, so that they can still be resumed.
+
+    Parameters:
+    pages_env (str): The PAGES mode of the run.
+    target (str): The target of the run.
+    run_params (dict): JSON serializable parameters needed to resume the run (query parameters, batch size).
+
+    Returns:
+    int: The id of the new run.
+    """
+    with get_engine().connect() as connection:
+        create_ingest_checkpoint_tables(connection)
+        connection.execute(text('''
+            DELETE FROM ingest_runs
+            WHERE finished_at IS NULL AND pages_env = :pages_env AND target IS NOT DISTINCT FROM :target
+        '''), {"pages_env": pages_env, "target": target})
+        run_id = connection.execute(
+            text("INSERT INTO ingest_runs (pages_env, target, params) VALUES (:pages_env, :target, :params) RETURNING run_id"),
+            {"pages_env": pages_env, "target": target, "params": json.dumps(run_params)}
+        ).scalar()
+        connection.commit()
+    return run_id
+
+def finish_ingest_run(run_id):
+    """
+    Marks an ingest run finished so that the next run starts from the beginning.
+
+    Parameters:
+    run_id (int): The id of the run.
+    """
+    with get_engine().connect() as connection:
+        connection.execute(text("UPDATE ingest_runs SET finished_at = now() WHERE run_id = :run_id"), {"run_id": run_id})
+        connection.commit()
+
+def get_completed_batches(run_id, table_base_name):
+    """
+    Retrieves the batches that have already been completed for a table group in an ingest run.
+
+    Parameters:
+    run_id (int): The id of the run.
+    table_base_name (str): The base name of the tables (e.g. 'uusimaa').
+
+    Returns:
+    set: Names of the completed batches.
+    """
+    with get_engine().connect() as connection:
+        result = connection.execute(
+            text("SELECT batch FROM ingest_checkpoints WHERE run_id = :run_id AND table_base_name = :table_base_name"),
+            {"run_id": run_id, "table_base_name": table_base_name}
+        )
+        return {row[0] for row in result}
+
+def mark_batch_completed(run_id, table_base_name, batch, startpage=None, endpage=None):
+    """
+    Records that a batch of an ingest run has been completely written to the database.
+
+    Parameters:
+    run_id (int): The id of the run.
+    table_base_name (str): The base name of the tables (e.g. 'uusimaa').
+    batch (str): Name of the batch, e.g. 'pages 1-5' or 'maintenance'.
+    startpage (int, optional): First page of the batch.
+    endpage (int, optional): Last page of the batch.
+    """
+    with get_engine().connect() as connection:
+        connection.execute(text('''
+            INSERT INTO ingest_checkpoints (run_id, table_base_name, batch, startpage, endpage)
+            VALUES (:run_id, :table_base_name, :batch, :startpage, :endpage)
+            ON CONFLICT (run_id, table_base_name, batch) DO UPDATE SET completed_at = now()
+        '''), {"run_id": run_id, "table_base_name": table_base_name, "batch": batch, "startpage": startpage, "endpage": endpage})
+        connection.commit()
+
+def discard_completed_batches(run_id, table_base_name):
+    """
+    Forgets the completed batches of a table group in an ingest run so that a resumed run loads them again.
+
+    Parameters:
+    run_id (int): The id of the run.
+    table_base_name (str): The base name of the tables (e.g. 'uusimaa').
+    """
+    with get_engine().connect() as connection:
+        connection.execute(
+            text("DELETE FROM ingest_checkpoints WHERE run_id = :run_id AND table_base_name = :table_base_name"),
+            {"run_id": run_id, "table_base_name": table_base_name}
+        )
+        connection.commit()
+
 def connect_to_db():
     """
     Creates connection to the PostGIS database using credentials stored in .env file or parameters/secrets in openshift.
+    The engine is pooled and thread-safe, see db_engine.create_db_engine.
 
     Returns:
     engine (sqlalchemy.engine.base.Engine): SQLAlchemy engine for database connection
     """
     # Remove this line, since env vars are set in test code
     load_dotenv()
-    db_params = {
-        'dbname': os.getenv('POSTGRES_DB'),
-        'user': os.getenv('POSTGRES_USER'),
-        'password': os.getenv('POSTGRES_PASSWORD'),
-        'host': os.getenv('POSTGRES_HOST'),
-        'port': os.getenv('POSTGRES_PORT', '5432')  # Default PostgreSQL port
-    }
 
     # Connect to the PostGIS database
     logger.debug("Creating database connection...")
-    engine = create_engine(f"postgresql+psycopg2://{db_params['user']}:{db_params['password']}@{db_params['host']}:{db_params['port']}/{db_params['dbname']}")
+    engine = db_engine.create_db_engine('laji-pygeoapi-ingest')
     with engine.connect() as connection:
         connection.execute(text('CREATE EXTENSION IF NOT EXISTS postgis;'))
         connection.commit()
@@ -100,7 +271,15 @@ def drop_all_tables():
     """
     logger.info("Dropping all the tables from the database...")
     
-    tables = get_all_tables()
+    with get_engine().connect() as connection:
+        connection.execute(text(f'DROP SCHEMA IF EXISTS "{SHADOW_SCHEMA}" CASCADE'))
+        connection.execute(text(f'DROP TABLE IF EXISTS "{COLLECTION_STATS_TABLE}"'))
+        for grid_table in GRID_TABLES:
+            connection.execute(text(f'DROP TABLE IF EXISTS "{grid_table}"'))
+            connection.execute(text(f'DROP TABLE IF EXISTS "{grid_table}{GRID_BUILD_SUFFIX}"'))
+        connection.commit()
+
+    tables = get_all_tables(include_staging=True)
     if not tables:
         return
     with get_engine().connect() as connection:
@@ -111,12 +290,13 @@ def drop_all_tables():
                 logger.warning(f"Failed to drop table {table_name}: {e}")
         connection.commit()
 
-def drop_table(table_names):
+def drop_table(table_names, schema='public'):
     """
     Drops specified tables in the database.
 
     Parameters:
     table_names (list): The table names
+    schema (str): The schema of the tables
     """
     if not table_names:
         return
@@ -124,18 +304,145 @@ def drop_table(table_names):
     with get_engine().connect() as connection:
         for table_name in table_names:
             try:
-                connection.execute(text(f'DROP TABLE IF EXISTS "{table_name}" CASCADE'))
+                connection.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{table_name}" CASCADE'))
             except Exception as e:
                 logger.warning(f"Failed to drop table {table_name}: {e}")
+        if connection.execute(text("SELECT to_regclass(:table_name)"), {"table_name": f'"{schema}"."{COLLECTION_STATS_TABLE}"'}).scalar() is not None:
+            connection.execute(text(f'DELETE FROM "{schema}"."{COLLECTION_STATS_TABLE}" WHERE table_name = ANY(:table_names)'), {"table_names": list(table_names)})
         connection.commit()
 
-def get_all_tables():
+def get_all_tables(include_staging=False):
+    """
+    Retrieves all occurrence table names (except default and grid tables) from the database. Returns them as a list.
+
+    Parameters:
+    include_staging (bool): Whether to include the staging tables of incremental updates.
+    """
+    with get_engine().connect() as connection:
+        tables = inspect(connection).get_table_names()
+        partitions = _partition_tables(connection)
+    grid_tables = set(GRID_TABLES) | {f'{grid_table}{GRID_BUILD_SUFFIX}' for grid_table in GRID_TABLES}
+    tables = [table for table in tables if table not in postgis_default_tables and table not in partitions and table not in grid_tables]
+    if not include_staging:
+        tables = [table for table in tables if not table.endswith((STAGING_SUFFIX, DELTA_SUFFIX))]
+    return tables
+
+def staging_table_name(table_name):
+    """Returns the name of the staging table of a live table."""
+    return f'{table_name}{STAGING_SUFFIX}'
+
+def _partition_tables(connection, schema='public'):
+    """
+    Returns the names of the tables in a schema that are partitions of another table.
+    """
+    return set(connection.execute(text('''
+        SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relispartition AND n.nspname = :schema
+    '''), {"schema": schema}).scalars())
+
+def _get_partitions(connection, table_name, schema='public'):
+    """
+    Returns the names of the partitions of a table.
+    """
+    return list(connection.execute(text('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:table_name)
+        ORDER BY c.relname
+    '''), {"table_name": f'"{schema}"."{table_name}"'}).scalars())
+
+def _is_partitioned(connection, table_name, schema='public'):
+    """
+    Returns whether a table is a partitioned table.
+    """
+    return bool(connection.execute(text('''
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table_name))
+    '''), {"table_name": f'"{schema}"."{table_name}"'}).scalar())
+
+def _create_partitioned_like(connection, table_name, layout_table, schema='public'):
+    """
+    Creates a table partitioned by the year of PARTITION_COLUMN with the columns of layout_table, and drops layout_table.
+    """
+    connection.execute(text(f'''
+        CREATE TABLE "{schema}"."{table_name}" (LIKE "{schema}"."{layout_table}" INCLUDING DEFAULTS)
+        PARTITION BY RANGE ("{PARTITION_COLUMN}")
+    '''))
+    connection.execute(text(f'DROP TABLE "{schema}"."{layout_table}"'))
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS "{schema}"."{table_name}_pdefault" PARTITION OF "{schema}"."{table_name}" DEFAULT'))
+
+def _ensure_year_partitions(connection, table_name, years, schema='public'):
+    """
+    Creates the missing yearly partitions of a partitioned table.
+
+    Rows without a date go to the default partition. The partitions of the years must exist before rows of those
+    years are written, as a year partition can't be created while the default partition holds rows of that year.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Database connection.
+    table_name (str): Name of the partitioned table.
+    years (iterable): Years to create partitions for.
+    schema (str): The schema of the table.
+    """
+    for year in sorted({int(year) for year in years}):
+        connection.execute(text(f'''
+            CREATE TABLE IF NOT EXISTS "{schema}"."{table_name}_p{year}" PARTITION OF "{schema}"."{table_name}"
+            FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')
+        '''))
+
+def _source_years(connection, source, schema='public'):
     """
-    Retrieves all table names (except default tables) from the database. Returns them as a list.
+    Returns the distinct years of PARTITION_COLUMN in a table.
+    """
+    return connection.execute(text(f'''
+        SELECT DISTINCT date_part('year', "{PARTITION_COLUMN}")::integer FROM "{schema}"."{source}"
+        WHERE "{PARTITION_COLUMN}" IS NOT NULL
+    ''')).scalars().all()
+
+def _rename_partitions(connection, table_name, old_prefix, schema='public'):
+    """
+    Renames the partitions of a renamed table so that they are prefixed with the new table name.
+    """
+    for partition in _get_partitions(connection, table_name, schema):
+        if partition.startswith(old_prefix):
+            connection.execute(text(f'ALTER TABLE "{schema}"."{partition}" RENAME TO "{table_name}{partition[len(old_prefix):]}"'))
+
+def get_geometry_columns(table_name):
+    """
+    Returns the generated geometry columns of an occurrence table and their expressions: the geometry in
+    EPSG:3067 and, for polygon tables, the SIMPLIFIED_GEOMETRY_COLUMNS simplified in EPSG:3067 so that the
+    tolerances are in metres.
+    """
+    columns = {PROJECTED_GEOMETRY_COLUMN: 'ST_Transform(geometry, 3067)::geometry(GEOMETRY, 3067)'}
+    if table_name.endswith('_polygons'):
+        for column, tolerance in SIMPLIFIED_GEOMETRY_COLUMNS.items():
+            columns[column] = f'ST_Transform(ST_SimplifyPreserveTopology(ST_Transform(geometry, 3067), {tolerance}), 4326)::geometry(GEOMETRY, 4326)'
+    return columns
+
+def add_geometry_columns(connection, table_name, schema='public'):
+    """
+    Adds the missing columns of get_geometry_columns to a table as generated columns.
+
+    Generated columns are kept up to date by PostgreSQL when rows are inserted or updated, also by incremental
+    updates. Adding a column to a table with rows rewrites the table, so they are added while tables are empty
+    when possible. The caller commits.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Database connection.
+    table_name (str): Name of the table.
+    schema (str): The schema of the table.
+
+    Returns:
+    list: The added columns.
     """
-    inspector = inspect(get_engine())
-    tables = inspector.get_table_names()
-    return [table for table in tables if table not in postgis_default_tables]
+    existing = set(connection.execute(text('''
+        SELECT column_name FROM information_schema.columns WHERE table_schema = :schema AND table_name = :tname
+    '''), {"schema": schema, "tname": table_name}).scalars().all())
+    added = []
+    for column, expression in get_geometry_columns(table_name).items():
+        if column in existing:
+            continue
+        connection.execute(text(f'ALTER TABLE "{schema}"."{table_name}" ADD COLUMN "{column}" GENERATED ALWAYS AS ({expression}) STORED'))
+        added.append(column)
+    return added
 
 def get_table_bbox(table_name):
     """
@@ -211,6 +518,176 @@ def get_table_dates(table_name):
     min_date, max_date = result if result else (None, None)
     return min_date, max_date
 
+def _create_collection_stats_table(connection, schema='public'):
+    """
+    Creates the collection statistics table of a schema if it does not exist.
+    """
+    connection.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS "{schema}"."{COLLECTION_STATS_TABLE}" (
+            table_name TEXT PRIMARY KEY,
+            min_x DOUBLE PRECISION,
+            min_y DOUBLE PRECISION,
+            max_x DOUBLE PRECISION,
+            max_y DOUBLE PRECISION,
+            min_date TIMESTAMP,
+            max_date TIMESTAMP,
+            occurrences BIGINT NOT NULL,
+            quality JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    '''))
+
+def prepare_database(lookup_df=None):
+    """
+    Creates the database objects shared by all tables of an ingest: the shadow schema, the collection statistics
+    tables of both schemas and the extensions needed by the indexes. Called once before the datasets are loaded in parallel, as
+    concurrent CREATE ... IF NOT EXISTS statements of the same object can fail.
+
+    Parameters:
+    lookup_df (pd.DataFrame, optional): The lookup table whose index_type column defines the indexes.
+    """
+    with get_engine().connect() as connection:
+        connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{SHADOW_SCHEMA}"'))
+        _create_collection_stats_table(connection)
+        _create_collection_stats_table(connection, SHADOW_SCHEMA)
+        connection.commit()
+
+    if any(index_type == 'trgm' for _, index_type in get_index_plan(lookup_df)):
+        try:
+            with get_engine().connect() as connection:
+                connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                connection.commit()
+        except Exception as e:
+            logger.warning(f"Extension pg_trgm is not available, skipping trigram indexes: {e}")
+
+def _stats_query(relation, columns):
+    """
+    Returns a query that computes the statistics of a table or CTE in one scan: the extent, the first and last
+    collection dates, the number of rows and the number of rows of each Aineiston_laatu value. Columns that are not
+    in columns are left empty.
+    """
+    def column(name):
+        return f'"{name}"' if name in columns else 'NULL'
+
+    return f'''
+        SELECT ST_XMin(extent) AS min_x, ST_YMin(extent) AS min_y, ST_XMax(extent) AS max_x, ST_YMax(extent) AS max_y,
+               min_date, max_date, occurrences, quality
+        FROM (
+            SELECT ST_Extent(extent::geometry) AS extent, MIN(min_date) AS min_date, MAX(max_date) AS max_date,
+                   COALESCE(SUM(n), 0)::bigint AS occurrences,
+                   COALESCE(jsonb_object_agg(quality, n) FILTER (WHERE quality IS NOT NULL), '{{}}'::jsonb) AS quality
+            FROM (
+                SELECT {column('Aineiston_laatu')}::text AS quality,
+                       ST_Extent({column('geometry')}::geometry) AS extent,
+                       MIN({column('Keruu_aloitus_pvm')}::timestamp) AS min_date,
+                       MAX({column('Keruu_lopetus_pvm')}::timestamp) AS max_date,
+                       COUNT(*) AS n
+                FROM {relation}
+                GROUP BY 1
+            ) per_quality
+        ) totals
+    '''
+
+def _write_collection_stats(connection, table_name, stats, schema='public'):
+    """
+    Inserts or replaces the statistics row of a table in the statistics table of its schema.
+    """
+    min_x, min_y, max_x, max_y, min_date, max_date, occurrences, quality = stats
+    connection.execute(text(f'''
+        INSERT INTO "{schema}"."{COLLECTION_STATS_TABLE}" AS stats (table_name, min_x, min_y, max_x, max_y, min_date, max_date, occurrences, quality)
+        VALUES (:table_name, :min_x, :min_y, :max_x, :max_y, :min_date, :max_date, :occurrences, CAST(:quality AS jsonb))
+        ON CONFLICT (table_name) DO UPDATE SET
+            min_x = EXCLUDED.min_x, min_y = EXCLUDED.min_y, max_x = EXCLUDED.max_x, max_y = EXCLUDED.max_y,
+            min_date = EXCLUDED.min_date, max_date = EXCLUDED.max_date, occurrences = EXCLUDED.occurrences,
+            quality = EXCLUDED.quality, updated_at = now()
+    '''), {"table_name": table_name, "min_x": min_x, "min_y": min_y, "max_x": max_x, "max_y": max_y,
+          "min_date": min_date, "max_date": max_date, "occurrences": occurrences, "quality": json.dumps(quality)})
+
+def update_collection_stats(connection, table_name, columns, schema='public'):
+    """
+    Computes the statistics of a table in one scan and stores them to the collection statistics table of its
+    schema. The statistics of shadow tables are moved to the public table when they are published. The caller commits.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Database connection.
+    table_name (str): Name of the table.
+    columns (list): Columns of the table.
+    schema (str): The schema of the table.
+    """
+    stats = connection.execute(text(_stats_query(f'"{schema}"."{table_name}"', columns))).one()
+    _write_collection_stats(connection, table_name, tuple(stats), schema)
+
+def _combine_collection_stats(current, added, removed=()):
+    """
+    Combines the statistics of a table with the statistics of the rows added to and removed from it.
+
+    The extent and the dates can't shrink without a scan, so they only grow; the next full load makes them exact.
+
+    Parameters:
+    current (tuple): Statistics of the table, as returned by _stats_query.
+    added (tuple): Statistics of the added rows.
+    removed (iterable): Statistics of the removed rows.
+
+    Returns:
+    tuple: The combined statistics.
+    """
+    def pick(function, *values):
+        values = [value for value in values if value is not None]
+        return function(values) if values else None
+
+    quality = dict(current[7])
+    for key, count in added[7].items():
+        quality[key] = quality.get(key, 0) + count
+    occurrences = current[6] + added[6]
+    for stats in removed:
+        occurrences -= stats[6]
+        for key, count in stats[7].items():
+            quality[key] = quality.get(key, 0) - count
+    quality = {key: count for key, count in quality.items() if count > 0}
+
+    return (
+        pick(min, current[0], added[0]), pick(min, current[1], added[1]),
+        pick(max, current[2], added[2]), pick(max, current[3], added[3]),
+        pick(min, current[4], added[4]), pick(max, current[5], added[5]),
+        max(occurrences, 0), quality
+    )
+
+def get_collection_stats():
+    """
+    Retrieve the statistics of all tables from the collection statistics table.
+
+    Returns:
+    dict: Table name to a dictionary with bbox, min_date and max_date (RFC3339), occurrences and quality_dict
+          (percentages of the Aineiston_laatu values, like get_quality_frequency).
+    """
+    with get_engine().connect() as connection:
+        if connection.execute(text("SELECT to_regclass(:table_name)"), {"table_name": COLLECTION_STATS_TABLE}).scalar() is None:
+            return {}
+        rows = connection.execute(text(f'''
+            SELECT table_name, min_x, min_y, max_x, max_y,
+                   TO_CHAR(min_date, 'YYYY-MM-DD"T"HH24:MI:SS"Z"'),
+                   TO_CHAR(max_date, 'YYYY-MM-DD"T"HH24:MI:SS"Z"'),
+                   occurrences, quality
+            FROM "{COLLECTION_STATS_TABLE}"
+        ''')).fetchall()
+
+    collection_stats = {}
+    for table_name, min_x, min_y, max_x, max_y, min_date, max_date, occurrences, quality in rows:
+        quality_dict = {}
+        if occurrences:
+            quality_dict = {key: round(count * 100 / occurrences, 2) for key, count in quality.items()}
+            without_quality = occurrences - sum(quality.values())
+            if without_quality > 0:
+                quality_dict[None] = round(without_quality * 100 / occurrences, 2)
+        collection_stats[table_name] = {
+            "bbox": [min_x, min_y, max_x, max_y] if min_x is not None else None,
+            "min_date": min_date,
+            "max_date": max_date,
+            "occurrences": occurrences,
+            "quality_dict": quality_dict
+        }
+    return collection_stats
+
 def check_table_exists(table_name):
     """
     Check if a table exists in the database.
@@ -250,22 +727,77 @@ def get_amount_of_occurrences(table_name):
 
 def get_amount_of_all_occurrences():
     """
-    Retrieve the number of all occurrences from the database.
+    Retrieve the number of all occurrences from the database. Tables that have statistics in the collection
+    statistics table are not scanned.
 
     Returns:
     int: Total number of occurrences.
     """
     tables = get_all_tables()
-    total_occurrences = sum(get_amount_of_occurrences(table) for table in tables)
+    collection_stats = get_collection_stats()
+    total_occurrences = sum(
+        collection_stats[table]["occurrences"] if table in collection_stats else get_amount_of_occurrences(table)
+        for table in tables
+    )
     return total_occurrences
 
-def to_db(gdf, table_names):
+def _copy_to_postgis(connection, gdf, table_name, unlogged=False, partition_by_year=False):
+    """
+    Write a GeoDataFrame to a PostGIS table with COPY ... FROM STDIN, creating the table first if it does not exist.
+
+    The rows are streamed as CSV with geometries as hex-encoded EWKB, which avoids the INSERT batches of
+    GeoDataFrame.to_postgis. The index is written to the column Paikallinen_tunniste. The caller commits.
+
+    Parameters:
+    connection (sqlalchemy.engine.Connection): Database connection.
+    gdf (GeoDataFrame): The occurrences to write.
+    table_name (str): Name of the table.
+    unlogged (bool): Whether a new table is created as UNLOGGED, which skips the write-ahead log.
+    partition_by_year (bool): Whether a new table is partitioned by the year of PARTITION_COLUMN. UNLOGGED tables are not partitioned.
+    """
+    # Also begins the transaction that the COPY below runs in
+    exists = connection.execute(text("SELECT to_regclass(:table_name)"), {"table_name": f'public."{table_name}"'}).scalar() is not None
+    if not exists:
+        partitioned = partition_by_year and not unlogged and PARTITION_COLUMN in gdf.columns
+        layout_table = f'{table_name}_layout' if partitioned else table_name
+        # Empty frame, so the geometry column is created as the generic geometry(GEOMETRY)
+        gdf.head(0).to_postgis(layout_table, connection, schema='public', index=True, index_label='Paikallinen_tunniste')
+        if partitioned:
+            _create_partitioned_like(connection, table_name, layout_table)
+        if unlogged:
+            connection.execute(text(f'ALTER TABLE "{table_name}" SET UNLOGGED'))
+    if gdf.empty:
+        return
+
+    if PARTITION_COLUMN in gdf.columns and _is_partitioned(connection, table_name):
+        years = pd.to_datetime(gdf[PARTITION_COLUMN], errors='coerce').dt.year.dropna().unique()
+        _ensure_year_partitions(connection, table_name, years)
+
+    geometry_column = gdf.geometry.name
+    srid = gdf.crs.to_epsg() if gdf.crs else 4326
+    frame = pd.DataFrame(gdf.drop(columns=geometry_column))
+    frame.index.name = 'Paikallinen_tunniste'
+    frame = frame.reset_index()
+    frame[geometry_column] = shapely.to_wkb(shapely.set_srid(np.asarray(gdf.geometry.values), srid), hex=True, include_srid=True)
+
+    # \N marks NULL, so that empty strings stay empty strings
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+
+    columns = ', '.join(f'"{col}"' for col in frame.columns)
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f'''COPY "{table_name}" ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')''', buffer)
+
+def to_db(gdf, table_names, unlogged=False, partition_by_year=False):
     """
     Process and insert geospatial data into a PostGIS database.
 
     Parameters:
     gdf (GeoDataFrame): The main GeoDataFrame containing occurrences.
     table_names (list): DB table names
+    unlogged (bool): Whether new tables are created as UNLOGGED (for staging tables that are finalized later)
+    partition_by_year (bool): Whether new tables are partitioned by the year of PARTITION_COLUMN
 
     Returns:
     int: An updated counter for failed occurrence inserts.
@@ -288,173 +820,724 @@ def to_db(gdf, table_names):
     with get_engine().connect() as conn:
         for table_name, geom_gdf in geom_types.items():
             try:
-                geom_gdf.to_postgis(table_name, conn, if_exists='append', schema='public', index=True, index_label='Paikallinen_tunniste')
+                _copy_to_postgis(conn, geom_gdf, table_name, unlogged, partition_by_year)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error occurred: {e}")
+                failed_features_count += len(geom_gdf)
+
+    return failed_features_count
+
+def upsert_to_db(gdf, table_names):
+    """
+    Insert occurrences to staging tables, replacing earlier versions of the same occurrences.
+
+    Each batch is written to a temporary delta table and then inserted with INSERT ... ON CONFLICT on the
+    unique Havainnon_tunniste of the staging table, so that the staging tables hold the latest version of
+    each occurrence and loading the same batch again (e.g. after a resumed run) has no effect.
+
+    Parameters:
+    gdf (GeoDataFrame): The main GeoDataFrame containing occurrences.
+    table_names (list): Staging table names for points, lines and polygons
+
+    Returns:
+    int: An updated counter for failed occurrence inserts.
+    """
+    if 'Paikallinen_tunniste' in gdf.columns:
+        gdf = gdf.set_index('Paikallinen_tunniste', drop=True)
+
+    geom_types = {
+        table_names[0]: gdf[gdf.geometry.geom_type.isin(['Point','MultiPoint'])],
+        table_names[1]: gdf[gdf.geometry.geom_type.isin(['LineString', 'MultiLineString'])],
+        table_names[2]: gdf[gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])]
+    }
+
+    failed_features_count = 0
+
+    with get_engine().connect() as conn:
+        for table_name, geom_gdf in geom_types.items():
+            if geom_gdf.empty:
+                continue
+            delta_table = f'{table_name}{DELTA_SUFFIX}'
+            columns = ', '.join(f'"{col}"' for col in ['Paikallinen_tunniste', *geom_gdf.columns])
+            updates = ', '.join(f'"{col}" = EXCLUDED."{col}"' for col in ['Paikallinen_tunniste', *geom_gdf.columns] if col != 'Havainnon_tunniste')
+            try:
+                conn.execute(text(f'DROP TABLE IF EXISTS "{delta_table}"'))
+                _copy_to_postgis(conn, geom_gdf, delta_table)
+                if conn.execute(text("SELECT to_regclass(:table_name)"), {"table_name": f'public."{table_name}"'}).scalar() is None:
+                    conn.execute(text(f'CREATE TABLE "{table_name}" (LIKE "{delta_table}")'))
+                    # Later batches may contain other geometry types than the first one
+                    conn.execute(text(f'ALTER TABLE "{table_name}" ALTER COLUMN geometry TYPE geometry(GEOMETRY, 4326)'))
+                    conn.execute(text(f'CREATE UNIQUE INDEX "idx_{table_name}_tunniste" ON "{table_name}" ("Havainnon_tunniste")'))
+                # A row can be updated only once per statement, so duplicates within the batch are removed first
+                conn.execute(text(f'''
+                    INSERT INTO "{table_name}" ({columns})
+                    SELECT DISTINCT ON ("Havainnon_tunniste") {columns}
+                    FROM "{delta_table}"
+                    ORDER BY "Havainnon_tunniste", "Lataus_pvm" DESC NULLS LAST
+                    ON CONFLICT ("Havainnon_tunniste") DO UPDATE SET {updates}
+                    WHERE "{table_name}"."Lataus_pvm" IS NULL OR EXCLUDED."Lataus_pvm" >= "{table_name}"."Lataus_pvm"
+                '''))
+                conn.execute(text(f'DROP TABLE "{delta_table}"'))
+                conn.commit()
             except Exception as e:
+                conn.rollback()
                 logger.error(f"Error occurred: {e}")
                 failed_features_count += len(geom_gdf)
 
     return failed_features_count
 
-def update_single_table_indexes(table_name, connection):
+DEFAULT_INDEX_WORKERS = 4
+
+INDEX_METHODS = {
+    'btree': 'USING btree ("{column}")',
+    'brin': 'USING brin ("{column}")',
+    'gist': 'USING gist ("{column}")',
+    'trgm': 'USING gin ("{column}" gin_trgm_ops)',
+}
+DEFAULT_INDEX_PLAN = [('Kunta', 'btree'), ('geometry', 'gist')]
+
+def _index_name(table_name, column):
+    """
+    Returns the index name of a column, shortened with a hash suffix if it exceeds PostgreSQL's 63 character limit.
+    """
+    suffix = 'geom' if column == 'geometry' else column.replace('geometry', 'geom')
+    index_name = f'idx_{table_name}_{suffix}'
+    if len(index_name) > 63:
+        digest = hashlib.md5(index_name.encode('utf-8')).hexdigest()[:8]
+        index_name = f'{index_name[:54]}_{digest}'
+    return index_name
+
+def get_index_plan(lookup_df=None):
+    """
+    Returns the indexed columns of the occurrence tables as (column, index type) pairs.
+
+    The plan is read from the index_type column of the lookup table, so that the filterable columns
+    are indexed with a method that suits them: btree for codes, identifiers and dates, trgm (pg_trgm GIN)
+    for names searched with partial matches and gist for the geometry. brin only suits columns that follow
+    the physical row order, which the dates do not, as finalized tables are stored in spatial order. A gist
+    index of the geometry also gets one of PROJECTED_GEOMETRY_COLUMN.
+
+    Parameters:
+    lookup_df (pd.DataFrame, optional): The lookup table. Without it, only Kunta and geometry are indexed.
+
+    Returns:
+    list: (column name, index type) pairs.
+    """
+    if lookup_df is None or 'index_type' not in lookup_df.columns:
+        plan = list(DEFAULT_INDEX_PLAN)
+    else:
+        plan = []
+        for column, index_type in lookup_df[['virva', 'index_type']].dropna().itertuples(index=False):
+            index_type = str(index_type).strip().lower()
+            if index_type not in INDEX_METHODS:
+                logger.warning(f"Unknown index type {index_type} for column {column}, skipping")
+                continue
+            plan.append((column, index_type))
+
+    if ('geometry', 'gist') in plan:
+        plan.append((PROJECTED_GEOMETRY_COLUMN, 'gist'))
+    return plan
+
+def _index_statements(table_name, schema='public', lookup_df=None, index_plan=None):
+    """
+    Returns the indexes of an occurrence table as (index name, CREATE INDEX statement) pairs.
+    """
+    if index_plan is None:
+        index_plan = get_index_plan(lookup_df)
+    statements = []
+    for column, index_type in index_plan:
+        index_name = _index_name(table_name, column)
+        method = INDEX_METHODS[index_type].format(column=column)
+        statements.append((index_name, f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{schema}"."{table_name}" {method}'))
+    return statements
+
+def _available_index_plan(index_plan):
+    """
+    Returns the plan without trigram indexes if the pg_trgm extension has not been created (see prepare_database).
+    """
+    if not any(index_type == 'trgm' for _, index_type in index_plan):
+        return index_plan
+    with get_engine().connect() as connection:
+        if connection.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None:
+            return index_plan
+    logger.warning("Extension pg_trgm is not available, skipping trigram indexes")
+    return [(column, index_type) for column, index_type in index_plan if index_type != 'trgm']
+
+def _build_index(connection, index_name, statement, maintenance_work_mem=None):
+    """
+    Runs one CREATE INDEX statement and returns its duration in seconds.
+    """
+    if maintenance_work_mem:
+        # Local to the transaction, so that the setting does not stay on the pooled connection
+        connection.execute(text("SELECT set_config('maintenance_work_mem', :value, true)"), {"value": maintenance_work_mem})
+    start = time.monotonic()
+    connection.execute(text(statement))
+    connection.commit()
+    elapsed = time.monotonic() - start
+    logger.info(f"Built index {index_name} in {elapsed:.1f} s")
+    return elapsed
+
+def _build_index_on_own_connection(index_name, statement, maintenance_work_mem=None):
+    """
+    Runs one CREATE INDEX statement on a connection of its own from the engine pool.
+    """
+    with get_engine().connect() as connection:
+        return _build_index(connection, index_name, statement, maintenance_work_mem)
+
+def _analyze_table(table_name, schema='public'):
+    """
+    Updates the planner statistics of a table.
+    """
+    with get_engine().connect() as connection:
+        connection.execute(text(f'ANALYZE "{schema}"."{table_name}"'))
+        connection.commit()
+
+def update_single_table_indexes(table_name, connection, schema='public', maintenance_work_mem=None, lookup_df=None):
     """
     Updates indexes for a single table.
 
     Parameters:
     table_name (str): The name of the table to update indexes for.
+    schema (str): The schema of the table.
+    maintenance_work_mem (str, optional): PostgreSQL maintenance_work_mem for the index builds, e.g. '1GB'.
+    lookup_df (pd.DataFrame, optional): The lookup table whose index_type column defines the indexes.
+
+    Returns:
+    dict: Build time in seconds of each index.
     """
     logger.debug(f"Updating indexes for table: {table_name}")
 
-    index_creation_sql = text(f'''
-        CREATE INDEX IF NOT EXISTS "idx_{table_name}_Kunta" ON "{table_name}" ("Kunta");
-        CREATE INDEX IF NOT EXISTS "idx_{table_name}_geom" ON "{table_name}" USING GIST (geometry);
-    ''')
-    connection.execute(index_creation_sql)
-    connection.commit()
+    return {
+        index_name: _build_index(connection, index_name, statement, maintenance_work_mem)
+        for index_name, statement in _index_statements(table_name, schema, lookup_df)
+    }
 
-def update_indexes(table_names, use_multiprocessing=True):
+def update_indexes(table_names, use_multiprocessing=True, schema='public', max_workers=DEFAULT_INDEX_WORKERS, maintenance_work_mem=None, lookup_df=None):
     """
-    Updates spatial and normal indexes for the given tables.
+    Updates spatial and normal indexes for the given tables and analyzes the tables afterwards.
+
+    The indexes are built in parallel threads, each on its own pooled connection; the builds themselves
+    run in separate PostgreSQL backends.
 
     Parameters:
     table_names (list): A list of PostGIS table names to update indexes for.
-    use_multiprocessing (bool): Whether to use multiprocessing for updating indexes.
+    use_multiprocessing (bool): Whether to build the indexes in parallel.
+    schema (str): The schema of the tables.
+    max_workers (int): Number of indexes built at the same time.
+    maintenance_work_mem (str, optional): PostgreSQL maintenance_work_mem for the index builds, e.g. '1GB'.
+    lookup_df (pd.DataFrame, optional): The lookup table whose index_type column defines the indexes.
+
+    Returns:
+    dict: Build time in seconds of each index.
     """
-    if table_names:
-        with get_engine().connect() as connection:
-            if use_multiprocessing:
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    executor.map(update_single_table_indexes, table_names, [connection]*len(table_names))
-            else:
-                for table_name in table_names:
-                    update_single_table_indexes(table_name, connection)
-    else:
+    if not table_names:
         logger.warning("No table names given, can't update table indexes")
+        return {}
+
+    index_plan = _available_index_plan(get_index_plan(lookup_df))
+    indexes = [index for table_name in table_names for index in _index_statements(table_name, schema, index_plan=index_plan)]
+    timings = {}
+    if use_multiprocessing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="index") as executor:
+            futures = {
+                executor.submit(_build_index_on_own_connection, index_name, statement, maintenance_work_mem): index_name
+                for index_name, statement in indexes
+            }
+            for future in concurrent.futures.as_completed(futures):
+                timings[futures[future]] = future.result()
+            list(executor.map(_analyze_table, table_names, [schema] * len(table_names)))
+    else:
+        with get_engine().connect() as connection:
+            for index_name, statement in indexes:
+                timings[index_name] = _build_index(connection, index_name, statement, maintenance_work_mem)
+        for table_name in table_names:
+            _analyze_table(table_name, schema)
+
+    logger.info(f"Built {len(timings)} indexes for {len(table_names)} tables in {sum(timings.values()):.1f} s of build time")
+    return timings
 
-def remove_duplicates(table_names):
+def _merge_aggregations(lookup_df):
     """
-    Remove duplicate rows from the specified tables based on the 'Havainnon_tunniste' attribute to ensure DB has no occurrences with identical IDs.
+    Build the aggregations that merge similar observations, based on the merge_option column of the lookup table.
 
     Parameters:
-    table_names (list): The names of the tables to be checked for duplicates.
+    lookup_df (DataFrame): DataFrame containing column configuration with 'merge_option' and 'virva' columns.
 
     Returns:
-    int: The number of duplicate rows removed.
+    tuple: The columns to group by, the aggregation clauses (including geometry) and the aggregated column names in the same order.
     """
-    removed_occurrences = 0
-    
+    columns_to_group_by = lookup_df.loc[lookup_df['merge_option'] == 'GROUPBY', 'virva'].values.tolist()
+    columns_to_aggregate = lookup_df.loc[lookup_df['merge_option'] == 'AGGREGATE', 'virva'].values.tolist()
+    columns_to_use_first_value = lookup_df.loc[lookup_df['merge_option'] == 'FIRST', 'virva'].values.tolist()
+    columns_to_sum = lookup_df.loc[lookup_df['merge_option'] == 'SUM', 'virva'].values.tolist()
+    columns_to_use_max = lookup_df.loc[lookup_df['merge_option'] == 'MAX', 'virva'].values.tolist()
+
+    agg_clauses = []
+    for col in columns_to_use_first_value:
+        agg_clauses.append(f'(ARRAY_AGG("{col}"))[1] as "{col}"')
+    for col in columns_to_aggregate:
+        agg_clauses.append(f'string_agg("{col}", \', \') FILTER (WHERE "{col}" IS NOT NULL AND "{col}" != \'nan\') as "{col}"')
+    for col in columns_to_sum:
+        agg_clauses.append(f'SUM("{col}") as "{col}"')
+    for col in columns_to_use_max:
+        agg_clauses.append(f'MAX("{col}") as "{col}"')
+    agg_clauses.append('ST_SetSRID((ARRAY_AGG(geometry))[1],4326)::geometry(GEOMETRY,4326) AS geometry')
+
+    aggregated_columns = columns_to_use_first_value + columns_to_aggregate + columns_to_sum + columns_to_use_max + ['geometry']
+    return columns_to_group_by, agg_clauses, aggregated_columns
+
+# Spatial key that finalized tables are physically ordered by, so that nearby occurrences are on nearby pages
+SPATIAL_SORT_KEY = 'CASE WHEN NOT ST_IsEmpty(geometry) THEN ST_GeoHash(ST_Centroid(geometry), 12) END'
+
+def _spatial_correlation(connection, table_name, schema='public', sample_pages=2000):
+    """
+    Returns the correlation between the physical order of the rows of a table and their SPATIAL_SORT_KEY order.
+
+    1 means that the rows are stored in spatial order, values near 0 that a spatial query touches pages all over the
+    table. The correlation is computed from a sample of about sample_pages pages, within each partition.
+
+    Returns:
+    float: The correlation, or None if the table is empty.
+    """
+    pages = connection.execute(text('''
+        SELECT COALESCE(SUM(pg_relation_size(c.oid)), 0) / current_setting('block_size')::bigint
+        FROM pg_class c
+        WHERE c.oid = to_regclass(:table_name) OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(:table_name))
+    '''), {"table_name": f'"{schema}"."{table_name}"'}).scalar()
+    if not pages:
+        return None
+    return connection.execute(text(f'''
+        SELECT corr(physical, spatial) FROM (
+            SELECT row_number() OVER (PARTITION BY tableoid ORDER BY ctid) AS physical,
+                   row_number() OVER (PARTITION BY tableoid ORDER BY {SPATIAL_SORT_KEY}) AS spatial
+            FROM "{schema}"."{table_name}" TABLESAMPLE SYSTEM (:percent)
+        ) ordered
+    '''), {"percent": min(100.0, 100.0 * sample_pages / pages)}).scalar()
+
+def _format_correlation(correlation):
+    return 'n/a' if correlation is None else f'{correlation:.2f}'
+
+def get_grid_tables():
+    """
+    Returns the names of the grid tables that exist in the database.
+    """
+    return [grid_table for grid_table in GRID_TABLES if check_table_exists(grid_table)]
+
+def build_grid_tables(table_names, grid_tables=GRID_TABLES, lock_timeout='5s', max_attempts=10):
+    """
+    Aggregate the occurrences of the given tables to EUREF-TM35FIN (EPSG:3067) grid tables.
+
+    Each occurrence is counted in the cell of a point on its geometry. A cell has the number of occurrences
+    (merged rows count as Yhdistetty occurrences), the number of taxa and the latest collection date. The finest
+    grid is computed from the tables and coarser grids from it, so the tables are scanned once.
+
+    The grids are built into new tables (GRID_BUILD_SUFFIX) while the old ones are still served, and then swapped
+    in with renames in one short transaction, like in publish_shadow_tables: the transaction waits for the table
+    locks at most lock_timeout at a time, so that it does not queue readers behind a long query, and is retried
+    after a timeout.
+
+    Parameters:
+    table_names (list): Occurrence tables to aggregate.
+    grid_tables (dict): Grid table names and their cell sizes in metres. The sizes must be multiples of the smallest one.
+    lock_timeout (str): PostgreSQL lock_timeout for one attempt of the swap.
+    max_attempts (int): Number of attempts of the swap before giving up.
+
+    Returns:
+    dict: The number of cells in each grid table.
+    """
+    if not table_names:
+        logger.warning("No tables to aggregate to grids")
+        return {}
+
+    cell_size = min(grid_tables.values())
+    occurrences = ' UNION ALL '.join(f'''
+        SELECT ST_Transform(ST_PointOnSurface(geometry), 3067) AS point, "Taksonin_tunniste",
+               COALESCE("Yhdistetty", 1) AS occurrences, COALESCE("Keruu_lopetus_pvm", "Keruu_aloitus_pvm") AS collected
+        FROM "{table_name}"
+        WHERE geometry IS NOT NULL AND NOT ST_IsEmpty(geometry)
+    ''' for table_name in table_names)
+
+    cell_counts = {}
     with get_engine().connect() as connection:
-        # Add id column to all tables that need it (once, outside the loop)
-        for table_name in table_names:
-            id_column_check = connection.execute(text(f'''
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_name = '{table_name}' AND column_name = 'id';
-            ''')).fetchone()
-
-            if not id_column_check:
-                connection.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN "id" SERIAL PRIMARY KEY;'))
-        
+        # Occurrences by the cells of the finest grid and taxon
+        connection.execute(text(f'''
+            CREATE TEMPORARY TABLE grid_taxa ON COMMIT DROP AS
+            SELECT floor(ST_X(point) / {cell_size})::integer AS cell_x, floor(ST_Y(point) / {cell_size})::integer AS cell_y,
+                   "Taksonin_tunniste" AS taxon, SUM(occurrences) AS occurrences, MAX(collected) AS collected
+            FROM ({occurrences}) o
+            GROUP BY 1, 2, 3
+        '''))
+
+        for grid_table, size in grid_tables.items():
+            factor = size // cell_size
+            new_table = f'{grid_table}{GRID_BUILD_SUFFIX}'
+            # Left over from an interrupted build
+            connection.execute(text(f'DROP TABLE IF EXISTS "{new_table}"'))
+            connection.execute(text(f'''
+                CREATE TABLE "{new_table}" AS
+                SELECT (y * {size // 1000})::text || ':' || (x * {size // 1000})::text AS "Ruudun_tunniste",
+                       occurrences::bigint AS "Havaintojen_lukumaara",
+                       taxa::integer AS "Taksonien_lukumaara",
+                       collected AS "Viimeisin_havainto",
+                       ST_Transform(ST_MakeEnvelope(x * {size}, y * {size}, (x + 1) * {size}, (y + 1) * {size}, 3067), 4326)::geometry(POLYGON, 4326) AS geometry
+                FROM (
+                    SELECT floor(cell_x::numeric / {factor})::integer AS x, floor(cell_y::numeric / {factor})::integer AS y,
+                           SUM(occurrences) AS occurrences, COUNT(DISTINCT taxon) AS taxa, MAX(collected) AS collected
+                    FROM grid_taxa
+                    GROUP BY 1, 2
+                ) cells
+            '''))
+            connection.execute(text(f'ALTER TABLE "{new_table}" ADD CONSTRAINT "{new_table}_pkey" PRIMARY KEY ("Ruudun_tunniste")'))
+            connection.execute(text(f'CREATE INDEX "idx_{new_table}_geom" ON "{new_table}" USING GIST (geometry)'))
+            cell_counts[grid_table] = connection.execute(text(f'SELECT COUNT(*) FROM "{new_table}"')).scalar()
         connection.commit()
-        
-        # Remove duplicates from each table
+
+        for attempt in range(1, max_attempts + 1):
+            try:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+                for grid_table in grid_tables:
+                    new_table = f'{grid_table}{GRID_BUILD_SUFFIX}'
+                    connection.execute(text(f'DROP TABLE IF EXISTS "{grid_table}"'))
+                    connection.execute(text(f'ALTER TABLE "{new_table}" RENAME TO "{grid_table}"'))
+                    connection.execute(text(f'ALTER TABLE "{grid_table}" RENAME CONSTRAINT "{new_table}_pkey" TO "{grid_table}_pkey"'))
+                    connection.execute(text(f'ALTER INDEX "idx_{new_table}_geom" RENAME TO "idx_{grid_table}_geom"'))
+                connection.commit()
+                break
+            except OperationalError as e:
+                connection.rollback()
+                if attempt == max_attempts:
+                    raise
+                logger.warning(f"Replacing grid tables failed ({e.orig}), retrying...")
+                time.sleep(attempt)
+
+    logger.info(f"Built grid tables: {cell_counts}")
+    return cell_counts
+
+def has_rows(table_names):
+    """
+    Check if any of the given tables exists and contains rows.
+
+    Parameters:
+    table_names (list): The names of the tables to check.
+
+    Returns:
+    bool: True if at least one of the tables has rows.
+    """
+    with get_engine().connect() as connection:
         for table_name in table_names:
-            number_before_deletion = get_amount_of_occurrences(table_name)
-            
-            # Create new table with distinct rows, keeping the one with latest Lataus_pvm
+            if connection.execute(text("SELECT to_regclass(:table_name)"), {"table_name": f'public."{table_name}"'}).scalar() is None:
+                continue
+            if connection.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{table_name}")')).scalar():
+                return True
+    return False
+
+def finalize_tables(table_names, lookup_df, source_table_names=None, schema='public', partition_by_year=False):
+    """
+    Remove duplicates and merge similar observations in a single pass over each table.
+
+    One statement keeps the latest version of every Havainnon_tunniste (DISTINCT ON), merges the rows according to
+    the merge_option of the lookup table, counts the merged observations to Yhdistetty and returns the counters.
+    The result is written in SPATIAL_SORT_KEY order to a new table created WITH NO DATA, which replaces the table,
+    and the statistics of the table are updated. The table gets the generated columns of get_geometry_columns. Source tables other than
+    the table itself (e.g. UNLOGGED staging tables written by to_db) are dropped in the same transaction.
+    If schema is not public, the tables are built in that schema (see publish_shadow_tables) and the public tables
+    are left untouched. With partition_by_year, the finalized tables are partitioned by the year of PARTITION_COLUMN.
+
+    Parameters:
+    table_names (list): The names of the tables to finalize.
+    lookup_df (DataFrame): DataFrame containing column configuration with 'merge_option' and 'virva' columns.
+    source_table_names (list, optional): Tables to read the rows from, in the same order. Defaults to table_names.
+    schema (str): Schema to write the finalized tables to.
+    partition_by_year (bool): Whether the finalized tables are partitioned by year.
+
+    Returns:
+    tuple: The number of removed duplicates and the number of merged occurrences.
+    """
+    source_table_names = source_table_names or table_names
+    columns_to_group_by, agg_clauses, aggregated_columns = _merge_aggregations(lookup_df)
+    groupby_columns = ', '.join(f'"{col}"' for col in columns_to_group_by)
+    all_agg_columns = ', '.join(agg_clauses)
+    target_columns = ', '.join(f'"{col}"' for col in columns_to_group_by + aggregated_columns + ['Yhdistetty'])
+    if partition_by_year and PARTITION_COLUMN not in columns_to_group_by + aggregated_columns:
+        logger.warning(f"Column {PARTITION_COLUMN} is not in the lookup table, tables are not partitioned")
+        partition_by_year = False
+
+    total_removed = 0
+    total_merged = 0
+
+    with get_engine().connect() as connection:
+        for table_name, source in zip(table_names, source_table_names):
+            if not check_table_exists(source):
+                logger.error(f"Table {source} does not exist, skipping finalizing.")
+                continue
+
+            # Rows merged by an earlier run already stand for several observations
+            has_yhdistetty = connection.execute(text('''
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = 'public' AND table_name = :tname AND column_name = 'Yhdistetty'
+                )
+            '''), {"tname": source}).scalar()
+            observations = 'SUM(COALESCE("Yhdistetty", 1))' if has_yhdistetty else 'COUNT(*)'
+            new_table_name = f'{table_name}_finalized' if schema == 'public' else table_name
+            new_table = f'"{schema}"."{new_table_name}"'
+            layout_table = f'{new_table_name}_layout' if partition_by_year else new_table_name
+
+            connection.execute(text(f'DROP TABLE IF EXISTS {new_table} CASCADE'))
             connection.execute(text(f'''
-                CREATE TABLE "{table_name}_temp" AS
-                SELECT DISTINCT ON ("Havainnon_tunniste") *
-                FROM "{table_name}"
-                ORDER BY "Havainnon_tunniste", "Lataus_pvm" DESC;
+                CREATE TABLE "{schema}"."{layout_table}" AS
+                SELECT {groupby_columns}, {all_agg_columns}, {observations}::integer AS "Yhdistetty"
+                FROM "{source}"
+                GROUP BY {groupby_columns}
+                WITH NO DATA
             '''))
-            
-            # Replace original table with deduplicated one
-            connection.execute(text(f'DROP TABLE "{table_name}";'))
-            connection.execute(text(f'ALTER TABLE "{table_name}_temp" RENAME TO "{table_name}";'))
+            if partition_by_year:
+                _create_partitioned_like(connection, new_table_name, layout_table, schema)
+                _ensure_year_partitions(connection, new_table_name, _source_years(connection, source), schema)
+            add_geometry_columns(connection, new_table_name, schema)
+            correlation_before = _spatial_correlation(connection, source)
+
+            source_count, deduplicated_count, merged_rows = connection.execute(text(f'''
+                WITH deduplicated AS (
+                    SELECT DISTINCT ON ("Havainnon_tunniste") *
+                    FROM "{source}"
+                    ORDER BY "Havainnon_tunniste", "Lataus_pvm" DESC NULLS LAST
+                ),
+                inserted AS (
+                    INSERT INTO {new_table} ({target_columns})
+                    SELECT * FROM (
+                        SELECT {groupby_columns}, {all_agg_columns}, {observations}
+                        FROM deduplicated
+                        GROUP BY {groupby_columns}
+                    ) merged
+                    ORDER BY {SPATIAL_SORT_KEY}
+                    RETURNING "Yhdistetty"
+                )
+                SELECT (SELECT {observations} FROM "{source}"), COALESCE(SUM("Yhdistetty"), 0), COUNT(*)
+                FROM inserted
+            ''')).one()
+            correlation_after = _spatial_correlation(connection, new_table_name, schema)
+
+            if source != table_name:
+                connection.execute(text(f'DROP TABLE "{source}" CASCADE'))
+            if schema == 'public':
+                connection.execute(text(f'DROP TABLE IF EXISTS "{table_name}" CASCADE'))
+                connection.execute(text(f'ALTER TABLE {new_table} RENAME TO "{table_name}"'))
+                _rename_partitions(connection, table_name, new_table_name)
+            update_collection_stats(connection, table_name, columns_to_group_by + aggregated_columns + ['Yhdistetty'], schema)
             connection.commit()
-            
-            number_after_deletion = get_amount_of_occurrences(table_name)
-            removed_occurrences += number_before_deletion - number_after_deletion
 
-    return removed_occurrences
+            removed = (source_count or 0) - deduplicated_count
+            merged = deduplicated_count - merged_rows
+            logger.info(f"Finalized {table_name}: {removed} duplicates removed, {merged} occurrences merged, "
+                        f"spatial order correlation {_format_correlation(correlation_before)} -> {_format_correlation(correlation_after)}")
+            total_removed += removed
+            total_merged += merged
+
+    return total_removed, total_merged
 
-def merge_similar_observations(table_names, lookup_df):
+def publish_shadow_tables(lock_timeout='5s', max_attempts=10, removed_tables=()):
     """
-    Merge similar observations in PostGIS tables based on specified subset of columns and geometry.
+    Replace the public tables with the tables built in the shadow schema, all in one transaction.
+    Public tables of datasets that no longer have occurrences are dropped in the same transaction, and the
+    statistics of the shadow tables replace those of the public tables.
+
+    Readers see either all old or all new tables, and the new tables are already indexed. The transaction waits for
+    the table locks at most lock_timeout at a time, so that it does not queue readers behind a long query; after a
+    timeout it is retried.
 
     Parameters:
-    table_names (list): List of PostGIS table names to process.
-    lookup_df (DataFrame): DataFrame containing column configuration with 'groupby' and 'virva' columns.
+    lock_timeout (str): PostgreSQL lock_timeout for one attempt.
+    max_attempts (int): Number of attempts before giving up.
+    removed_tables (list): Public tables to drop that have no replacement in the shadow schema.
 
     Returns:
-    int: Total number of merged occurrences across all tables.
+    list: The names of the published tables.
     """
-    # Get columns to group by from lookup table
-    columns_to_group_by = lookup_df.loc[lookup_df['merge_option'] == 'GROUPBY', 'virva'].values.tolist()
-    columns_to_aggregate = lookup_df.loc[lookup_df['merge_option'] == 'AGGREGATE', 'virva'].values.tolist()
-    columns_to_use_first_value = lookup_df.loc[lookup_df['merge_option'] == 'FIRST', 'virva'].values.tolist()
-    columns_to_sum = lookup_df.loc[lookup_df['merge_option'] == 'SUM', 'virva'].values.tolist()
-    columns_to_use_max = lookup_df.loc[lookup_df['merge_option'] == 'MAX', 'virva'].values.tolist()
-    
+    with get_engine().connect() as connection:
+        partitions = _partition_tables(connection, SHADOW_SCHEMA)
+        tables = [table for table in inspect(connection).get_table_names(schema=SHADOW_SCHEMA)
+                  if table not in partitions and table != COLLECTION_STATS_TABLE]
+        table_partitions = {table: _get_partitions(connection, table, SHADOW_SCHEMA) for table in tables}
+        connection.rollback()
+        removed_tables = [table for table in removed_tables if table not in tables]
+        if not tables and not removed_tables:
+            return []
+
+        for attempt in range(1, max_attempts + 1):
+            try:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+                for table_name in tables:
+                    # Dropping a partitioned table also drops its partitions
+                    connection.execute(text(f'DROP TABLE IF EXISTS "public"."{table_name}" CASCADE'))
+                    connection.execute(text(f'ALTER TABLE "{SHADOW_SCHEMA}"."{table_name}" SET SCHEMA "public"'))
+                    for partition in table_partitions[table_name]:
+                        connection.execute(text(f'ALTER TABLE "{SHADOW_SCHEMA}"."{partition}" SET SCHEMA "public"'))
+                for table_name in removed_tables:
+                    connection.execute(text(f'DROP TABLE IF EXISTS "public"."{table_name}" CASCADE'))
+                # The statistics of the published tables replace the old ones
+                connection.execute(text(f'DELETE FROM "public"."{COLLECTION_STATS_TABLE}" WHERE table_name = ANY(:table_names)'),
+                                   {"table_names": tables + removed_tables})
+                connection.execute(text(f'''
+                    INSERT INTO "public"."{COLLECTION_STATS_TABLE}"
+                    SELECT * FROM "{SHADOW_SCHEMA}"."{COLLECTION_STATS_TABLE}" WHERE table_name = ANY(:table_names)
+                '''), {"table_names": tables})
+                connection.execute(text(f'DELETE FROM "{SHADOW_SCHEMA}"."{COLLECTION_STATS_TABLE}" WHERE table_name = ANY(:table_names)'),
+                                   {"table_names": tables})
+                connection.commit()
+                logger.info(f"Published {len(tables)} tables from schema {SHADOW_SCHEMA} and removed {len(removed_tables)} tables")
+                return tables
+            except OperationalError as e:
+                connection.rollback()
+                if attempt == max_attempts:
+                    raise
+                logger.warning(f"Publishing tables failed ({e.orig}), retrying...")
+                time.sleep(attempt)
+
+def apply_staged_changes(table_names, lookup_df):
+    """
+    Apply the occurrences in the staging tables (see upsert_to_db) to the live tables without rebuilding them.
+
+    Earlier versions of the staged occurrences are removed from the live tables, and only the merge groups that
+    the staged occurrences belong to are merged again with them. A merged row that loses an earlier version keeps its
+    other aggregated values until the next full load; only its Havainnon_tunniste and Yhdistetty are corrected.
+    A live table that does not exist yet is replaced by its staging table, which is merged as a whole.
+    Missing generated geometry columns (see get_geometry_columns) are added to the live tables.
+    Missing yearly partitions of partitioned live tables are created, and the statistics of the tables are updated
+    with the changed rows. The staging tables are dropped afterwards.
+
+    Parameters:
+    table_names (list): Names of the live tables.
+    lookup_df (DataFrame): DataFrame containing column configuration with 'merge_option' and 'virva' columns.
+
+    Returns:
+    tuple: The number of live rows that contained earlier versions of the staged occurrences and the number of merged occurrences.
+    """
+    columns_to_group_by, agg_clauses, aggregated_columns = _merge_aggregations(lookup_df)
+    groupby_columns = ', '.join(f'"{col}"' for col in columns_to_group_by)
+    source_columns = ', '.join(f'"{col}"' for col in columns_to_group_by + aggregated_columns)
+    target_columns = ', '.join(f'"{col}"' for col in columns_to_group_by + aggregated_columns + ['Yhdistetty'])
+    live_columns = columns_to_group_by + aggregated_columns + ['Yhdistetty']
+
+    def group_key(alias):
+        # NULL-safe key of a merge group, as GROUP BY treats NULLs as equal but = does not
+        columns = ', '.join(f'{alias}."{col}"' for col in columns_to_group_by)
+        return f'md5(ROW({columns})::text)'
+
+    ids_filter = 'FILTER (WHERE "Havainnon_tunniste" IS NOT NULL AND "Havainnon_tunniste" != \'nan\')'
+
+    # Rows are usually grouped by load date, so the load dates of the staged rows narrow down the affected groups
+    load_date_filter = ''
+    if 'Lataus_pvm' in columns_to_group_by:
+        load_date_filter = 't."Lataus_pvm" IN (SELECT DISTINCT "Lataus_pvm" FROM "{staging}") AND'
+
+    total_replaced = 0
     total_merged = 0
-    
+
     with get_engine().connect() as connection:
         for table_name in table_names:
+            staging = staging_table_name(table_name)
+            if not check_table_exists(staging):
+                continue
+
             if not check_table_exists(table_name):
-                logger.error(f"Table {table_name} does not exist, skipping merging.")
+                logger.info(f"Table {table_name} does not exist, creating it from {staging}")
+                _, merged = finalize_tables([table_name], lookup_df, [staging])
+                total_merged += merged
                 continue
-                
-            # Get count before merging
-            count_before = get_amount_of_occurrences(table_name)
-        
-            # Create the groupby clause
-            groupby_columns = ', '.join([f'"{col}"' for col in columns_to_group_by])
-            
-            # Add all columns
-            agg_clauses = []
-            for col in columns_to_use_first_value:
-                agg_clauses.append(f'(ARRAY_AGG("{col}"))[1] as "{col}"')
-            for col in columns_to_aggregate:
-                agg_clauses.append(f'string_agg("{col}", \', \') FILTER (WHERE "{col}" IS NOT NULL AND "{col}" != \'nan\') as "{col}"')
-            for col in columns_to_sum:
-                agg_clauses.append(f'SUM("{col}") as "{col}"')
-            for col in columns_to_use_max:
-                agg_clauses.append(f'MAX("{col}") as "{col}"')
-            
-            # Include geometry and Yhdistetty
-            agg_clauses.append('ST_SetSRID((ARRAY_AGG(geometry))[1],4326)::geometry(GEOMETRY,4326) AS geometry')
-            agg_clauses.append('1 as "Yhdistetty"')
-                       
-            # Combine all aggregation clauses and build aggregation SQL
-            all_agg_columns = ', '.join(agg_clauses)
-            agg_sql = f'''
-                CREATE TABLE merged_{table_name} AS
-                SELECT 
-                    {groupby_columns},
-                    {all_agg_columns}
-                FROM "{table_name}"
-                GROUP BY {groupby_columns}
-            '''
 
-            # Execute the aggregations
-            connection.execute(text(agg_sql))
-            
+            # Tables finalized before the generated geometry columns existed get them once
+            added_columns = add_geometry_columns(connection, table_name)
+            if added_columns:
+                logger.info(f"Added columns {added_columns} to {table_name}")
             connection.execute(text(f'''
-                UPDATE merged_{table_name} 
-                SET "Yhdistetty" = array_length(string_to_array("Havainnon_tunniste", ', '), 1)
-                WHERE "Havainnon_tunniste" LIKE '%,%'
+                CREATE INDEX IF NOT EXISTS "idx_{table_name}_ids" ON "{table_name}" USING GIN (string_to_array("Havainnon_tunniste", ', '));
             '''))
+            if load_date_filter:
+                connection.execute(text(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_lataus" ON "{table_name}" ("Lataus_pvm")'))
+
+            # Remove earlier versions of the staged occurrences, also from merged rows. Rows left without
+            # occurrences are deleted.
+            replaced, *emptied_stats = connection.execute(text(f'''
+                WITH delta AS (
+                    SELECT array_agg("Havainnon_tunniste") {ids_filter} AS ids FROM "{staging}"
+                ),
+                remaining AS (
+                    SELECT t.tableoid AS table_id, t.ctid AS row_id,
+                           array_to_string(ARRAY(
+                               SELECT id FROM unnest(string_to_array(t."Havainnon_tunniste", ', ')) WITH ORDINALITY AS u(id, n)
+                               WHERE id <> ALL (delta.ids) ORDER BY n
+                           ), ', ') AS ids
+                    FROM "{table_name}" t, delta
+                    WHERE string_to_array(t."Havainnon_tunniste", ', ') && delta.ids
+                ),
+                updated AS (
+                    UPDATE "{table_name}" t
+                    SET "Havainnon_tunniste" = remaining.ids,
+                        "Yhdistetty" = array_length(string_to_array(remaining.ids, ', '), 1)
+                    FROM remaining
+                    WHERE t.tableoid = remaining.table_id AND t.ctid = remaining.row_id AND remaining.ids <> ''
+                    RETURNING 1
+                ),
+                emptied AS (
+                    DELETE FROM "{table_name}" t
+                    USING remaining
+                    WHERE t.tableoid = remaining.table_id AND t.ctid = remaining.row_id AND remaining.ids = ''
+                    RETURNING t.*
+                )
+                SELECT (SELECT COUNT(*) FROM updated) + (SELECT COUNT(*) FROM emptied), stats.*
+                FROM ({_stats_query('emptied', live_columns)}) stats
+            ''')).one()
+
+            if _is_partitioned(connection, table_name):
+                _ensure_year_partitions(connection, table_name, _source_years(connection, staging))
+
+            # Merge the affected groups again together with the staged occurrences
+            staged_count, rows_count, inserted_count, *merge_stats = connection.execute(text(f'''
+                WITH removed AS (
+                    DELETE FROM "{table_name}" t
+                    WHERE {load_date_filter.format(staging=staging)}
+                          {group_key('t')} IN (SELECT {group_key('s')} FROM "{staging}" s)
+                    RETURNING {', '.join(f't."{col}"' for col in columns_to_group_by + aggregated_columns)}
+                ),
+                merge_rows AS (
+                    SELECT {source_columns} FROM removed
+                    UNION ALL
+                    SELECT {source_columns} FROM "{staging}"
+                ),
+                inserted AS (
+                    INSERT INTO "{table_name}" ({target_columns})
+                    SELECT
+                        {groupby_columns},
+                        {', '.join(agg_clauses)},
+                        COALESCE(array_length(string_to_array(string_agg("Havainnon_tunniste", ', ') {ids_filter}, ', '), 1), 1)
+                    FROM merge_rows
+                    GROUP BY {groupby_columns}
+                    RETURNING *
+                )
+                SELECT (SELECT COUNT(*) FROM "{staging}"), (SELECT COUNT(*) FROM merge_rows), (SELECT COUNT(*) FROM inserted),
+                       added.*, removed_stats.*
+                FROM ({_stats_query('inserted', live_columns)}) added, ({_stats_query('removed', live_columns)}) removed_stats
+            ''')).one()
+
+            # Update the statistics with the changed rows, or from the whole table if they don't exist yet
+            current = connection.execute(text(f'''
+                SELECT min_x, min_y, max_x, max_y, min_date, max_date, occurrences, quality
+                FROM "{COLLECTION_STATS_TABLE}" WHERE table_name = :table_name FOR UPDATE
+            '''), {"table_name": table_name}).fetchone()
+            if current is None:
+                update_collection_stats(connection, table_name, live_columns)
+            else:
+                stats = _combine_collection_stats(tuple(current), tuple(merge_stats[:8]), [tuple(emptied_stats), tuple(merge_stats[8:])])
+                _write_collection_stats(connection, table_name, stats)
 
+            connection.execute(text(f'DROP TABLE "{staging}"'))
             connection.commit()
-            
-            # Replace the original table with merged data
-            drop_table([table_name])
-            connection.execute(text(f'ALTER TABLE merged_{table_name} RENAME TO "{table_name}"'))
-            connection.commit()
-                        
-            # Get count after merging
-            count_after = get_amount_of_occurrences(table_name)
-            merged_count = count_before - count_after
-            total_merged += merged_count
-                
-    return total_merged
+
+            logger.info(f"Applied {staged_count} staged rows to {table_name}: {replaced} rows had earlier versions, {rows_count - inserted_count} occurrences merged")
+            total_replaced += replaced
+            total_merged += rows_count - inserted_count
+
+    return total_replaced, total_merged
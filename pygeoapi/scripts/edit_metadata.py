@@ -35,11 +35,20 @@ def create_metadata(template_resource, metadata_db_path, pygeoapi_config_out):
     
     table_names = edit_db.get_all_tables()
     table_names.sort()
+    # Statistics stored by the ingest, so that the tables need not be scanned
+    collection_stats = edit_db.get_collection_stats()
     for idx, table_name in enumerate(table_names):
-        bbox = edit_db.get_table_bbox(table_name)
-        min_date, max_date = edit_db.get_table_dates(table_name)
-        no_of_occurrences = edit_db.get_amount_of_occurrences(table_name)
-        quality_dict = edit_db.get_quality_frequency(table_name)
+        table_stats = collection_stats.get(table_name)
+        if table_stats:
+            bbox = table_stats["bbox"]
+            min_date, max_date = table_stats["min_date"], table_stats["max_date"]
+            no_of_occurrences = table_stats["occurrences"]
+            quality_dict = table_stats["quality_dict"]
+        else:
+            bbox = edit_db.get_table_bbox(table_name)
+            min_date, max_date = edit_db.get_table_dates(table_name)
+            no_of_occurrences = edit_db.get_amount_of_occurrences(table_name)
+            quality_dict = edit_db.get_quality_frequency(table_name)
         title_name = compute_variables.get_title_name_from_table_name(table_name)
 
         if no_of_occurrences == 0:
@@ -85,6 +94,33 @@ def create_metadata(template_resource, metadata_db_path, pygeoapi_config_out):
         edit_config.add_to_pygeoapi_config(template_resource, template_params, pygeoapi_config_out)
         add_JSON_metadata_to_DB(metadata_dict, metadata_db_path)
 
+def add_grid_collections(template_resource, pygeoapi_config_out):
+    """
+    Adds the grid aggregation tables to the PyGeoAPI configuration as collections.
+
+    Parameters:
+    - template_resource (str): A template file for the grid collections with placeholders for dynamic values.
+    - pygeoapi_config_out (str): Output path for the PyGeoAPI configuration file.
+    """
+    load_dotenv()
+    for table_name in edit_db.get_grid_tables():
+        no_of_cells = edit_db.get_amount_of_occurrences(table_name)
+        if no_of_cells == 0:
+            continue
+
+        cell_size_km = edit_db.GRID_TABLES[table_name] // 1000
+        template_params = {
+            "<placeholder_table_name>": table_name,
+            "<placeholder_cell_size>": str(cell_size_km),
+            "<placeholder_amount_of_cells>": str(no_of_cells),
+            "<placeholder_bbox>": str(edit_db.get_table_bbox(table_name)),
+            "<placeholder_postgres_host>": os.getenv('POSTGRES_HOST'),
+            "<placeholder_postgres_password>": os.getenv('POSTGRES_PASSWORD'),
+            "<placeholder_postgres_user>": os.getenv('POSTGRES_USER'),
+            "<placeholder_db_name>": os.getenv('POSTGRES_DB')
+        }
+        edit_config.add_to_pygeoapi_config(template_resource, template_params, pygeoapi_config_out)
+
 def add_JSON_metadata_to_DB(metadata_dict, metadata_db_path):
     """
     Creates a JSON metadata record and inserts it into a TinyDB database.
@@ -1,10 +1,22 @@
 # Caching utility for essential data
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+from shapely.geometry import shape
+import json
+import datetime
 import requests, concurrent.futures
+from requests.adapters import HTTPAdapter
 import time
 import logging
 import functools
+import threading
+import os
+import struct
+import hashlib
+import tempfile
+import zlib
+from scripts.rate_controller import AdaptiveRateController
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +27,28 @@ _cache = {}
 _cache_timeout = 86400  # 1 day in seconds
 _cache_timestamps = {}
 
+# Persistent cache of the API helper data, shared by all processes of the same user on the same host.
+# The directory is private to the user, and files owned by others are never read.
+DEFAULT_HELPER_CACHE_PATH = os.path.join(tempfile.gettempdir(), f'laji-pygeoapi-{os.getuid()}', 'helper-cache.json.z')
+_HELPER_CACHE_MAGIC = b'LAJIHELP'
+_HELPER_CACHE_VERSION = 2  # zlib compressed JSON
+_HELPER_CACHE_HEADER = struct.Struct('>8sHd32s')  # magic, format version, creation time, sha256 of the payload
+
+# Maximum time in seconds to wait for the helper datasets fetched at startup
+DEFAULT_HELPER_FETCH_TIMEOUT = 900
+
+# Shared HTTP session so that page downloads reuse keep-alive connections
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+# Shared by all threads so that every warehouse call counts towards the same concurrency limit and retry budget
+rate_controller = AdaptiveRateController(max_concurrency=DEFAULT_MAX_CONCURRENT_REQUESTS)
+
+_json_decoder = json.JSONDecoder()
+_JSON_WHITESPACE = ' \t\n\r'
+
 def _is_cache_valid(key):
     """Check if cached data is still valid"""
     if key not in _cache_timestamps:
@@ -28,38 +62,208 @@ def _get_api_headers(access_token):
         'Api-Version': '1'
     }
 
-def load_or_update_cache(config):
+def _get_session(pool_size=DEFAULT_MAX_CONCURRENT_REQUESTS):
+    """
+    Return a shared requests session whose connection pool can keep at least pool_size connections alive.
+    """
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _session_pool_size:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pool_size = pool_size
+        return _session
+
+def _encode_helper_data(api_data):
+    """Converts the cached API data (municipality ids, taxon DataFrame, collection names, value ranges) to JSON compatible types."""
+    municipals_ids, taxon_df, collection_names, all_value_ranges = api_data
+    return [municipals_ids, taxon_df.to_dict(orient='split'), collection_names, all_value_ranges]
+
+def _decode_helper_data(data):
+    """Inverse of _encode_helper_data."""
+    municipals_ids, taxon_split, collection_names, all_value_ranges = data
+    return municipals_ids, pd.DataFrame(**taxon_split), collection_names, all_value_ranges
+
+def _read_helper_cache_file(path, laji_api_url):
+    """
+    Reads the helper data fetched from the API from the on-disk cache.
+
+    Parameters:
+    path (str): Path of the cache file.
+    laji_api_url (str): The API the data must have been fetched from.
+
+    Returns:
+    tuple: The cached API data and its creation time, or None if the file is missing, not owned by the current user, expired, corrupted or from another API or format version.
+    """
+    try:
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_uid != os.getuid():
+                logger.warning(f"Helper data cache {path} is not owned by the current user, ignoring it")
+                return None
+            blob = file.read()
+    except OSError:
+        return None
+
+    if len(blob) < _HELPER_CACHE_HEADER.size:
+        return None
+    magic, version, created, digest = _HELPER_CACHE_HEADER.unpack_from(blob)
+    payload = blob[_HELPER_CACHE_HEADER.size:]
+    if magic != _HELPER_CACHE_MAGIC or version != _HELPER_CACHE_VERSION:
+        return None
+    if time.time() - created >= _cache_timeout:
+        logger.debug(f"Helper data cache {path} has expired")
+        return None
+    if hashlib.sha256(payload).digest() != digest:
+        logger.warning(f"Helper data cache {path} is corrupted, ignoring it")
+        return None
+
+    try:
+        data = json.loads(zlib.decompress(payload))
+        if data.get('laji_api_url') != laji_api_url:
+            return None
+        return _decode_helper_data(data['api_data']), created
+    except Exception as e:
+        logger.warning(f"Could not read helper data cache {path}: {e}")
+        return None
+
+def _write_helper_cache_file(path, laji_api_url, api_data):
+    """
+    Writes the helper data fetched from the API to the on-disk cache. The file is replaced atomically,
+    so other processes never read a partially written cache. The directory of the file is created
+    readable by the current user only, and the file is not written to a directory owned by someone else.
+
+    Parameters:
+    path (str): Path of the cache file.
+    laji_api_url (str): The API the data was fetched from.
+    api_data (tuple): The data to cache.
+    """
+    try:
+        payload = zlib.compress(json.dumps({'laji_api_url': laji_api_url, 'api_data': _encode_helper_data(api_data)}).encode('utf-8'))
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Could not serialize helper data for the cache: {e}")
+        return
+    header = _HELPER_CACHE_HEADER.pack(_HELPER_CACHE_MAGIC, _HELPER_CACHE_VERSION, time.time(), hashlib.sha256(payload).digest())
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.stat(directory).st_uid != os.getuid():
+            logger.warning(f"Helper data cache directory {directory} is not owned by the current user, not writing the cache")
+            return
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(header + payload)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write helper data cache {path}: {e}")
+
+def fetch_helper_data(base_url, headers, timeout=DEFAULT_HELPER_FETCH_TIMEOUT):
+    """
+    Fetches the helper datasets from the API concurrently, so that the total time is that of the slowest endpoint.
+
+    A source that fails or does not finish within the timeout is reported and replaced with an empty value.
+    Value ranges and enumerations are required to process occurrences, so their failure raises an error.
+
+    Parameters:
+    base_url (str): The base URL of the API.
+    headers (dict): Headers for the requests.
+    timeout (float): Maximum time in seconds to wait for each source.
+
+    Returns:
+    dict: The data of each source (municipality_ids, taxon_data, collection_names, value_ranges, enumerations).
+    """
+    sources = {
+        'municipality_ids': (get_municipality_ids, f"{base_url}areas", {'areaType': 'ML.municipality', 'lang': 'fi', 'pageSize': 1000}, {}),
+        'taxon_data': (get_taxon_data, f"{base_url}informal-taxon-groups", {'lang': 'fi', 'pageSize': 1000}, pd.DataFrame()),
+        'collection_names': (get_collection_names, f"{base_url}collections", {'selected': 'id', 'lang': 'fi', 'pageSize': 1500, 'langFallback': 'true'}, {}),
+        'value_ranges': (get_value_ranges, f"{base_url}metadata/alts", {'lang': 'fi'}, None),
+        'enumerations': (get_enumerations, f"{base_url}warehouse/enumeration-labels", {}, None),
+    }
+
+    # The pool is not used as a context manager: a timed out request keeps running in its thread,
+    # but the caller should not wait for it.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="helper-data")
+    start = time.monotonic()
+    futures = {name: executor.submit(func, url, params, headers) for name, (func, url, params, _) in sources.items()}
+    executor.shutdown(wait=False)
+
+    results = {}
+    failures = {}
+    for name, future in futures.items():
+        try:
+            # Sources run concurrently, so each timeout is counted from the common start
+            result = future.result(timeout=max(0, timeout - (time.monotonic() - start)))
+            if result is None or len(result) == 0:
+                failures[name] = "no data received"
+            else:
+                results[name] = result
+        except concurrent.futures.TimeoutError:
+            failures[name] = f"timed out after {timeout} seconds"
+        except Exception as e:
+            failures[name] = str(e)
+
+    for name, reason in failures.items():
+        logger.error(f"Failed to fetch helper data '{name}' from {sources[name][1]}: {reason}")
+    logger.info(f"Fetched {len(results)}/{len(sources)} helper datasets in {time.monotonic() - start:.1f} seconds")
+
+    required = [name for name in failures if sources[name][3] is None]
+    if required:
+        raise ValueError(f"Error getting required helper data: {', '.join(required)}")
+
+    for name in failures:
+        results[name] = sources[name][3]
+    return results
+
+def load_or_update_cache(config, force_refresh=False):
     """
     Loads essential data (municipality_ely_mappings, municipals_ids, lookup_df, taxon_df, collection_names, all_value_ranges, municipality_elinvoima_mappings) from the cache or the API.
+
+    Data fetched from the API is cached in memory and in a file (config['helper_cache_path']) that other processes
+    can read, so it is fetched again only when the cache is older than one day or force_refresh is True.
+    The local resource files are always read from disk.
     """
     cache_key = f"helper_data_{config.get('laji_api_url', '')}"
     
     # Check if we have valid cached data
-    if cache_key in _cache and _is_cache_valid(cache_key):
+    if not force_refresh and cache_key in _cache and _is_cache_valid(cache_key):
         logger.debug("Using cached helper data")
         return _cache[cache_key]
 
-    logger.debug("Fetching data from API")
     base_url = config['laji_api_url']
-    headers = _get_api_headers(config['access_token'])
+    cache_path = config.get('helper_cache_path', DEFAULT_HELPER_CACHE_PATH)
 
     municipality_df = pd.read_json('scripts/resources/municipality_ely_mappings.json').set_index('Municipal_Name')
     municipality_ely_mappings = municipality_df['ELY_Area_Name']
     municipality_elinvoima_mappings = municipality_df['Elinvoimakeskus_Name']
-
-    municipals_ids = get_municipality_ids(f"{base_url}areas", {'areaType': 'ML.municipality', 'lang': 'fi', 'pageSize': 1000}, headers)
     lookup_df = pd.read_csv('scripts/resources/lookup_table_columns.csv', sep=';', header=0)
-    taxon_df = get_taxon_data(f"{base_url}informal-taxon-groups", {'lang': 'fi', 'pageSize': 1000}, headers)
-    collection_names = get_collection_names(f"{base_url}collections", {'selected': 'id', 'lang': 'fi', 'pageSize': 1500, 'langFallback': 'true'}, headers)
-    ranges1 = get_value_ranges(f"{base_url}metadata/alts", {'lang': 'fi'}, headers)
-    ranges2 = get_enumerations(f"{base_url}warehouse/enumeration-labels", {}, headers)
-    all_value_ranges = ranges1 | ranges2  # type: ignore
+
+    cached = None if force_refresh or not cache_path else _read_helper_cache_file(cache_path, base_url)
+    if cached:
+        logger.debug(f"Using helper data from {cache_path}")
+        (municipals_ids, taxon_df, collection_names, all_value_ranges), created = cached
+    else:
+        logger.debug("Fetching data from API")
+        headers = _get_api_headers(config['access_token'])
+        helper_data = fetch_helper_data(base_url, headers, config.get('helper_fetch_timeout', DEFAULT_HELPER_FETCH_TIMEOUT))
+
+        municipals_ids = helper_data['municipality_ids']
+        taxon_df = helper_data['taxon_data']
+        collection_names = helper_data['collection_names']
+        all_value_ranges = helper_data['value_ranges'] | helper_data['enumerations']
+        created = time.time()
+
+        # Incomplete data (e.g. after failed requests) is not persisted, so that the next process tries again
+        if cache_path and municipals_ids and not taxon_df.empty and collection_names:
+            _write_helper_cache_file(cache_path, base_url, (municipals_ids, taxon_df, collection_names, all_value_ranges))
 
     result = municipality_ely_mappings, municipals_ids, lookup_df, taxon_df, collection_names, all_value_ranges, municipality_elinvoima_mappings
 
     # Cache the result
     _cache[cache_key] = result
-    _cache_timestamps[cache_key] = time.time()
+    _cache_timestamps[cache_key] = created
 
     return result
 
@@ -91,31 +295,62 @@ def get_filter_values(filter_name, access_token, base_url=None):
     logger.error(f"Failed to retrieve values for {filter_name}")
     return {}
 
-def fetch_json_with_retry(url, params=None, headers=None, max_retries=5, delay=30):
+def _get_retry_after(exception):
+    """Return the Retry-After header of a failed response in seconds, if the upstream sent one."""
+    response = getattr(exception, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if isinstance(value, str) and value.isdigit():
+        return float(value)
+    return None
+
+def fetch_json_with_retry(url, params=None, headers=None, max_retries=5, delay=30, session=None, decoder=None):
     """
-    Fetches JSON data from an API URL with retry logic.
+    Fetches JSON data from an API URL with retry logic. Requests go through the shared rate controller, which
+    limits the number of concurrent requests, backs off exponentially with jitter and caps the total number of retries.
     
     Parameters:
     url (str): The base API URL to fetch JSON data from.
     params (dict): Query parameters to include in the request.
     headers (dict): Headers to include in the request.
-    max_retries (int): The maximum number of retry attempts in case of failure.
-    delay (int): The delay between retries in seconds.
+    max_retries (int): The maximum number of attempts in case of failure.
+    delay (int): The base delay for the exponential backoff between retries in seconds.
+    session (requests.Session, optional): Session to send the request with. Defaults to a new connection per request.
+    decoder (callable, optional): Function that parses the response text instead of response.json(). It should raise ValueError for malformed responses.
     
     Returns:
-    dict: Parsed JSON data from the API as a dictionary, or None if the request fails.
+    dict: Parsed JSON data from the API as a dictionary (or the decoder's result), or None if the request fails.
     """
+    get = session.get if session is not None else requests.get
     attempt = 0
     while attempt < max_retries:
+        rate_controller.acquire()
+        start = time.monotonic()
+        status_code = None
+        failed = True
         try:
-            response = requests.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching data from {url}: {e}. Retrying in {delay} seconds...")
-            time.sleep(delay)
+            try:
+                response = get(url, params=params, headers=headers)
+                status_code = response.status_code
+                response.raise_for_status()
+                result = decoder(response.text) if decoder is not None else response.json()
+                failed = False
+            finally:
+                # The permit is returned also when an unexpected exception propagates
+                rate_controller.release(time.monotonic() - start, status_code, failed=failed)
+            return result
+        except (requests.exceptions.RequestException, ValueError) as e:
             attempt += 1
-    logger.error(f"Failed to retrieve data from {url} after {max_retries} attempts.")
+            if attempt >= max_retries:
+                break
+            if not rate_controller.allow_retry():
+                logger.error(f"Error fetching data from {url}: {e}. Retry budget exhausted, not retrying.")
+                break
+            wait = rate_controller.backoff_delay(attempt, delay, _get_retry_after(e))
+            logger.error(f"Error fetching data from {url}: {e}. Retrying in {wait:.0f} seconds...")
+            time.sleep(wait)
+    logger.error(f"Failed to retrieve data from {url} after {attempt} attempts.")
     return None
 
 def get_collection_names(url, params, headers):
@@ -166,42 +401,184 @@ def get_last_page(url, params, headers, page_size, max_retries=5, delay=60):
     Returns:
     int: The last page number. Returns None if all retries fail.
     """
+    total = get_count(url, params, headers, max_retries=max_retries, delay=delay)
+    if total is not None:
+        pages = -(-total // page_size)
+        logger.info(f"Total number of occurrences is {total} in {pages} pages")
+        return pages
+    else:
+        return None
+
+def get_count(url, params, headers, max_retries=5, delay=60):
+    """
+    Get the number of occurrences matching the query from the count endpoint.
+
+    Parameters:
+    url (str): The URL of the Warehouse API list endpoint.
+    params (dict): Query parameters for the request.
+    headers (dict): Headers for the request.
+
+    Returns:
+    int: The number of occurrences. Returns None if all retries fail.
+    """
     count_url = url.replace('/list/', '/count/')
     # Remove geoJSON parameters for count endpoint
     count_params = {k: v for k, v in params.items() if k not in ['geoJSON', 'featureType']}
-    
+
     api_response = fetch_json_with_retry(count_url, params=count_params, headers=headers, max_retries=max_retries, delay=delay)
     if api_response:
-        total = api_response.get('total')
-        pages = total // page_size
-        if total % page_size != 0:
-            pages += 1
-        logger.info(f"Total number of occurrences is {total} in {pages} pages")
-        return pages
-    else:
-        return None
+        return api_response.get('total')
+    return None
+
+def _parse_time_range(time_range):
+    """Parse a 'YYYY-MM-DD/YYYY-MM-DD' time filter into dates. An open end means today."""
+    start, _, end = time_range.partition('/')
+    start = datetime.date.fromisoformat(start)
+    end = datetime.date.fromisoformat(end) if end else datetime.date.today()
+    return start, end
 
-def download_page(url, params, headers, page_no):
+def get_time_windows(url, params, headers, page_size, max_pages):
     """
-    Download data from a specific page of the API with retry logic. This is in separate function to speed up multiprocessing.
+    Split the time range of a query into windows that each fit in at most max_pages pages.
+
+    The range in params['time'] is halved until the count endpoint reports few enough occurrences for each
+    half, so that every window can be fetched independently without deep page numbers. A single day is not
+    split further even if it has more occurrences.
+
+    Parameters:
+    url (str): The URL of the Warehouse API list endpoint.
+    params (dict): Query parameters for the request. params['time'] must be a 'YYYY-MM-DD/[YYYY-MM-DD]' range.
+    headers (dict): Headers for the request.
+    page_size (int): The number of items per page.
+    max_pages (int): The maximum number of pages in a window.
+
+    Returns:
+    list: Tuples of (time range, number of pages) in chronological order. Windows without occurrences are left out.
+    """
+    start, end = _parse_time_range(params['time'])
+    windows = []
+    ranges = [(start, end)]
+    while ranges:
+        window_start, window_end = ranges.pop()
+        time_range = f"{window_start.isoformat()}/{window_end.isoformat()}"
+        total = get_count(url, {**params, 'time': time_range}, headers)
+        if total is None:
+            raise ValueError(f"Error counting occurrences for time window {time_range}")
+        if total == 0:
+            continue
+        if total > max_pages * page_size and window_start < window_end:
+            middle = window_start + (window_end - window_start) // 2
+            # The later half is pushed first so that windows come out in chronological order
+            ranges.append((middle + datetime.timedelta(days=1), window_end))
+            ranges.append((window_start, middle))
+            continue
+        windows.append((time_range, -(-total // page_size)))
+
+    logger.info(f"Split {params['time']} into {len(windows)} time windows with {sum(pages for _, pages in windows)} pages in total")
+    return windows
+
+def _skip_json_whitespace(text, index):
+    while text[index] in _JSON_WHITESPACE:
+        index += 1
+    return index
+
+def decode_feature_collection(text, crs="EPSG:4326"):
+    """
+    Decode a GeoJSON FeatureCollection into a GeoDataFrame one feature at a time.
+
+    Unlike parsing the whole response with json.loads and calling GeoDataFrame.from_features, only one
+    feature dictionary is alive at a time: its properties are appended straight to per-column buffers
+    and its geometry is built directly from the decoded dictionary. This lowers the peak memory of a page
+    but is not faster. The response text itself is still held in memory whole.
+
+    Parameters:
+    text (str): The GeoJSON FeatureCollection as text.
+    crs (str): The coordinate reference system of the features.
+
+    Returns:
+    geopandas.GeoDataFrame: The features as a GeoDataFrame, or an empty GeoDataFrame if there are no features.
+
+    Raises:
+    ValueError: If the text is not a JSON object or ends unexpectedly.
+    """
+    decode = _json_decoder.raw_decode
+    columns = {}
+    geometries = []
+    n = 0
+
+    try:
+        i = _skip_json_whitespace(text, 0)
+        if text[i] != '{':
+            raise ValueError("GeoJSON response is not a JSON object")
+        i += 1
+        while True:
+            i = _skip_json_whitespace(text, i)
+            if text[i] == '}':
+                break
+            if text[i] == ',':
+                i += 1
+                continue
+            key, i = decode(text, i)
+            i = _skip_json_whitespace(text, i)
+            i = _skip_json_whitespace(text, i + 1)  # skip ':'
+            if key != 'features':
+                _, i = decode(text, i)
+                continue
+
+            # Walk the features array one feature at a time
+            i += 1  # skip '['
+            while True:
+                i = _skip_json_whitespace(text, i)
+                if text[i] == ']':
+                    i += 1
+                    break
+                if text[i] == ',':
+                    i += 1
+                    continue
+                feature, i = decode(text, i)
+                geometry = feature.get('geometry')
+                geometries.append(shape(geometry) if geometry else None)
+                for name, value in (feature.get('properties') or {}).items():
+                    column = columns.get(name)
+                    if column is None:
+                        column = columns[name] = [np.nan] * n
+                    column.append(value)
+                n += 1
+                # Properties the feature lacks are NaN, like in GeoDataFrame.from_features
+                for column in columns.values():
+                    if len(column) < n:
+                        column.append(np.nan)
+    except IndexError:
+        raise ValueError("GeoJSON response ended unexpectedly")
+
+    if n == 0:
+        return gpd.GeoDataFrame()
+
+    geometry = gpd.GeoSeries(geometries, crs=crs)
+    return gpd.GeoDataFrame(columns, geometry=geometry)
+
+def download_page(url, params, headers, page_no, session=None):
+    """
+    Download data from a specific page of the API with retry logic. This is in separate function so that pages can be downloaded concurrently.
 
     Parameters:
     url (str): The base URL of the Warehouse API endpoint.
     params (dict): Query parameters for the request.
     headers (dict): Headers for the request.
     page_no (int): The page number to download.
+    session (requests.Session, optional): Session with pooled keep-alive connections.
 
     Returns:
     geopandas.GeoDataFrame: The downloaded data as a GeoDataFrame.
     """
     page_params = params.copy()
     page_params['page'] = page_no
-    data = fetch_json_with_retry(url, params=page_params, headers=headers)
-    if data:
-        return gpd.GeoDataFrame.from_features(data["features"], crs="EPSG:4326")
+    gdf = fetch_json_with_retry(url, params=page_params, headers=headers, session=session, decoder=decode_feature_collection)
+    if gdf is not None:
+        return gdf
     return gpd.GeoDataFrame()
 
-def get_occurrence_data(url, params, headers, startpage, endpage, multiprocessing=False):
+def get_occurrence_data(url, params, headers, startpage, endpage, multiprocessing=False, max_workers=None):
     """
     Retrieve occurrence data from the API.
 
@@ -209,9 +586,10 @@ def get_occurrence_data(url, params, headers, startpage, endpage, multiprocessin
     url (str): The base URL of the Warehouse API endpoint.
     params (dict): Query parameters for the request.
     headers (dict): Headers for the request.
-    multiprocessing (bool, optional): Whether to use multiprocessing. Defaults to False.
+    multiprocessing (bool, optional): Whether to download pages concurrently. Defaults to False.
     startpage (int): First page to retrieve. 
     endpage (int): Last page to retrieve 
+    max_workers (int, optional): Upper bound for requests in flight; the rate controller adapts the actual number below it. Defaults to DEFAULT_MAX_CONCURRENT_REQUESTS.
 
     Returns:
     geopandas.GeoDataFrame: The retrieved occurrence data as a GeoDataFrame.
@@ -219,20 +597,24 @@ def get_occurrence_data(url, params, headers, startpage, endpage, multiprocessin
     """    
     failed_features_counter = 0
     gdfs = []
+    max_workers = max_workers or DEFAULT_MAX_CONCURRENT_REQUESTS
+    session = _get_session(max_workers)
+    rate_controller.set_max_concurrency(max_workers)
 
     if multiprocessing in [True, "True"]:
-        # Use multiprocessing to retrieve page by page. 
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            futures = [executor.submit(download_page, url, params, headers, page_no) for page_no in range(startpage, endpage + 1)]
+        # Downloading is I/O bound, so threads sharing one connection pool keep several requests in flight
+        # without the cost of spawning processes and pickling GeoDataFrames back to the parent.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download_page, url, params, headers, page_no, session) for page_no in range(startpage, endpage + 1)]
             for future in concurrent.futures.as_completed(futures):
                 result = future.result()
                 gdfs.append(result)
                 if result.empty:
                     failed_features_counter += 10000
     else:
-        # Retrieve data page by page without multiprocessing 
+        # Retrieve data page by page, still reusing the same keep-alive connection
         for page_no in range(startpage,endpage+1):
-            next_gdf = download_page(url, params, headers, page_no)
+            next_gdf = download_page(url, params, headers, page_no, session)
             gdfs.append(next_gdf)
             if next_gdf.empty:
                 failed_features_counter += 10000
@@ -5,7 +5,9 @@ import os
 import logging
 from scripts import load_data, process_data, edit_config, edit_configmaps, compute_variables, edit_db, edit_metadata, send_error_emails
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +21,20 @@ logging.basicConfig(
     format='%(asctime)s %(levelname)s %(message)s'
 )
 
-maintenance_executor = ThreadPoolExecutor(max_workers=1)
-maintenance_futures = []  # (future -> returns (duplicates_removed, merged_features))
+maintenance_executor = ThreadPoolExecutor(max_workers=int(os.getenv('MAINTENANCE_WORKERS', 2)), thread_name_prefix="maintenance")
+maintenance_futures = []  # (future -> returns (duplicates_removed, merged_features), table_base_name, staging_table_names)
+
+# Live tables of full-load datasets that loaded nothing, dropped when the new tables are published
+removed_tables = []
+
+MAINTENANCE_BATCH = 'maintenance'
+_PIPELINE_END = object()  # Marks that a pipeline stage has no more batches
+
+def batch_name(startpage, endpage, time_window=None):
+    """Name of a page range batch in the ingest checkpoints."""
+    if time_window:
+        return f'{time_window} pages {startpage}-{endpage}'
+    return f'pages {startpage}-{endpage}'
 
 def _parse_bool(val, default=False):
     if val is None:
@@ -38,8 +52,22 @@ def setup_environment():
     multiprocessing = _parse_bool(os.getenv('MULTIPROCESSING'), True)
     target = os.getenv('TARGET')
     batch_size = int(os.getenv('BATCH_SIZE', 5))
+    max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', load_data.DEFAULT_MAX_CONCURRENT_REQUESTS))
+    pipeline_queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', 1))
+    province_workers = int(os.getenv('PROVINCE_WORKERS', 3))
+    harvest_mode = os.getenv('HARVEST_MODE', 'pages').lower()
+    index_workers = int(os.getenv('INDEX_WORKERS', edit_db.DEFAULT_INDEX_WORKERS))
+    maintenance_work_mem = os.getenv('MAINTENANCE_WORK_MEM')
+    window_pages = int(os.getenv('HARVEST_WINDOW_PAGES', batch_size))
     run_in_openshift = _parse_bool(os.getenv('RUNNING_IN_OPENSHIFT'), False)
     invasive_species = _parse_bool(os.getenv('INVASIVE_SPECIES'), True)
+    resume_ingest = _parse_bool(os.getenv('RESUME_INGEST'), True)
+    incremental_updates = _parse_bool(os.getenv('INCREMENTAL_UPDATES'), True)
+    partition_by_year = _parse_bool(os.getenv('PARTITION_BY_YEAR'), False)
+    grid_aggregation = _parse_bool(os.getenv('GRID_AGGREGATION'), True)
+    premerge_batches = _parse_bool(os.getenv('PREMERGE_BATCHES'), False)
+    helper_cache_path = os.getenv('HELPER_CACHE_PATH', load_data.DEFAULT_HELPER_CACHE_PATH)
+    helper_fetch_timeout = float(os.getenv('HELPER_FETCH_TIMEOUT', load_data.DEFAULT_HELPER_FETCH_TIMEOUT))
     biogeographical_province_ids = os.getenv('BIOGEOGRAPHICAL_PROVINCES')
     if biogeographical_province_ids:
         biogeographical_province_ids = biogeographical_province_ids.split(',')
@@ -67,14 +95,85 @@ def setup_environment():
         "metadata_db_path": metadata_db_path,
         "db_path_in_config": db_path_in_config,
         "batch_size": batch_size,
+        "max_concurrent_requests": max_concurrent_requests,
+        "pipeline_queue_size": pipeline_queue_size,
+        "province_workers": province_workers,
+        "harvest_mode": harvest_mode,
+        "index_workers": index_workers,
+        "maintenance_work_mem": maintenance_work_mem,
+        "window_pages": window_pages,
         "run_in_openshift": run_in_openshift,
         "invasive_species": invasive_species,
+        "resume_ingest": resume_ingest,
+        "incremental_updates": incremental_updates,
+        "partition_by_year": partition_by_year,
+        "grid_aggregation": grid_aggregation,
+        "premerge_batches": premerge_batches,
+        "helper_cache_path": helper_cache_path,
+        "helper_fetch_timeout": helper_fetch_timeout,
         "biogeographical_province_ids": biogeographical_province_ids
     }
 
-def load_and_process_data(occurrence_url, params, headers, table_base_name, pages, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables=False):
+def _put_until_stopped(q, item, stop):
+    """Put item to a bounded queue, waiting while it is full unless the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get_until_stopped(q, stop):
+    """Get the next item from a queue, or the end marker if the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            continue
+    return _PIPELINE_END
+
+def transform_batch(gdf, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df):
+    """
+    Transform downloaded occurrences to the database schema.
+
+    Returns:
+    tuple: The transformed GeoDataFrame, the number of fixed geometries and the number of converted geometry collections.
+    """
+    gdf = process_data.merge_taxonomy_data(gdf, taxon_df)
+    gdf = process_data.combine_similar_columns(gdf)
+    gdf = compute_variables.compute_all(gdf, all_value_ranges, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings)
+    gdf = process_data.translate_column_names(gdf, lookup_df, style='virva')
+    gdf, converted = process_data.convert_geometry_collection_to_multipolygon(gdf)
+    gdf, edited = process_data.validate_geometry(gdf)
+    return gdf, edited, converted
+
+def load_and_process_data(occurrence_url, params, headers, table_base_name, pages, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables=False, run_id=None, time_windows=None):
     """
     Load and process data in batches from the given URL.
+
+    Downloading, transforming and writing run as a pipeline: while batch N is transformed, batch N+1 is
+    downloaded and batch N-1 is written to PostGIS. The stages are connected with bounded queues
+    (PIPELINE_QUEUE_SIZE batches each), so a fast stage waits for a slow one and memory use stays bounded.
+
+    If run_id is given, batches completed by an earlier attempt of the same ingest run are skipped
+    and every newly completed batch is checkpointed to the database.
+
+    With drop_tables, occurrences are written to UNLOGGED staging tables, which the maintenance job deduplicates
+    and merges into new, indexed tables in the shadow schema with edit_db.finalize_tables. main() publishes them
+    all at once when every dataset is done, so the old tables are served until then.
+    If config["incremental"] is set, occurrences are upserted to staging tables and the maintenance job applies
+    them to the live tables with edit_db.apply_staged_changes instead of rebuilding the tables.
+    Otherwise occurrences are appended to the live tables, which are finalized in place.
+
+    Duplicates by Havainnon_tunniste within and across the batches of this call are dropped before writing,
+    keeping the latest version by Lataus_pvm (see process_data.SeenOccurrences).
+    With config["premerge_batches"], the similar occurrences of every batch are merged before writing
+    (see process_data.premerge_occurrences), except with incremental updates. An occurrence folded into a
+    premerged row keeps the version it was folded in.
+
+    If time_windows (tuples of time range and number of pages, see load_data.get_time_windows) is given,
+    every window is paged separately with its own time filter instead of paging through the whole query.
     """
     processed_occurrences = 0
     failed_features_count = 0
@@ -83,53 +182,234 @@ def load_and_process_data(occurrence_url, params, headers, table_base_name, page
     converted_collections = 0
     merged_features_count = 0
     table_names = [f'{table_base_name}_points', f'{table_base_name}_lines', f'{table_base_name}_polygons']
-
-    if drop_tables:
-        edit_db.drop_table(table_names)
-
-    gdf = None
+    incremental = config.get("incremental", False)
+    staging_table_names = [edit_db.staging_table_name(table_name) for table_name in table_names]
+    use_staging = incremental or drop_tables
+    write_table_names = staging_table_names if use_staging else table_names
+    target_schema = edit_db.SHADOW_SCHEMA if drop_tables and not incremental else 'public'
+
+    completed_batches = edit_db.get_completed_batches(run_id, table_base_name) if run_id else set()
+    if completed_batches and drop_tables and not incremental and MAINTENANCE_BATCH not in completed_batches and not edit_db.has_rows(staging_table_names):
+        # UNLOGGED tables are emptied if the database crashes
+        logger.warning(f"Staging tables of {table_base_name} have been lost, loading all batches again")
+        completed_batches = set()
+    if completed_batches:
+        logger.info(f"Resuming {table_base_name}: {len(completed_batches)} batches already completed")
+
+    if use_staging and not completed_batches:
+        # Left over from an abandoned run
+        edit_db.drop_table(staging_table_names)
+        if target_schema != 'public':
+            edit_db.drop_table(table_names, schema=target_schema)
+
+    loaded_batches = False
     batch_size = config["batch_size"]
+    batches = []
+    for time_window, window_pages in time_windows or [(None, pages)]:
+        batch_params = {**params, 'time': time_window} if time_window else params
+        for startpage in range(1, window_pages + 1, batch_size):
+            endpage = min(startpage + batch_size - 1, window_pages)
+            name = batch_name(startpage, endpage, time_window)
+            if name in completed_batches:
+                logger.debug(f"Skipping {table_base_name} {name}, already loaded")
+                continue
+            batches.append((batch_params, startpage, endpage, name))
+
+    queue_size = config.get("pipeline_queue_size", 1)
+    downloaded = queue.Queue(maxsize=queue_size)
+    transformed = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def download_stage():
+        try:
+            for batch_params, startpage, endpage, name in batches:
+                logger.info(f"Loading {table_base_name} observations. {name.capitalize()} ({pages} in total)")
+                gdf, failed_features = load_data.get_occurrence_data(occurrence_url, batch_params, headers, startpage=startpage, endpage=endpage, multiprocessing=config["multiprocessing"], max_workers=config.get("max_concurrent_requests"))
+                if not _put_until_stopped(downloaded, (startpage, endpage, name, gdf, failed_features), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put_until_stopped(downloaded, _PIPELINE_END, stop)
+
+    def transform_stage():
+        try:
+            while True:
+                item = _get_until_stopped(downloaded, stop)
+                if item is _PIPELINE_END:
+                    break
+                startpage, endpage, name, gdf, failed_features = item
+                if gdf.empty:
+                    logger.warning(f"No occurrences found from {table_base_name}, skipping.")
+                    result = (startpage, endpage, name, None, failed_features, 0, 0)
+                else:
+                    logger.info(f"Processing {len(gdf)} observations...")
+                    gdf, edited, converted = transform_batch(gdf, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df)
+                    result = (startpage, endpage, name, gdf, failed_features, edited, converted)
+                if not _put_until_stopped(transformed, result, stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put_until_stopped(transformed, _PIPELINE_END, stop)
+
+    threads = [threading.Thread(target=download_stage, name=f"download-{table_base_name}", daemon=True),
+               threading.Thread(target=transform_stage, name=f"transform-{table_base_name}", daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    # Write stage runs in this thread. Duplicates of occurrences written by earlier batches are dropped here.
+    seen_occurrences = process_data.SeenOccurrences()
+    # Staged occurrences of incremental updates are matched to the live tables by their own IDs, so they are not premerged
+    premerge = config.get("premerge_batches", False) and not incremental
+    try:
+        while True:
+            item = _get_until_stopped(transformed, stop)
+            if item is _PIPELINE_END:
+                break
+            startpage, endpage, name, gdf, failed_features, edited, converted = item
+            failed_features_count += failed_features
+            if gdf is None:
+                continue
+            processed_occurrences += len(gdf)
+            gdf, dropped, superseding = seen_occurrences.filter(gdf)
+            duplicates_count_by_id += dropped
+            if premerge:
+                # Counted as merged by the maintenance job, which sums Yhdistetty. Newer versions of written
+                # occurrences stay on their own rows, so that finalize_tables can replace the older ones.
+                gdf, _ = process_data.premerge_occurrences(gdf, lookup_df, separate=superseding)
+                seen_occurrences.mark_folded(gdf)
+            if incremental:
+                failed_features_count += edit_db.upsert_to_db(gdf, write_table_names)
+            else:
+                failed_features_count += edit_db.to_db(gdf, write_table_names, unlogged=use_staging, partition_by_year=config.get("partition_by_year", False))
+            edited_features_count += edited
+            converted_collections += converted
+            loaded_batches = True
+            if run_id:
+                edit_db.mark_batch_completed(run_id, table_base_name, name, startpage, endpage)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
 
-    for startpage in range(1, pages + 1, batch_size):
-        endpage = min(startpage + batch_size - 1, pages)
-        logger.info(f"Loading {table_base_name} observations. Pages {startpage}-{endpage} ({pages} in total)")
-        
-        gdf, failed_features = load_data.get_occurrence_data(occurrence_url, params, headers, startpage=startpage, endpage=endpage, multiprocessing=config["multiprocessing"])
-        failed_features_count += failed_features
+    if errors:
+        raise errors[0]
 
-        if gdf.empty:
-            logger.warning(f"No occurrences found from {table_base_name}, skipping.")
-            continue
+    if drop_tables and not incremental and not (loaded_batches or completed_batches):
+        # Nothing to replace the old tables with. They are served until the run has succeeded.
+        logger.warning(f"No occurrences were loaded for {table_base_name}, its tables are removed when the new tables are published")
+        removed_tables.extend(table_names)
 
-        logger.info(f"Processing {len(gdf)} observations...")
-        processed_occurrences += len(gdf)
-        
-        gdf = process_data.merge_taxonomy_data(gdf, taxon_df)
-        gdf = process_data.combine_similar_columns(gdf)
-        gdf = compute_variables.compute_all(gdf, all_value_ranges, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings)
-        gdf = process_data.translate_column_names(gdf, lookup_df, style='virva')
-        gdf, converted = process_data.convert_geometry_collection_to_multipolygon(gdf)
-        gdf, edited = process_data.validate_geometry(gdf)
-        failed_features_count += edit_db.to_db(gdf, table_names)
-        edited_features_count += edited
-        converted_collections += converted
-
-    if gdf is not None and not gdf.empty:
+    needs_maintenance = (loaded_batches or completed_batches) and MAINTENANCE_BATCH not in completed_batches
+    if needs_maintenance:
         # Schedule maintenance work in background so next dataset can start downloading.
         def maintenance_job(tnames, lookup):
             try:
-                d = edit_db.remove_duplicates(tnames)
-                m = edit_db.merge_similar_observations(tnames, lookup)
-                edit_db.update_indexes(tnames, use_multiprocessing=True)
+                if incremental:
+                    d, m = edit_db.apply_staged_changes(tnames, lookup)
+                else:
+                    d, m = edit_db.finalize_tables(tnames, lookup, write_table_names, schema=target_schema, partition_by_year=config.get("partition_by_year", False))
+                edit_db.update_indexes(tnames, use_multiprocessing=True, schema=target_schema, max_workers=config.get("index_workers", edit_db.DEFAULT_INDEX_WORKERS), maintenance_work_mem=config.get("maintenance_work_mem"), lookup_df=lookup)
+                if run_id:
+                    edit_db.mark_batch_completed(run_id, table_base_name, MAINTENANCE_BATCH)
                 return d, m
             except Exception as e:
                 logger.error(f"Maintenance job failed for {tnames}: {e}")
-                return 0, 0
-        maintenance_futures.append(maintenance_executor.submit(maintenance_job, table_names, lookup_df))
+                raise
+        maintenance_futures.append((maintenance_executor.submit(maintenance_job, table_names, lookup_df), table_base_name, staging_table_names))
         logger.debug(f"Scheduled async maintenance for tables {table_names}")
 
     return processed_occurrences, failed_features_count, edited_features_count, duplicates_count_by_id, converted_collections, merged_features_count
 
+def wait_for_maintenance(run_id=None):
+    """
+    Waits for the scheduled maintenance jobs to finish.
+
+    If any job failed, the staging tables of the failed datasets are dropped and their batches are forgotten, so
+    that a resumed run loads them again, and an error is raised so that the new tables are not published.
+
+    Parameters:
+    run_id (int, optional): The id of the ingest run.
+
+    Returns:
+    tuple: Duplicates removed and features merged by the jobs.
+    """
+    duplicates_removed = 0
+    merged_features = 0
+    failed = []
+    if maintenance_futures:
+        logger.info("Waiting for background maintenance tasks to finish...")
+        for fut, table_base_name, staging_table_names in maintenance_futures:
+            try:
+                d, m = fut.result()
+                duplicates_removed += d
+                merged_features += m
+            except Exception as e:
+                logger.error(f"Maintenance of {table_base_name} failed: {e}")
+                failed.append((table_base_name, staging_table_names))
+        maintenance_executor.shutdown(wait=True)
+
+    for table_base_name, staging_table_names in failed:
+        edit_db.drop_table(staging_table_names)
+        if run_id:
+            edit_db.discard_completed_batches(run_id, table_base_name)
+    if failed:
+        raise RuntimeError(f"Maintenance failed for {', '.join(name for name, _ in failed)}, the new tables were not published")
+
+    return duplicates_removed, merged_features
+
+def load_datasets_in_parallel(datasets, base_url, headers, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables=False, run_id=None):
+    """
+    Load several datasets (biogeographical provinces or invasive species) at the same time.
+
+    The datasets are started from the largest to the smallest by their number of pages, so the longest
+    loads do not end up running alone at the end. The number of datasets loaded at once is set with
+    config["province_workers"].
+
+    With config["harvest_mode"] 'windows', every dataset is split into time windows of at most
+    config["window_pages"] pages, which are loaded separately, so no request needs a deep page number.
+
+    Parameters:
+    datasets (list): Tuples of (table_base_name, query parameters).
+
+    Returns:
+    tuple: The summed counters returned by load_and_process_data.
+    """
+    totals = [0, 0, 0, 0, 0, 0]
+    if not datasets:
+        return tuple(totals)
+
+    pages_by_dataset = {}
+    windows_by_dataset = {}
+    use_windows = config.get("harvest_mode") == "windows" and config["pages_env"] in ("all", "latest")
+    for table_base_name, params in datasets:
+        if use_windows:
+            windows = load_data.get_time_windows(base_url, params, headers, int(params['pageSize']), config["window_pages"])
+            windows_by_dataset[table_base_name] = windows
+            pages_by_dataset[table_base_name] = sum(pages for _, pages in windows)
+        else:
+            pages_by_dataset[table_base_name] = load_data.get_pages(config["pages_env"], base_url, params, headers, int(params['pageSize']))
+    datasets = sorted(datasets, key=lambda dataset: pages_by_dataset[dataset[0]], reverse=True)
+    logger.info("Loading order: " + ", ".join(f"{name} ({pages_by_dataset[name]} pages)" for name, _ in datasets))
+
+    with ThreadPoolExecutor(max_workers=config.get("province_workers", 1), thread_name_prefix="dataset") as executor:
+        futures = {
+            executor.submit(load_and_process_data, base_url, params, headers, table_base_name, pages_by_dataset[table_base_name], config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables, run_id, windows_by_dataset.get(table_base_name)): table_base_name
+            for table_base_name, params in datasets
+        }
+        for future in as_completed(futures):
+            results = future.result()
+            logger.info(f"Finished loading {futures[future]}")
+            totals = [total + result for total, result in zip(totals, results)]
+
+    return tuple(totals)
+
 def main():
     """
     Main function to load, process data, insert it into the database, and prepare the API configuration.
@@ -150,6 +430,7 @@ def main():
     last_update = edit_db.get_and_update_last_update()
     edit_config.clear_collections_from_config('pygeoapi-config.yml', config["pygeoapi_config_out"])
 
+    run_id = None
     if config['pages_env'] == '0':
         edit_db.drop_all_tables()
     else:
@@ -184,31 +465,35 @@ def main():
         # Add conditional parameters
         if config['pages_env'] == "latest" and last_update:
             common_params['loadedSameOrAfter'] = last_update
+            config['incremental'] = config['incremental_updates']
         elif config['pages_env'] == "all":
             drop_tables = True
             
         if config['target'] == 'virva':
             common_params['personEmail'] = config['access_email']
+
+        # Continue an interrupted run with its original parameters, or record a new one
+        if config['resume_ingest']:
+            run_id, run_params = edit_db.get_unfinished_ingest_run(config['pages_env'], config['target'])
+        if run_id:
+            logger.info(f"Resuming interrupted ingest run {run_id}...")
+            common_params = run_params['common_params']
+            config['batch_size'] = run_params['batch_size']
+        else:
+            run_params = {'common_params': common_params, 'batch_size': config['batch_size']}
+            run_id = edit_db.start_ingest_run(config['pages_env'], config['target'], run_params)
         
-        for province_id in config["biogeographical_province_ids"]:
-            table_base_name = compute_variables.get_biogeographical_region_from_id(province_id)
-            
+        # Shared objects are created before the datasets are loaded in parallel
+        edit_db.prepare_database(lookup_df)
+
+        # Collect the datasets to load. Each one writes to its own tables, so they can be loaded in parallel.
+        datasets = []
+        for province_id in config["biogeographical_province_ids"] or []:
             params = common_params.copy()
             params['biogeographicalProvinceId'] = province_id
-            
-            pages = load_data.get_pages(config["pages_env"], base_url, params, headers, int(params['pageSize']))
-            results = load_and_process_data(base_url, params, headers, table_base_name, pages, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables)
-
-            processed_occurrences += results[0]
-            failed_features_count += results[1]
-            edited_features_count += results[2]
-            duplicates_count_by_id += results[3]
-            converted_collections += results[4]
-            merged_features_count += results[5]
+            datasets.append((compute_variables.get_biogeographical_region_from_id(province_id), params))
 
         if config["invasive_species"]:
-            logger.info("Processing invasive species data...")
-            
             params = common_params.copy()
             params['invasive'] = 'true'
             # Remove parameters not needed for invasive species
@@ -217,34 +502,40 @@ def main():
             params.pop('coordinateAccuracyMax', None)
             params.pop('taxonAdminFiltersOperator', None)
             params.pop('collectionAndRecordQuality', None)
-            
-            pages = load_data.get_pages(config["pages_env"], base_url, params, headers, int(params['pageSize']))
-            results = load_and_process_data(base_url, params, headers, 'invasive_species', pages, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables)
+            datasets.append(('invasive_species', params))
 
-            processed_occurrences += results[0]
-            failed_features_count += results[1]
-            edited_features_count += results[2]
-            duplicates_count_by_id += results[3]
-            converted_collections += results[4]
-            merged_features_count += results[5]
+        results = load_datasets_in_parallel(datasets, base_url, headers, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_elinvoima_mappings, lookup_df, drop_tables, run_id)
+        processed_occurrences += results[0]
+        failed_features_count += results[1]
+        edited_features_count += results[2]
+        duplicates_count_by_id += results[3]
+        converted_collections += results[4]
+        merged_features_count += results[5]
 
         logger.info("Processing completed.")
 
     # Wait for any async maintenance still running and aggregate their results
-    if maintenance_futures:
-        logger.info("Waiting for background maintenance tasks to finish...")
-        for fut in maintenance_futures:
-            try:
-                d, m = fut.result()
-                duplicates_count_by_id += d
-                merged_features_count += m
-            except Exception as e:
-                logger.error(f"A maintenance task failed during final aggregation: {e}")
-        maintenance_executor.shutdown(wait=True)
+    duplicates_removed, merged_features = wait_for_maintenance(run_id)
+    duplicates_count_by_id += duplicates_removed
+    merged_features_count += merged_features
+
+    if drop_tables:
+        # Replace the served tables with the new ones in one transaction
+        edit_db.publish_shadow_tables(removed_tables=removed_tables)
+
+    if run_id:
+        edit_db.finish_ingest_run(run_id)
+
+    # Aggregate the occurrences of the provinces to grids for overview queries
+    if config['grid_aggregation'] and config['pages_env'] != '0':
+        logger.info("Building grid aggregation tables...")
+        province_tables = [table for table in edit_db.get_all_tables() if not table.startswith('invasive_species')]
+        edit_db.build_grid_tables(province_tables)
 
     # Create metadata for the processed data
     logger.info("Creating metadata...")
     edit_metadata.create_metadata("scripts/resources/template_resource.txt", config["metadata_db_path"], config["pygeoapi_config_out"])
+    edit_metadata.add_grid_collections("scripts/resources/template_grid_resource.txt", config["pygeoapi_config_out"])
 
     # Generate statistics for reporting
     total_occurrences = edit_db.get_amount_of_all_occurrences()
@@ -5,6 +5,171 @@ import re
 from shapely.geometry import Polygon, MultiPolygon, GeometryCollection, Point, LineString, MultiPoint, MultiLineString
 from shapely.ops import unary_union
 
+class SeenOccurrences:
+    """
+    Compact record of the occurrences written so far by one dataset, used to drop duplicates by Havainnon_tunniste
+    before they are written.
+
+    The IDs are kept as 64-bit hashes with the Lataus_pvm of the written version in sorted numpy arrays, with a flag
+    for the occurrences that were folded into a premerged row, 17 bytes per occurrence. A row is dropped if an
+    earlier batch already wrote the same or a newer version of the occurrence. A newer version is written, and the
+    older row is left for the DISTINCT ON of edit_db.finalize_tables or the staging upsert to remove. These match
+    rows by their own Havainnon_tunniste, so they can't remove a version folded into a premerged row (see
+    premerge_occurrences): a newer version of a folded occurrence is dropped instead and the folded version is
+    kept, and a newer version of an occurrence written on its own row must itself be written on its own row.
+    Hash collisions are possible but unlikely (about 1e-6 with 10 million occurrences).
+    """
+
+    def __init__(self):
+        self._ids = np.empty(0, dtype=np.uint64)
+        self._versions = np.empty(0, dtype=np.int64)
+        self._folded = np.empty(0, dtype=bool)
+
+    def __len__(self):
+        return len(self._ids)
+
+    @staticmethod
+    def _hash(ids):
+        return pd.util.hash_pandas_object(pd.Series(ids, dtype=object), index=False).to_numpy()
+
+    def _find(self, ids):
+        """Returns the positions of hashed IDs in the record and whether they were found."""
+        positions = np.searchsorted(self._ids, ids)
+        found = positions < len(self._ids)
+        found[found] = self._ids[positions[found]] == ids[found]
+        return positions, found
+
+    def filter(self, gdf):
+        """
+        Drops the duplicates of a batch, keeping the latest version of every occurrence, and the occurrences
+        that are already written in the same or a newer version or folded into a premerged row. Records the
+        kept occurrences as written.
+
+        Parameters:
+        gdf (geopandas.GeoDataFrame): A transformed batch of occurrences.
+
+        Returns:
+        gdf (geopandas.GeoDataFrame): The batch without duplicates.
+        dropped (int): Number of dropped rows.
+        superseding (numpy.ndarray): For every kept row, whether it is a newer version of an occurrence written
+                                     by an earlier batch. These rows must not be premerged.
+        """
+        if gdf.empty or 'Havainnon_tunniste' not in gdf.columns:
+            return gdf, 0, np.zeros(len(gdf), dtype=bool)
+
+        ids = self._hash(gdf['Havainnon_tunniste'])
+        if 'Lataus_pvm' in gdf.columns:
+            # NaT becomes the smallest int64, so that rows without a load date lose to dated ones
+            load_dates = pd.to_datetime(gdf['Lataus_pvm'], errors='coerce', utc=True)
+            versions = load_dates.to_numpy(dtype='datetime64[ns]').view(np.int64)
+        else:
+            versions = np.zeros(len(gdf), dtype=np.int64)
+
+        # Latest version of every occurrence in the batch, the last one when sorted by ID and version
+        order = np.lexsort((versions, ids))
+        sorted_ids = ids[order]
+        last = np.r_[sorted_ids[1:] != sorted_ids[:-1], True]
+        keep = np.zeros(len(gdf), dtype=bool)
+        keep[order[last]] = True
+
+        # Versions written by earlier batches. Folded versions can't be replaced, so they are kept.
+        positions, found = self._find(ids)
+        replaceable = np.ones(len(gdf), dtype=bool)
+        replaceable[found] = (versions[found] > self._versions[positions[found]]) & ~self._folded[positions[found]]
+        keep &= replaceable
+
+        self._add(ids[keep], versions[keep])
+        return gdf[keep], int(len(gdf) - keep.sum()), found[keep]
+
+    def mark_folded(self, gdf):
+        """
+        Records the occurrences of the premerged rows of a written batch (Yhdistetty > 1) as folded.
+
+        Parameters:
+        gdf (geopandas.GeoDataFrame): A batch returned by premerge_occurrences.
+        """
+        if gdf.empty or 'Yhdistetty' not in gdf.columns:
+            return
+        # premerge_occurrences joins the IDs of a merged row with ', '
+        merged_ids = gdf.loc[(gdf['Yhdistetty'] > 1).to_numpy(), 'Havainnon_tunniste'].dropna().str.split(', ').explode()
+        if merged_ids.empty:
+            return
+        positions, found = self._find(self._hash(merged_ids))
+        self._folded[positions[found]] = True
+
+    def _add(self, ids, versions):
+        ids = np.concatenate([self._ids, ids])
+        versions = np.concatenate([self._versions, versions])
+        folded = np.concatenate([self._folded, np.zeros(len(ids) - len(self._folded), dtype=bool)])
+        # Sorted by ID and version, so the last entry of an ID is its latest version
+        order = np.lexsort((versions, ids))
+        ids, versions, folded = ids[order], versions[order], folded[order]
+        last = np.r_[ids[1:] != ids[:-1], True]
+        self._ids, self._versions, self._folded = ids[last], versions[last], folded[last]
+
+def premerge_occurrences(gdf, lookup_df, separate=None):
+    """
+    Merges the similar occurrences of a batch with the merge_option rules of the lookup table, like
+    edit_db.finalize_tables does for the whole table: rows with the same GROUPBY columns become one row with
+    the FIRST value, the AGGREGATE values joined with ', ', and the SUM and MAX of the other columns, and the
+    geometry of the first row. Yhdistetty counts the merged occurrences (1 for rows that are not merged, also
+    when nothing in the batch is merged), so that the final merge in PostGIS only combines the partial groups of
+    different batches. Rows of different geometry types are not merged, as they
+    are written to different tables.
+
+    A merged row keeps only the joined IDs of its occurrences, so a later version of one of them can no longer
+    replace it by Havainnon_tunniste. SeenOccurrences.mark_folded records these occurrences so that their later
+    versions are dropped, and rows that replace an earlier written version are passed in separate.
+
+    Parameters:
+    gdf (geopandas.GeoDataFrame): A transformed batch of occurrences.
+    lookup_df (pandas.DataFrame): The lookup table with the 'virva' and 'merge_option' columns.
+    separate (numpy.ndarray, optional): Rows that are not merged with others.
+
+    Returns:
+    gdf (geopandas.GeoDataFrame): The merged batch.
+    merged_count (int): Number of occurrences merged into other rows.
+    """
+    options = lookup_df.dropna(subset=['merge_option'])
+    columns = {option: [col for col in options.loc[options['merge_option'] == option, 'virva'] if col in gdf.columns]
+               for option in ['GROUPBY', 'AGGREGATE', 'SUM', 'MAX']}
+    # Every batch gets Yhdistetty, also when nothing is merged, so that all batches of a table have the same columns
+    if 'Yhdistetty' in gdf.columns:
+        gdf = gdf.assign(Yhdistetty=gdf['Yhdistetty'].fillna(1).astype(int))
+    else:
+        gdf = gdf.assign(Yhdistetty=1)
+    if gdf.empty or not columns['GROUPBY']:
+        return gdf, 0
+
+    keys = [gdf[col] for col in columns['GROUPBY']] + [gdf.geometry.geom_type]
+    # Group numbers by position, so that the index of the batch need not be unique
+    groups = gdf.groupby(keys, dropna=False, sort=False).ngroup().to_numpy()
+    if separate is not None and separate.any():
+        groups[separate] = groups.max() + 1 + np.arange(separate.sum())
+    occurrences = pd.Series(gdf['Yhdistetty'].to_numpy()).groupby(groups).sum()
+    if len(occurrences) == len(gdf):
+        return gdf, 0
+
+    # The first row of every group holds the GROUPBY and FIRST values and the geometry
+    first_rows = ~pd.Series(groups).duplicated().to_numpy()
+    merged = gdf[first_rows].copy()
+    merged_groups = groups[first_rows]
+
+    for col in columns['AGGREGATE']:
+        values = gdf[col].to_numpy()
+        kept = pd.notna(values)
+        strings = pd.Series(values[kept]).astype(str)
+        not_nan = (strings != 'nan').to_numpy()
+        joined = strings[not_nan].groupby(groups[kept][not_nan], sort=False).agg(', '.join)
+        merged[col] = joined.reindex(merged_groups).to_numpy()
+    for col in columns['SUM']:
+        merged[col] = pd.Series(gdf[col].to_numpy()).groupby(groups).sum(min_count=1).reindex(merged_groups).to_numpy()
+    for col in columns['MAX']:
+        merged[col] = pd.Series(gdf[col].to_numpy()).groupby(groups).max().reindex(merged_groups).to_numpy()
+    merged['Yhdistetty'] = occurrences.reindex(merged_groups).astype(int).to_numpy()
+
+    return merged, int(len(gdf) - len(merged))
+
 def merge_taxonomy_data(occurrence_gdf, taxonomy_df):
     """
     Merge taxonomy information to the occurrence data.
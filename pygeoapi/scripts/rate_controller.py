@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class AdaptiveRateController:
+    """
+    Controls how many requests are sent to api.laji.fi at the same time and how long to wait before retrying.
+
+    The concurrency limit follows AIMD (additive increase, multiplicative decrease): every successful request
+    with a latency close to the recent average grows the limit by 1/limit (about +1 per round of requests),
+    while a throttled (429), failing (5xx) or unreachable upstream halves it. Retries wait an exponentially
+    growing, fully jittered delay and are limited by a retry budget shared by all threads, so that a struggling
+    upstream is not flooded with retries.
+    """
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, decrease_factor=0.5, latency_tolerance=2.0,
+                 retry_budget_ratio=0.2, min_retry_budget=20, max_delay=300):
+        """
+        Parameters:
+        max_concurrency (int): Upper bound for requests in flight.
+        min_concurrency (int): Lower bound for requests in flight.
+        decrease_factor (float): Multiplier applied to the limit when the upstream is overloaded.
+        latency_tolerance (float): A success slower than this many times the average latency does not grow the limit.
+        retry_budget_ratio (float): Share of all requests that may be retries.
+        min_retry_budget (int): Retries that are always allowed regardless of the ratio.
+        max_delay (float): Maximum backoff delay in seconds.
+        """
+        self._condition = threading.Condition()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.retry_budget_ratio = retry_budget_ratio
+        self.min_retry_budget = min_retry_budget
+        self.max_delay = max_delay
+        self.limit = float(max(min_concurrency, max_concurrency // 2))
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.average_latency = None
+        self._last_decrease = 0.0
+
+    def set_max_concurrency(self, max_concurrency):
+        """Changes the upper bound for requests in flight."""
+        with self._condition:
+            self.max_concurrency = max(self.min_concurrency, max_concurrency)
+            self.limit = min(self.limit, self.max_concurrency)
+            self._condition.notify_all()
+
+    def acquire(self):
+        """Blocks until a new request may be sent."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self.requests += 1
+
+    def release(self, latency, status_code=None, failed=False):
+        """
+        Records the outcome of a request started with acquire() and adjusts the concurrency limit.
+
+        Parameters:
+        latency (float): Duration of the request in seconds.
+        status_code (int, optional): HTTP status code of the response, None if no response was received.
+        failed (bool): Whether the request failed.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            overloaded = failed and (status_code is None or status_code in RETRYABLE_STATUS_CODES)
+            if overloaded:
+                # Decrease at most once per average request duration, as the requests already in flight
+                # were sent with the old limit and will likely fail as well.
+                now = time.monotonic()
+                if now - self._last_decrease >= (self.average_latency or 0):
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    logger.debug(f"Upstream overloaded (status {status_code}), concurrency limit lowered to {int(self.limit)}")
+            elif not failed:
+                if self.average_latency is None or latency <= self.average_latency * self.latency_tolerance:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.average_latency = latency if self.average_latency is None else 0.8 * self.average_latency + 0.2 * latency
+            self._condition.notify_all()
+
+    def allow_retry(self):
+        """
+        Takes one retry from the shared retry budget.
+
+        Returns:
+        bool: True if the retry may be made, False if the budget is exhausted.
+        """
+        with self._condition:
+            if self.retries >= self.min_retry_budget + self.retry_budget_ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+    def backoff_delay(self, attempt, base_delay, retry_after=None):
+        """
+        Returns the time to wait before a retry: a random delay between zero and base_delay * 2^(attempt - 1),
+        capped at max_delay. A Retry-After value given by the upstream is always respected.
+
+        Parameters:
+        attempt (int): Number of the failed attempt, starting from 1.
+        base_delay (float): Delay in seconds for the first retry.
+        retry_after (float, optional): Seconds requested by the upstream in a Retry-After header.
+
+        Returns:
+        float: Delay in seconds.
+        """
+        delay = random.uniform(0, min(self.max_delay, base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
@@ -9,4 +9,7 @@ cp /pygeoapi/catalogue.tinydb /pygeoapi/metadata_db.tinydb
 pygeoapi openapi generate ${PYGEOAPI_CONFIG} --output-file ${PYGEOAPI_OPENAPI}
 
 # create datatable tables
-flask --app src.app db upgrade
\ No newline at end of file
+flask --app src.app db upgrade
+
+# fetch helper data once so that the workers read it from the disk cache
+flask --app src.app refresh_helper_cache
\ No newline at end of file
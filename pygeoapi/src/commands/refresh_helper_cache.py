@@ -0,0 +1,13 @@
+import logging
+from src.app import app
+from scripts.main import setup_environment
+from scripts.load_data import load_or_update_cache
+
+logger = logging.getLogger(__name__)
+
+
+@app.cli.command('refresh_helper_cache')
+def refresh_helper_cache():
+    config = setup_environment()
+    load_or_update_cache(config, force_refresh=True)
+    logger.info('Helper data cache refreshed: %s', config['helper_cache_path'])
@@ -1,4 +1,5 @@
 import os
+from scripts import db_engine
 
 
 class Config(object):
@@ -7,12 +8,10 @@ class Config(object):
 
     RESTRICT_ACCESS = os.environ['RESTRICT_ACCESS'] == 'True'
 
-    SQLALCHEMY_DATABASE_URI = 'postgresql://{}:{}@{}:{}/{}'.format(
-        os.environ['POSTGRES_USER'],
-        os.environ['POSTGRES_PASSWORD'],
-        os.environ['POSTGRES_HOST'],
-        5432,
-        os.environ['POSTGRES_DB']
+    SQLALCHEMY_DATABASE_URI = db_engine.database_url()
+    SQLALCHEMY_ENGINE_OPTIONS = db_engine.engine_options(
+        'laji-pygeoapi-web',
+        statement_timeout=os.getenv('DB_STATEMENT_TIMEOUT', '60s')
     )
 
     LAJI_API_URL = os.environ['LAJI_API_URL']
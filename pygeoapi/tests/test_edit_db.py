@@ -3,6 +3,7 @@ import os
 import pytest
 from sqlalchemy import text, inspect
 from datetime import date
+import pandas as pd
 
 from scripts import edit_db
 
@@ -26,7 +27,9 @@ def set_env_vars():
 def engine():
     # Always get a fresh engine for each test
     edit_db._engine = None
-    return edit_db.get_engine()
+    engine = edit_db.get_engine()
+    edit_db.prepare_database()
+    return engine
 
 def create_test_table(engine, table_name, geom_type='POINT', extra_cols=''):
     with engine.connect() as conn:
@@ -62,6 +65,42 @@ def test_connect_to_db(engine):
         result = conn.execute(text("SELECT extname FROM pg_extension WHERE extname='postgis';")).fetchone()
         assert result is not None
 
+def test_ingest_checkpoints(engine):
+    with engine.connect() as conn:
+        conn.execute(text('DROP TABLE IF EXISTS ingest_checkpoints, ingest_runs;'))
+        conn.commit()
+
+    assert edit_db.get_unfinished_ingest_run('all', 'default') == (None, None)
+
+    run_params = {'common_params': {'pageSize': '10000'}, 'batch_size': 5}
+    run_id = edit_db.start_ingest_run('all', 'default', run_params)
+    edit_db.mark_batch_completed(run_id, 'uusimaa', 'pages 1-5', 1, 5)
+    edit_db.mark_batch_completed(run_id, 'uusimaa', 'pages 1-5', 1, 5)  # Idempotent
+    edit_db.mark_batch_completed(run_id, 'uusimaa', 'maintenance')
+
+    assert edit_db.get_unfinished_ingest_run('all', 'default') == (run_id, run_params)
+    assert edit_db.get_unfinished_ingest_run('latest', 'default') == (None, None)
+    assert edit_db.get_completed_batches(run_id, 'uusimaa') == {'pages 1-5', 'maintenance'}
+    assert edit_db.get_completed_batches(run_id, 'satakunta') == set()
+
+    edit_db.mark_batch_completed(run_id, 'satakunta', 'pages 1-5', 1, 5)
+    edit_db.discard_completed_batches(run_id, 'satakunta')
+    assert edit_db.get_completed_batches(run_id, 'satakunta') == set()
+    assert edit_db.get_completed_batches(run_id, 'uusimaa') == {'pages 1-5', 'maintenance'}
+
+    # Starting a run of another mode does not remove the unfinished run, but a new run of the same mode does
+    latest_run_id = edit_db.start_ingest_run('latest', 'default', run_params)
+    edit_db.mark_batch_completed(latest_run_id, 'uusimaa', 'pages 1-1', 1, 1)
+    assert edit_db.get_unfinished_ingest_run('all', 'default') == (run_id, run_params)
+    assert edit_db.get_completed_batches(run_id, 'uusimaa') == {'pages 1-5', 'maintenance'}
+    edit_db.start_ingest_run('latest', 'default', run_params)
+    assert edit_db.get_completed_batches(latest_run_id, 'uusimaa') == set()
+    assert edit_db.get_unfinished_ingest_run('latest', 'default')[0] != latest_run_id
+
+    edit_db.finish_ingest_run(run_id)
+    assert edit_db.get_unfinished_ingest_run('all', 'default') == (None, None)
+    assert 'ingest_runs' not in edit_db.get_all_tables()
+
 def test_get_and_update_last_update(engine):
     # Table should not exist at first
     with engine.connect() as conn:
@@ -230,6 +269,122 @@ def test_to_db(engine):
         assert count == 1
         drop_test_table(engine, t)
 
+def test_to_db_premerged_batches(engine):
+    import geopandas as gpd
+    from shapely.geometry import Point
+    from scripts import process_data
+    lookup_df = pd.DataFrame({'virva': ['Havainnon_tunniste', 'Kunta'], 'merge_option': ['AGGREGATE', 'GROUPBY']})
+    table_names = ['premerged_points', 'premerged_lines', 'premerged_polygons']
+    for t in table_names:
+        drop_test_table(engine, t)
+
+    # The first batch merges nothing and creates the table, the second one merges two occurrences
+    first = gpd.GeoDataFrame({'Havainnon_tunniste': ['a', 'b'], 'Kunta': ['A', 'B']}, geometry=[Point(1, 2), Point(3, 4)], crs='EPSG:4326')
+    second = gpd.GeoDataFrame({'Havainnon_tunniste': ['c', 'd'], 'Kunta': ['C', 'C']}, geometry=[Point(1, 2), Point(3, 4)], crs='EPSG:4326')
+    for batch in [first, second]:
+        batch, _ = process_data.premerge_occurrences(batch, lookup_df)
+        assert edit_db.to_db(batch, table_names) == 0
+
+    with engine.connect() as conn:
+        rows = conn.execute(text('SELECT "Havainnon_tunniste", "Yhdistetty" FROM "premerged_points" ORDER BY 1')).fetchall()
+    assert [tuple(row) for row in rows] == [('a', 1), ('b', 1), ('c, d', 2)]
+    for t in table_names:
+        drop_test_table(engine, t)
+
+def test_copy_to_postgis():
+    import geopandas as gpd
+    import pandas as pd
+    from unittest.mock import MagicMock
+    from shapely.geometry import Point
+    connection = MagicMock()
+    connection.execute.return_value.scalar.return_value = 'points'  # table exists
+    cursor = connection.connection.cursor.return_value.__enter__.return_value
+    gdf = gpd.GeoDataFrame({
+        'Kunta': ['a, "b"', ''],
+        'Yksilomaara_tulkittu': pd.array([1, None], dtype='Int64'),
+    }, geometry=[Point(1, 2), None], crs='EPSG:4326', index=pd.Index(['1', '2'], name='Paikallinen_tunniste'))
+
+    edit_db._copy_to_postgis(connection, gdf, 'points')
+
+    sql, buffer = cursor.copy_expert.call_args.args
+    assert sql.startswith('COPY "points" ("Paikallinen_tunniste", "Kunta", "Yksilomaara_tulkittu", "geometry") FROM STDIN')
+    rows = buffer.getvalue().splitlines()
+    # Geometries are sent as EWKB with SRID 4326, NULLs as \N and empty strings as empty values
+    assert rows[0] == '1,"a, ""b""",1,0101000020E6100000000000000000F03F0000000000000040'
+    assert rows[1] == '2,,\\N,\\N'
+
+def test_upsert_to_db(engine):
+    import geopandas as gpd
+    import pandas as pd
+    from shapely.geometry import Point
+    table_names = ['points_staging', 'lines_staging', 'polygons_staging']
+    for t in table_names:
+        drop_test_table(engine, t)
+    gdf = gpd.GeoDataFrame({
+        'Havainnon_tunniste': ['a', 'b'],
+        'Lataus_pvm': pd.to_datetime(['2024-01-01', '2024-01-01']),
+        'Kunta': ['A', 'B'],
+        'geometry': [Point(1, 2), Point(2, 3)]
+    }, geometry='geometry', crs='EPSG:4326')
+    assert edit_db.upsert_to_db(gdf, table_names) == 0
+
+    # A newer version replaces the staged row instead of adding another one
+    gdf = gdf.iloc[[0]].assign(Kunta='C', Lataus_pvm=pd.to_datetime(['2024-01-02']))
+    assert edit_db.upsert_to_db(gdf, table_names) == 0
+    assert edit_db.get_amount_of_occurrences('points_staging') == 2
+    with engine.connect() as conn:
+        kunta = conn.execute(text('''SELECT "Kunta" FROM points_staging WHERE "Havainnon_tunniste" = 'a' ''')).scalar()
+    assert kunta == 'C'
+    assert 'points_staging' not in edit_db.get_all_tables()
+    assert 'points_staging' in edit_db.get_all_tables(include_staging=True)
+    drop_test_table(engine, 'points_staging')
+
+def test_apply_staged_changes(engine):
+    import pandas as pd
+    drop_test_table(engine, 'live_table')
+    drop_test_table(engine, 'live_table_staging')
+    with engine.connect() as conn:
+        for table_name in ['live_table', 'live_table_staging']:
+            conn.execute(text(f'''
+                CREATE TABLE "{table_name}" (
+                    "Kunta" TEXT,
+                    "Havainnon_tunniste" TEXT,
+                    "Lataus_pvm" TIMESTAMP,
+                    geometry Geometry(GEOMETRY, 4326)
+                    {', "Yhdistetty" INTEGER' if table_name == 'live_table' else ''}
+                );
+            '''))
+        conn.execute(text('''
+            INSERT INTO "live_table" VALUES
+            ('city1', 'obs1, obs2', '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326), 2),
+            ('city2', 'obs3', '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326), 1),
+            ('city3', 'obs4', '2024-01-01', ST_GeomFromText('POINT(3 4)', 4326), 1);
+        '''))
+        # obs2 is updated (and moves to city3), obs5 is new
+        conn.execute(text('''
+            INSERT INTO "live_table_staging" VALUES
+            ('city3', 'obs2', '2024-01-01', ST_GeomFromText('POINT(3 4)', 4326)),
+            ('city3', 'obs5', '2024-01-01', ST_GeomFromText('POINT(3 4)', 4326));
+        '''))
+        conn.commit()
+
+    lookup_df = pd.DataFrame({
+        'virva': ['Kunta', 'Lataus_pvm', 'Havainnon_tunniste'],
+        'merge_option': ['GROUPBY', 'GROUPBY', 'AGGREGATE']
+    })
+    replaced, merged = edit_db.apply_staged_changes(['live_table'], lookup_df)
+    assert replaced == 1
+    assert merged == 2  # obs4, obs2 and obs5 merged into one row
+
+    with engine.connect() as conn:
+        rows = dict(conn.execute(text('''SELECT "Kunta", "Havainnon_tunniste" FROM "live_table"''')).fetchall())
+        yhdistetty = conn.execute(text('''SELECT "Yhdistetty" FROM "live_table" WHERE "Kunta" = 'city3' ''')).scalar()
+    assert rows['city1'] == 'obs1'
+    assert rows['city2'] == 'obs3'
+    assert sorted(rows['city3'].split(', ')) == ['obs2', 'obs4', 'obs5']
+    assert yhdistetty == 3
+    assert not edit_db.check_table_exists('live_table_staging')
+    drop_test_table(engine, 'live_table')
 
 def test_update_single_table_indexes(engine):
     drop_test_table(engine, 'idx_table')
@@ -259,96 +414,361 @@ def test_update_indexes(engine):
     drop_test_table(engine, 'idx1')
     drop_test_table(engine, 'idx2')
 
-def test_remove_duplicates(engine):
-    drop_test_table(engine, 'dup_table')
+def test_update_indexes_parallel():
+    from unittest.mock import MagicMock, patch
+    mock_engine = MagicMock()
+    connection = mock_engine.connect.return_value.__enter__.return_value
+    with patch.object(edit_db, 'get_engine', return_value=mock_engine):
+        timings = edit_db.update_indexes(['t1', 't2'], use_multiprocessing=True, max_workers=2, maintenance_work_mem='1GB')
+
+    # Every index is built on its own connection and timed, and the tables are analyzed
+    assert sorted(timings) == ['idx_t1_Kunta', 'idx_t1_geom', 'idx_t1_geom_3067', 'idx_t2_Kunta', 'idx_t2_geom', 'idx_t2_geom_3067']
+    assert mock_engine.connect.call_count == 8
+    statements = [str(c.args[0]) for c in connection.execute.call_args_list]
+    assert statements.count("SELECT set_config('maintenance_work_mem', :value, true)") == 6
+    assert 'ANALYZE "public"."t1"' in statements
+    assert 'ANALYZE "public"."t2"' in statements
+
+def test_index_plan_adds_projected_geometry_index():
+    # A gist index of the geometry brings one of the EPSG:3067 geometry
+    assert edit_db.get_index_plan() == [('Kunta', 'btree'), ('geometry', 'gist'), ('geometry_3067', 'gist')]
+    lookup_df = pd.DataFrame({'virva': ['Kunta', 'geometry'], 'index_type': ['btree', 'gist']})
+    assert edit_db.get_index_plan(lookup_df) == [('Kunta', 'btree'), ('geometry', 'gist'), ('geometry_3067', 'gist')]
+
+    # Without a geometry index there is none of the projected geometry either
+    lookup_df = pd.DataFrame({'virva': ['Kunta', 'geometry'], 'index_type': ['btree', None]})
+    assert edit_db.get_index_plan(lookup_df) == [('Kunta', 'btree')]
+    # The default plan is not modified
+    assert edit_db.DEFAULT_INDEX_PLAN == [('Kunta', 'btree'), ('geometry', 'gist')]
+
+def test_index_plan_from_lookup_table():
+    lookup_df = pd.read_csv('scripts/resources/lookup_table_columns.csv', sep=';', header=0)
+    plan = dict(edit_db.get_index_plan(lookup_df))
+
+    # Filterable columns get an index suited to them, the rest are not indexed
+    assert plan['Kunta'] == 'btree'
+    assert plan['Keruu_aloitus_pvm'] == 'btree'
+    assert plan['Tieteellinen_nimi'] == 'trgm'
+    assert plan['geometry'] == 'gist'
+    assert plan['geometry_3067'] == 'gist'
+    assert 'Havainnon_tunniste' not in plan
+
+    statements = dict(edit_db._index_statements('t1', lookup_df=lookup_df))
+    assert statements['idx_t1_Kunta'] == 'CREATE INDEX IF NOT EXISTS "idx_t1_Kunta" ON "public"."t1" USING btree ("Kunta")'
+    assert statements['idx_t1_geom'] == 'CREATE INDEX IF NOT EXISTS "idx_t1_geom" ON "public"."t1" USING gist ("geometry")'
+    assert statements['idx_t1_geom_3067'] == 'CREATE INDEX IF NOT EXISTS "idx_t1_geom_3067" ON "public"."t1" USING gist ("geometry_3067")'
+    assert statements['idx_t1_Tieteellinen_nimi'].endswith('USING gin ("Tieteellinen_nimi" gin_trgm_ops)')
+
+    # Names longer than PostgreSQL's limit are shortened but stay unique
+    long_table = 'a_very_long_dataset_table_name_points'
+    names = [name for name, _ in edit_db._index_statements(long_table, lookup_df=lookup_df)]
+    assert all(len(name) <= 63 for name in names)
+    assert len(set(names)) == len(names)
+
+def test_update_indexes_skips_trigram_without_extension():
+    from unittest.mock import MagicMock, patch
+    lookup_df = pd.DataFrame({'virva': ['Kunta', 'Tieteellinen_nimi'], 'index_type': ['btree', 'trgm']})
+    mock_engine = MagicMock()
+    connection = mock_engine.connect.return_value.__enter__.return_value
+
+    def execute(statement, *args, **kwargs):
+        if 'CREATE EXTENSION' in str(statement):
+            raise Exception('permission denied')
+        # The extension was not created
+        return MagicMock(scalar=MagicMock(return_value=None))
+    connection.execute.side_effect = execute
+    with patch.object(edit_db, 'get_engine', return_value=mock_engine):
+        edit_db.prepare_database(lookup_df)
+        timings = edit_db.update_indexes(['t1'], use_multiprocessing=False, lookup_df=lookup_df)
+
+    assert list(timings) == ['idx_t1_Kunta']
+    # Shared objects are only created by prepare_database, never while the indexes are built in parallel
+    statements = [str(c.args[0]).strip() for c in connection.execute.call_args_list]
+    assert [statement.split(' IF NOT EXISTS')[0] for statement in statements[:4]] == ['CREATE SCHEMA', 'CREATE TABLE', 'CREATE TABLE', 'CREATE EXTENSION']
+    assert all(statement.startswith(('SELECT', 'CREATE INDEX', 'ANALYZE')) for statement in statements[4:])
+
+def test_finalize_tables(engine):
+    import pandas as pd
+    drop_test_table(engine, 'final_table')
+    drop_test_table(engine, 'final_table_staging')
     with engine.connect() as conn:
         conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS"dup_table" (
-                "id" SERIAL PRIMARY KEY,
+            CREATE UNLOGGED TABLE "final_table_staging" (
+                "Kunta" TEXT,
                 "Havainnon_tunniste" TEXT,
+                "Yksilomaara_tulkittu" INTEGER,
                 "Lataus_pvm" TIMESTAMP,
-                geometry Geometry(Point, 4326)
+                geometry Geometry(GEOMETRY, 4326)
             );
         '''))
-        # Insert duplicates
         conn.execute(text('''
-            INSERT INTO "dup_table" ("Havainnon_tunniste", "Lataus_pvm", geometry) VALUES
-            ('a', '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
-            ('a', '2023-01-02', ST_GeomFromText('POINT(1 2)', 4326)),
-            ('b', '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326));
+            INSERT INTO "final_table_staging" VALUES
+            ('city1', 'obs1', 5, '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
+            ('city1', 'obs1', 5, '2023-01-02', ST_GeomFromText('POINT(1 2)', 4326)),
+            ('city1', 'obs1', 9, NULL, ST_GeomFromText('POINT(1 2)', 4326)),
+            ('city1', 'obs2', 3, '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
+            ('city2', 'obs3', 2, '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326));
         '''))
         conn.commit()
-    removed = edit_db.remove_duplicates(['dup_table'])
-    # Only one duplicate should be removed
-    assert removed == 1
-    count = edit_db.get_amount_of_occurrences('dup_table')
-    assert count == 2
-    drop_test_table(engine, 'dup_table')
 
-def test_merge_similar_observations(engine):
-    import pandas as pd  
-    
-    drop_test_table(engine, 'test_merge_table')
+    lookup_df = pd.DataFrame({
+        'virva': ['Kunta', 'Havainnon_tunniste', 'Yksilomaara_tulkittu'],
+        'merge_option': ['GROUPBY', 'AGGREGATE', 'SUM']
+    })
+    removed, merged = edit_db.finalize_tables(['final_table'], lookup_df, ['final_table_staging'])
+    # The latest version is kept; versions without Lataus_pvm lose, like in upsert_to_db
+    assert removed == 2
+    assert merged == 1
+
+    with engine.connect() as conn:
+        rows = conn.execute(text('''
+            SELECT "Kunta", "Yksilomaara_tulkittu", "Yhdistetty" FROM "final_table" ORDER BY "Kunta"
+        ''')).fetchall()
+    assert [tuple(row) for row in rows] == [('city1', 8, 2), ('city2', 2, 1)]
+    assert not edit_db.check_table_exists('final_table_staging')
+    drop_test_table(engine, 'final_table')
+
+def test_finalize_tables_orders_rows_spatially(engine):
+    drop_test_table(engine, 'spatial_table')
     with engine.connect() as conn:
         conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS "test_merge_table" (
-                id SERIAL PRIMARY KEY,
-                "Tieteellinen_nimi" TEXT,
+            CREATE TABLE "spatial_table" ("Kunta" TEXT, "Havainnon_tunniste" TEXT, "Lataus_pvm" TIMESTAMP, geometry Geometry(GEOMETRY, 4326));
+        '''))
+        # Far apart points in alternating order
+        conn.execute(text('''
+            INSERT INTO "spatial_table"
+            SELECT 'city' || i, 'obs' || i, '2023-01-01', ST_SetSRID(ST_MakePoint(CASE WHEN i % 2 = 0 THEN 20 ELSE 30 END + i * 0.001, 60), 4326)
+            FROM generate_series(1, 200) AS i
+        '''))
+        conn.commit()
+        assert edit_db._spatial_correlation(conn, 'spatial_table') < 0.5
+        conn.rollback()
+
+    lookup_df = pd.DataFrame({'virva': ['Kunta', 'Havainnon_tunniste'], 'merge_option': ['GROUPBY', 'AGGREGATE']})
+    edit_db.finalize_tables(['spatial_table'], lookup_df)
+
+    with engine.connect() as conn:
+        longitudes = conn.execute(text('SELECT ST_X(geometry) FROM "spatial_table" ORDER BY ctid')).scalars().all()
+        assert longitudes == sorted(longitudes)
+        assert edit_db._spatial_correlation(conn, 'spatial_table') == pytest.approx(1)
+    drop_test_table(engine, 'spatial_table')
+
+def test_finalize_tables_partitioned_by_year(engine):
+    drop_test_table(engine, 'part_table')
+    drop_test_table(engine, 'part_table_staging')
+    with engine.connect() as conn:
+        conn.execute(text('''
+            CREATE TABLE "part_table_staging" (
                 "Kunta" TEXT,
                 "Havainnon_tunniste" TEXT,
-                "Yksilomaara_tulkittu" INTEGER,
-                "Keruutapahtuman_tunniste" TEXT,
-                "Maara" TEXT,
-                "Avainsanat" TEXT,
-                "Havainnon_lisatiedot" TEXT,
-                "Aineisto" TEXT,
-                "Paikallinen_tunniste" TEXT,
+                "Keruu_aloitus_pvm" TIMESTAMP,
                 "Lataus_pvm" TIMESTAMP,
-                geometry Geometry(Point, 4326)
+                geometry Geometry(GEOMETRY, 4326)
             );
         '''))
-        # Insert records that should be merged (same Tieteellinen_nimi and Kunta)
         conn.execute(text('''
-            INSERT INTO "test_merge_table" ("Tieteellinen_nimi", "Kunta", "Havainnon_tunniste", "Yksilomaara_tulkittu", 
-                                     "Keruutapahtuman_tunniste", "Maara", "Avainsanat", "Havainnon_lisatiedot", "Aineisto", "Paikallinen_tunniste", "Lataus_pvm", geometry) VALUES
-            ('species1', 'city1', 'obs1', 5, 'event1', '1', 'kw1,kw2', 'lisatiedot', 'collection1', '1', '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
-            ('species1', 'city1', 'obs2', 3, 'event2', '5', 'jee,juu', 'lisaa tietoa', 'aineisto3', '2', '2023-01-02', ST_GeomFromText('POINT(1 2)', 4326)),
-            ('species2', 'city2', 'obs3', 2, 'event3', '10', 'abc,def', 'lisatiedot2', 'aineisto1', '3', '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326));
+            INSERT INTO "part_table_staging" VALUES
+            ('city1', 'obs1', '2021-05-01', '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
+            ('city1', 'obs2', '2022-05-01', '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
+            ('city2', 'obs3', NULL, '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326));
         '''))
         conn.commit()
-    
-    # Create lookup DataFrame matching the structure from lookup_table_columns.csv
+
     lookup_df = pd.DataFrame({
-        'virva': ['Tieteellinen_nimi', 'Kunta', 'Havainnon_tunniste', 'Yksilomaara_tulkittu'],
-        'merge_option': ['FIRST', 'GROUPBY', 'AGGREGATE', 'SUM']
+        'virva': ['Kunta', 'Havainnon_tunniste', 'Keruu_aloitus_pvm'],
+        'merge_option': ['GROUPBY', 'AGGREGATE', 'GROUPBY']
     })
+    edit_db.finalize_tables(['part_table'], lookup_df, ['part_table_staging'], partition_by_year=True)
+    # Finalizing the partitioned table again replaces it and its partitions
+    edit_db.finalize_tables(['part_table'], lookup_df, partition_by_year=True)
 
-    merged = edit_db.merge_similar_observations(['test_merge_table'], lookup_df)
-    assert merged == 1  # One duplicate merged
-    
-    count = edit_db.get_amount_of_occurrences('test_merge_table')
-    assert count == 2  # Two unique groups remain
-    
-    # Check that Yksilomaara_tulkittu was summed correctly
     with engine.connect() as conn:
-        result = conn.execute(text('''
-            SELECT "Yksilomaara_tulkittu" FROM "test_merge_table" 
-            WHERE "Tieteellinen_nimi" = 'species1' AND "Kunta" = 'city1'
-        ''')).scalar()
-        assert result == 8  # 5 + 3
+        partitions = edit_db._get_partitions(conn, 'part_table')
+        counts = dict(conn.execute(text('''
+            SELECT tableoid::regclass::text, COUNT(*) FROM "part_table" GROUP BY 1
+        ''')).fetchall())
+    assert partitions == ['part_table_p2021', 'part_table_p2022', 'part_table_pdefault']
+    assert counts == {'part_table_p2021': 1, 'part_table_p2022': 1, 'part_table_pdefault': 1}
 
-    # Check that aggregated columns are correct
+    tables = edit_db.get_all_tables()
+    assert 'part_table' in tables
+    assert 'part_table_p2021' not in tables
+    drop_test_table(engine, 'part_table')
+
+def test_combine_collection_stats():
+    from datetime import datetime
+    current = (20.0, 60.0, 25.0, 65.0, datetime(2020, 1, 1), datetime(2020, 12, 31), 10, {'a': 6, 'b': 4})
+    added = (19.0, 61.0, 24.0, 66.0, datetime(2021, 1, 1), datetime(2021, 6, 1), 3, {'a': 1, 'c': 2})
+    removed = [(None, None, None, None, None, None, 0, {}), (20.0, 60.0, 21.0, 61.0, None, None, 4, {'b': 4})]
+
+    stats = edit_db._combine_collection_stats(current, added, removed)
+
+    # The extent and dates only grow, counts are exact
+    assert stats[:4] == (19.0, 60.0, 25.0, 66.0)
+    assert stats[4:6] == (datetime(2020, 1, 1), datetime(2021, 6, 1))
+    assert stats[6] == 9
+    assert stats[7] == {'a': 7, 'c': 2}
+
+def test_finalize_tables_updates_collection_stats(engine):
+    drop_test_table(engine, 'stats_table')
     with engine.connect() as conn:
-        result = conn.execute(text('''
-            SELECT *
-            FROM "test_merge_table"
-            WHERE "Tieteellinen_nimi" = 'species1' AND "Kunta" = 'city1'
-        ''')).fetchone()
-        assert 'species1' in result
-        assert 'city1' in result
-        assert 'obs1, obs2' in result
+        conn.execute(text('''
+            CREATE TABLE "stats_table" (
+                "Havainnon_tunniste" TEXT, "Aineiston_laatu" TEXT, "Keruu_aloitus_pvm" TIMESTAMP, "Keruu_lopetus_pvm" TIMESTAMP,
+                "Lataus_pvm" TIMESTAMP, geometry Geometry(GEOMETRY, 4326)
+            );
+        '''))
+        conn.execute(text('''
+            INSERT INTO "stats_table" VALUES
+            ('obs1', 'good', '2020-01-01', '2020-01-02', '2023-01-01', ST_GeomFromText('POINT(1 2)', 4326)),
+            ('obs2', 'good', '2021-01-01', '2021-01-02', '2023-01-01', ST_GeomFromText('POINT(3 4)', 4326)),
+            ('obs3', NULL, NULL, NULL, '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326)),
+            ('obs4', 'poor', '2022-01-01', NULL, '2023-01-01', ST_GeomFromText('POINT(2 3)', 4326));
+        '''))
+        conn.commit()
 
+    lookup_df = pd.DataFrame({
+        'virva': ['Havainnon_tunniste', 'Aineiston_laatu', 'Keruu_aloitus_pvm', 'Keruu_lopetus_pvm'],
+        'merge_option': ['GROUPBY', 'GROUPBY', 'GROUPBY', 'GROUPBY']
+    })
+    edit_db.finalize_tables(['stats_table'], lookup_df)
+
+    stats = edit_db.get_collection_stats()['stats_table']
+    assert stats['bbox'] == [1.0, 2.0, 3.0, 4.0]
+    assert stats['min_date'] == '2020-01-01T00:00:00Z'
+    assert stats['max_date'] == '2021-01-02T00:00:00Z'
+    assert stats['occurrences'] == 4
+    assert stats['quality_dict'] == {'good': 50.0, 'poor': 25.0, None: 25.0}
+    assert edit_db.get_amount_of_all_occurrences() >= 4
+
+    edit_db.drop_table(['stats_table'])
+    assert 'stats_table' not in edit_db.get_collection_stats()
+
+def test_get_geometry_columns():
+    assert list(edit_db.get_geometry_columns('uusimaa_points')) == ['geometry_3067']
+    assert set(edit_db.get_geometry_columns('uusimaa_polygons')) == {'geometry_3067', 'geometry_simplified_100m', 'geometry_simplified_1km'}
+
+def test_add_geometry_columns(engine):
+    drop_test_table(engine, 'old_points')
+    create_test_table(engine, 'old_points')
+    with engine.connect() as conn:
+        assert edit_db.add_geometry_columns(conn, 'old_points') == ['geometry_3067']
+        assert edit_db.add_geometry_columns(conn, 'old_points') == []
+        conn.commit()
+    edit_db.drop_table(['old_points'])
 
-    drop_test_table(engine, 'test_merge_table')
+def test_finalize_tables_adds_simplified_geometries(engine):
+    drop_test_table(engine, 'simple_polygons')
+    with engine.connect() as conn:
+        conn.execute(text('''
+            CREATE TABLE "simple_polygons" (
+                "Havainnon_tunniste" TEXT, "Lataus_pvm" TIMESTAMP, geometry Geometry(GEOMETRY, 4326)
+            );
+        '''))
+        # A circle of 64 vertices with a radius of 500 m
+        conn.execute(text('''
+            INSERT INTO "simple_polygons" VALUES
+            ('obs1', '2023-01-01', ST_Transform(ST_Buffer(ST_SetSRID(ST_MakePoint(385500, 6672500), 3067), 500, 16), 4326));
+        '''))
+        conn.commit()
 
+    lookup_df = pd.DataFrame({'virva': ['Havainnon_tunniste'], 'merge_option': ['GROUPBY']})
+    edit_db.finalize_tables(['simple_polygons'], lookup_df)
 
+    with engine.connect() as conn:
+        full, simplified_100m, simplified_1km = conn.execute(text('''
+            SELECT ST_NPoints(geometry), ST_NPoints(geometry_simplified_100m), ST_NPoints(geometry_simplified_1km)
+            FROM "simple_polygons"
+        ''')).one()
+        assert full > simplified_100m > 0
+        assert simplified_100m >= simplified_1km > 0
+        srid, x = conn.execute(text('SELECT ST_SRID(geometry_3067), ST_X(ST_Centroid(geometry_3067)) FROM "simple_polygons"')).one()
+        assert srid == 3067
+        assert abs(x - 385500) < 1
+
+        # Generated columns follow updates of the geometry
+        conn.execute(text('UPDATE "simple_polygons" SET geometry = ST_GeomFromText(\'POLYGON((24 60, 24.1 60, 24.1 60.1, 24 60))\', 4326)'))
+        assert conn.execute(text('SELECT ST_NPoints(geometry_simplified_1km) FROM "simple_polygons"')).scalar() == 4
+        conn.commit()
+
+    edit_db.drop_table(['simple_polygons'])
+
+def test_build_grid_tables(engine):
+    for table_name in ['grid_points', 'grid_polygons']:
+        drop_test_table(engine, table_name)
+    with engine.connect() as conn:
+        for table_name in ['grid_points', 'grid_polygons']:
+            conn.execute(text(f'''
+                CREATE TABLE "{table_name}" (
+                    "Taksonin_tunniste" TEXT, "Keruu_aloitus_pvm" TIMESTAMP, "Keruu_lopetus_pvm" TIMESTAMP,
+                    "Yhdistetty" INTEGER, geometry Geometry(GEOMETRY, 4326)
+                );
+            '''))
+        # Points in EPSG:3067 cells (385, 6672) and (386, 6672) of the 1 km grid, which are in the same 10 km cell
+        conn.execute(text('''
+            INSERT INTO "grid_points" VALUES
+            ('taxon1', '2020-01-01', '2020-01-02', 3, ST_Transform(ST_SetSRID(ST_MakePoint(385500, 6672500), 3067), 4326)),
+            ('taxon2', '2021-01-01', NULL, 1, ST_Transform(ST_SetSRID(ST_MakePoint(385600, 6672600), 3067), 4326)),
+            ('taxon1', '2019-01-01', '2019-01-01', 1, ST_Transform(ST_SetSRID(ST_MakePoint(386500, 6672500), 3067), 4326));
+        '''))
+        conn.execute(text('''
+            INSERT INTO "grid_polygons" VALUES
+            ('taxon3', '2022-01-01', '2022-01-01', 2, ST_Transform(ST_SetSRID(ST_Buffer(ST_MakePoint(385500, 6672500), 100), 3067), 4326));
+        '''))
+        conn.commit()
+
+    cell_counts = edit_db.build_grid_tables(['grid_points', 'grid_polygons'])
+    assert cell_counts == {'grid_1km': 2, 'grid_10km': 1}
+    # Rebuilding swaps the new tables in place of the served ones
+    assert edit_db.build_grid_tables(['grid_points', 'grid_polygons']) == cell_counts
+    inspector = inspect(engine)
+    assert 'grid_1km_new' not in inspector.get_table_names()
+    assert [index['name'] for index in inspector.get_indexes('grid_1km')] == ['idx_grid_1km_geom']
+    assert inspector.get_pk_constraint('grid_1km')['name'] == 'grid_1km_pkey'
+
+    with engine.connect() as conn:
+        cells = conn.execute(text('''
+            SELECT "Ruudun_tunniste", "Havaintojen_lukumaara", "Taksonien_lukumaara", "Viimeisin_havainto"
+            FROM "grid_1km" ORDER BY "Ruudun_tunniste"
+        ''')).fetchall()
+        assert [tuple(cell[:3]) for cell in cells] == [('6672:385', 6, 3), ('6672:386', 1, 1)]
+        assert str(cells[0][3]).startswith('2022-01-01')
+
+        cell = conn.execute(text('SELECT "Ruudun_tunniste", "Havaintojen_lukumaara", "Taksonien_lukumaara" FROM "grid_10km"')).fetchone()
+        assert tuple(cell) == ('6670:380', 7, 3)
+
+    # Grid tables are not occurrence tables
+    assert 'grid_1km' not in edit_db.get_all_tables()
+    assert set(edit_db.get_grid_tables()) == {'grid_1km', 'grid_10km'}
+    edit_db.drop_table(['grid_points', 'grid_polygons', 'grid_1km', 'grid_10km'])
+
+def test_publish_shadow_tables(engine):
+    drop_test_table(engine, 'shadow_table')
+    create_test_table(engine, 'shadow_table')
+    with engine.connect() as conn:
+        conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{edit_db.SHADOW_SCHEMA}"'))
+        conn.execute(text(f'CREATE TABLE "{edit_db.SHADOW_SCHEMA}"."shadow_table" ("Kunta" TEXT, geometry Geometry(POINT, 4326))'))
+        conn.execute(text(f'''INSERT INTO "{edit_db.SHADOW_SCHEMA}"."shadow_table" VALUES ('new', ST_GeomFromText('POINT(1 2)', 4326))'''))
+        conn.commit()
+    edit_db.update_indexes(['shadow_table'], use_multiprocessing=False, schema=edit_db.SHADOW_SCHEMA)
+    with engine.connect() as conn:
+        edit_db.update_collection_stats(conn, 'shadow_table', ['Kunta', 'geometry'], edit_db.SHADOW_SCHEMA)
+        conn.commit()
+    # The statistics of unpublished tables are not reported
+    assert 'shadow_table' not in edit_db.get_collection_stats()
+
+    assert edit_db.publish_shadow_tables() == ['shadow_table']
+    assert edit_db.get_collection_stats()['shadow_table']['occurrences'] == 1
+
+    # The public table is replaced with the shadow table and its indexes
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT "Kunta" FROM public."shadow_table"')).scalar() == 'new'
+        indexes = [row[0] for row in conn.execute(text("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = 'shadow_table'"))]
+    assert 'idx_shadow_table_geom' in indexes
+    assert inspect(engine).get_table_names(schema=edit_db.SHADOW_SCHEMA) == [edit_db.COLLECTION_STATS_TABLE]
+    assert edit_db.publish_shadow_tables() == []
+
+    # Tables of datasets that loaded nothing are dropped only when publishing
+    assert edit_db.publish_shadow_tables(removed_tables=['shadow_table']) == []
+    assert not edit_db.check_table_exists('shadow_table')
+    assert 'shadow_table' not in edit_db.get_collection_stats()
@@ -83,6 +83,9 @@ def test_create_metadata(monkeypatch, tmp_path):
         @staticmethod
         def get_all_tables():
             return ['satakunta_points']
+        @staticmethod
+        def get_collection_stats():
+            return {}
 
     class DummyEditConfig:
         @staticmethod
@@ -106,4 +109,85 @@ def test_create_metadata(monkeypatch, tmp_path):
     assert record['properties']['title'] == 'satakunta_points', "The title should match the dataset name."
     assert record['id'] == "ID_0", "The ID should match the expected ID for table_no=0."
     assert record['properties']['description'].startswith('This dataset has 100'), "The description should be correctly formatted."
-    db.close()
\ No newline at end of file
+    db.close()
+
+def test_create_metadata_from_collection_stats(monkeypatch):
+    """
+    Test that create_metadata uses the stored collection statistics instead of querying the tables.
+    """
+    class DummyEditDB:
+        @staticmethod
+        def get_all_tables():
+            return ['satakunta_points', 'uusimaa_points']
+        @staticmethod
+        def get_collection_stats():
+            return {
+                'satakunta_points': {
+                    'bbox': [24.5, 60.0, 25.0, 60.5],
+                    'min_date': '2024-01-01T00:00:00Z',
+                    'max_date': '2024-12-31T23:59:59Z',
+                    'occurrences': 42,
+                    'quality_dict': {'Kansalaishavaintoja / ei laadunvarmistusta': 100.0}
+                },
+                'uusimaa_points': {
+                    'bbox': None, 'min_date': None, 'max_date': None, 'occurrences': 0, 'quality_dict': {}
+                }
+            }
+        @staticmethod
+        def get_table_bbox(table_name):
+            raise AssertionError("Tables with statistics should not be queried")
+        get_table_dates = get_amount_of_occurrences = get_quality_frequency = get_table_bbox
+
+    added_params = []
+
+    class DummyEditConfig:
+        @staticmethod
+        def add_to_pygeoapi_config(template_resource, template_params, pygeoapi_config_out):
+            added_params.append(template_params)
+
+    monkeypatch.setattr(edit_metadata, "edit_db", DummyEditDB)
+    monkeypatch.setattr(edit_metadata, "edit_config", DummyEditConfig)
+
+    edit_metadata.create_metadata("dummy_template", TEST_DB_PATH, "dummy_config_out")
+
+    # Empty tables are skipped
+    assert len(added_params) == 1
+    assert added_params[0]["<placeholder_amount_of_occurrences>"] == '42'
+    db = TinyDB(TEST_DB_PATH)
+    records = db.all()
+    assert records[0]['properties']['description'].startswith('This dataset has 42 point occurrence features')
+    db.close()
+
+def test_add_grid_collections(monkeypatch):
+    """
+    Test that the grid tables with cells are added to the configuration.
+    """
+    class DummyEditDB:
+        GRID_TABLES = {'grid_1km': 1000, 'grid_10km': 10000}
+        @staticmethod
+        def get_grid_tables():
+            return ['grid_1km', 'grid_10km']
+        @staticmethod
+        def get_amount_of_occurrences(table_name):
+            return 0 if table_name == 'grid_1km' else 12
+        @staticmethod
+        def get_table_bbox(table_name):
+            return [19.0, 59.0, 32.0, 70.0]
+
+    added_params = []
+
+    class DummyEditConfig:
+        @staticmethod
+        def add_to_pygeoapi_config(template_resource, template_params, pygeoapi_config_out):
+            added_params.append(template_params)
+
+    monkeypatch.setattr(edit_metadata, "edit_db", DummyEditDB)
+    monkeypatch.setattr(edit_metadata, "edit_config", DummyEditConfig)
+
+    edit_metadata.add_grid_collections("dummy_template", "dummy_config_out")
+
+    # Empty grids are skipped
+    assert len(added_params) == 1
+    assert added_params[0]["<placeholder_table_name>"] == 'grid_10km'
+    assert added_params[0]["<placeholder_cell_size>"] == '10'
+    assert added_params[0]["<placeholder_amount_of_cells>"] == '12'
@@ -3,9 +3,13 @@ import pandas as pd
 from unittest.mock import patch, MagicMock
 import requests
 import os
+import stat
+import json
+import pytest
 
 from scripts import load_data
 import time
+import threading
 
 # run with:
 # cd pygeoapi
@@ -45,7 +49,7 @@ def test_is_cache_valid():
 @patch('pandas.read_json')
 def test_load_or_update_cache(mock_read_json, mock_read_csv, mock_get_municipality_ids, 
                              mock_get_taxon_data, mock_get_collection_names, 
-                             mock_get_value_ranges, mock_get_enumerations):
+                             mock_get_value_ranges, mock_get_enumerations, tmp_path):
     # Setup mocks
     mock_gdf = MagicMock()
     mock_gdf.to_crs.return_value = mock_gdf
@@ -63,7 +67,8 @@ def test_load_or_update_cache(mock_read_json, mock_read_csv, mock_get_municipali
     
     config = {
         'laji_api_url': 'https://api.laji.fi/',
-        'access_token': 'test_token'
+        'access_token': 'test_token',
+        'helper_cache_path': str(tmp_path / 'helper-cache.json.z')
     }
     
     # Clear cache to ensure fresh test
@@ -84,8 +89,8 @@ def test_load_or_update_cache(mock_read_json, mock_read_csv, mock_get_municipali
     mock_get_enumerations.assert_called_once()
     
     # Verify result structure
-    assert len(result) == 6
-    municipality_ely_mappings, municipals_ids, lookup_df, taxon_df, collection_names, all_value_ranges = result
+    assert len(result) == 7
+    municipality_ely_mappings, municipals_ids, lookup_df, taxon_df, collection_names, all_value_ranges, municipality_elinvoima_mappings = result
     assert municipals_ids == {'Municipality1': 'ID1'}
     assert collection_names == {'Collection1': 'Name1'}
     assert all_value_ranges == {'range1': 'value1', 'enum1': 'label1'}
@@ -182,6 +187,15 @@ def test_fetch_json_with_retry(mock_get):
     assert result is None
     assert mock_get.call_count == 3
 
+    # Unexpected exceptions propagate, but the request permit is still returned
+    mock_get.reset_mock()
+    mock_get.side_effect = None
+    mock_get.return_value = MagicMock(status_code=200, text='{}')
+    in_flight = load_data.rate_controller.in_flight
+    with pytest.raises(TypeError):
+        load_data.fetch_json_with_retry("http://example.com/api", decoder=lambda text: text + 1)
+    assert load_data.rate_controller.in_flight == in_flight
+
 @patch('scripts.load_data.fetch_json_with_retry')
 def test_get_collection_names(mock_fetch):
     mock_fetch.return_value = {
@@ -308,3 +322,151 @@ def test_get_municipality_ids(mock_fetch):
     result = load_data.get_municipality_ids("http://example.com/api", params, headers)
     assert result is None
     mock_fetch.assert_called_once_with("http://example.com/api", params=params, headers=headers)
+
+@patch('scripts.load_data.download_page')
+def test_get_occurrence_data_concurrent(mock_download_page):
+    def fake_download(url, params, headers, page_no, session=None):
+        # Page 2 fails and returns an empty GeoDataFrame
+        if page_no == 2:
+            return gpd.GeoDataFrame()
+        return gpd.GeoDataFrame({'unit.unitId': [f'id{page_no}'], 'geometry': [None]}, geometry='geometry', crs="EPSG:4326")
+    mock_download_page.side_effect = fake_download
+
+    gdf, failed = load_data.get_occurrence_data("http://example.com/api", {}, {}, startpage=1, endpage=3, multiprocessing=True, max_workers=2)
+    assert sorted(gdf['unit.unitId'].dropna()) == ['id1', 'id3']
+    assert failed == 10000
+    assert mock_download_page.call_count == 3
+
+    # All pages share the same pooled session
+    sessions = {call.args[4] for call in mock_download_page.call_args_list}
+    assert len(sessions) == 1
+    assert sessions.pop() is load_data._get_session()
+
+def test_decode_feature_collection():
+    features = [
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [24.9, 60.1]}, 'properties': {'unit.unitId': 'id1', 'unit.interpretations.individualCount': 3}},
+        {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': [[24.9, 60.1], [25.0, 60.2]]}, 'properties': {'unit.unitId': 'id2', 'unit.keywords[0]': 'kw'}},
+        {'type': 'Feature', 'geometry': None, 'properties': {'unit.unitId': 'id3'}},
+    ]
+    text = json.dumps({'type': 'FeatureCollection', 'total': 3, 'features': features, 'lastPage': 1})
+
+    gdf = load_data.decode_feature_collection(text)
+    expected = gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+    assert gdf.crs == expected.crs
+    pd.testing.assert_frame_equal(gdf[expected.columns], expected, check_like=True)
+
+    # Empty pages decode to an empty GeoDataFrame and truncated responses raise ValueError
+    assert load_data.decode_feature_collection('{"type": "FeatureCollection", "features": []}').empty
+    with pytest.raises(ValueError):
+        load_data.decode_feature_collection(text[:-10])
+
+def test_helper_cache_file(tmp_path):
+    path = str(tmp_path / 'cache' / 'helper-cache.json.z')
+    api_data = ({'Helsinki': 'ML.660'}, pd.DataFrame({'id': ['MVL.1'], 'name': ['Linnut']}), {'HR.1': 'Collection'}, {'enum1': 'label1'})
+
+    # Missing file
+    assert load_data._read_helper_cache_file(path, 'https://api.laji.fi/') is None
+
+    load_data._write_helper_cache_file(path, 'https://api.laji.fi/', api_data)
+    cached, created = load_data._read_helper_cache_file(path, 'https://api.laji.fi/')
+    assert cached[0] == api_data[0]
+    pd.testing.assert_frame_equal(cached[1], api_data[1])
+    assert cached[2:] == api_data[2:]
+    assert time.time() - created < 60
+    assert stat.S_IMODE(os.stat(tmp_path / 'cache').st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    # Files of other users are not read
+    with patch('scripts.load_data.os.getuid', return_value=os.getuid() + 1):
+        assert load_data._read_helper_cache_file(path, 'https://api.laji.fi/') is None
+
+    # Data fetched from another API is not used
+    assert load_data._read_helper_cache_file(path, 'https://apitest.laji.fi/') is None
+
+    # Expired cache
+    with patch('scripts.load_data.time.time', return_value=time.time() + load_data._cache_timeout + 1):
+        assert load_data._read_helper_cache_file(path, 'https://api.laji.fi/') is None
+
+    # Corrupted cache
+    with open(path, 'r+b') as file:
+        file.seek(-1, os.SEEK_END)
+        file.write(b'\x00')
+    assert load_data._read_helper_cache_file(path, 'https://api.laji.fi/') is None
+
+@patch('scripts.load_data.get_enumerations', return_value={'enum1': 'label1'})
+@patch('scripts.load_data.get_value_ranges', return_value={'range1': 'value1'})
+@patch('scripts.load_data.get_collection_names', return_value={'HR.1': 'Collection'})
+@patch('scripts.load_data.get_taxon_data', return_value=pd.DataFrame({'id': ['MVL.1'], 'name': ['Linnut']}))
+@patch('scripts.load_data.get_municipality_ids', return_value={'Helsinki': 'ML.660'})
+def test_load_or_update_cache_from_file(mock_get_municipality_ids, mock_get_taxon_data, mock_get_collection_names, mock_get_value_ranges, mock_get_enumerations, tmp_path):
+    config = {'laji_api_url': 'https://example.com/', 'access_token': 'test_token', 'helper_cache_path': str(tmp_path / 'helper-cache.json.z')}
+    cache_key = f"helper_data_{config['laji_api_url']}"
+    load_data._cache.pop(cache_key, None)
+
+    load_data.load_or_update_cache(config)
+    assert mock_get_municipality_ids.call_count == 1
+
+    # Another process (empty in-memory cache) reads the file instead of calling the API
+    load_data._cache.pop(cache_key, None)
+    result = load_data.load_or_update_cache(config)
+    assert mock_get_municipality_ids.call_count == 1
+    assert result[1] == {'Helsinki': 'ML.660'}
+    assert result[4] == {'HR.1': 'Collection'}
+
+    # Explicit refresh always calls the API
+    load_data.load_or_update_cache(config, force_refresh=True)
+    assert mock_get_municipality_ids.call_count == 2
+    load_data._cache.pop(cache_key, None)
+
+@patch('scripts.load_data.get_enumerations', return_value={'enum1': 'label1'})
+@patch('scripts.load_data.get_value_ranges', return_value={'range1': 'value1'})
+@patch('scripts.load_data.get_collection_names', return_value={})
+@patch('scripts.load_data.get_taxon_data', side_effect=RuntimeError('boom'))
+@patch('scripts.load_data.get_municipality_ids')
+def test_fetch_helper_data(mock_get_municipality_ids, mock_get_taxon_data, mock_get_collection_names, mock_get_value_ranges, mock_get_enumerations):
+    release = threading.Event()
+
+    def slow_municipalities(url, params, headers):
+        release.wait(5)
+        return {'Helsinki': 'ML.660'}
+    mock_get_municipality_ids.side_effect = slow_municipalities
+
+    # Failed and timed out sources are replaced with empty values
+    start = time.monotonic()
+    result = load_data.fetch_helper_data('https://example.com/', {}, timeout=0.5)
+    release.set()
+    assert time.monotonic() - start < 2
+    assert result['municipality_ids'] == {}
+    assert result['taxon_data'].empty
+    assert result['collection_names'] == {}
+    assert result['value_ranges'] == {'range1': 'value1'}
+    assert result['enumerations'] == {'enum1': 'label1'}
+
+    # Value ranges and enumerations are required
+    mock_get_enumerations.return_value = None
+    with pytest.raises(ValueError, match='enumerations'):
+        load_data.fetch_helper_data('https://example.com/', {}, timeout=0.5)
+
+@patch('scripts.load_data.get_count')
+def test_get_time_windows(mock_get_count):
+    # 100 occurrences per day in 2020, none before
+    def count(url, params, headers):
+        start, end = load_data._parse_time_range(params['time'])
+        start = max(start, load_data.datetime.date(2020, 1, 1))
+        return max(0, (end - start).days + 1) * 100
+    mock_get_count.side_effect = count
+
+    windows = load_data.get_time_windows("url", {'time': '2019-01-01/2020-12-31'}, {}, page_size=1000, max_pages=5)
+
+    # Windows cover the range in order without gaps and stay within five pages
+    assert windows[-1][0].endswith('/2020-12-31')
+    for (previous, _), (current, _) in zip(windows, windows[1:]):
+        previous_end = load_data._parse_time_range(previous)[1]
+        assert load_data._parse_time_range(current)[0] == previous_end + load_data.datetime.timedelta(days=1)
+    assert all(pages <= 5 for _, pages in windows)
+    assert sum(pages for _, pages in windows) >= 366 * 100 // 1000
+
+    mock_get_count.side_effect = None
+    mock_get_count.return_value = None
+    with pytest.raises(ValueError):
+        load_data.get_time_windows("url", {'time': '2019-01-01/'}, {}, page_size=1000, max_pages=5)
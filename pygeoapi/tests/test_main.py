@@ -1,4 +1,6 @@
+from concurrent.futures import Future
 from unittest.mock import patch
+import pytest
 import os
 import geopandas as gpd
 import pandas as pd
@@ -38,10 +40,9 @@ def test_parse_bool():
     assert main._parse_bool(None) is False
 
 @patch('pygeoapi.scripts.main.edit_db.to_db', return_value=0)
-@patch('pygeoapi.scripts.main.edit_db.remove_duplicates', return_value=0)
 @patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
 @patch('pygeoapi.scripts.main.compute_variables.compute_all')
-def test_load_and_process_data(mock_compute_all, mock_get_occurrence_data, mock_remove_duplicates, mock_to_db):
+def test_load_and_process_data(mock_compute_all, mock_get_occurrence_data, mock_to_db):
     gdf = gpd.GeoDataFrame({
         'unit.unitId': ['id1', 'id2', 'id3', 'id4'],
         'geometry': [
@@ -79,6 +80,238 @@ def test_load_and_process_data(mock_compute_all, mock_get_occurrence_data, mock_
     headers = {'Authorization': 'Bearer test_token'}
 
     results = main.load_and_process_data(
-        "occurrence_url", params, headers, "uusimaa", 1, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, lookup_df
+        "occurrence_url", params, headers, "uusimaa", 1, config, all_value_ranges, taxon_df, collection_names, municipality_ely_mappings, municipality_ely_mappings, lookup_df
     )
     assert results == (4, 0, 1, 0, 2, 0) # 4 occurrences, 0 failed, 1 edited, 0 duplicates, 2 processed and 0 merged geometry collections
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.has_rows', return_value=True)
+@patch('pygeoapi.scripts.main.edit_db.mark_batch_completed')
+@patch('pygeoapi.scripts.main.edit_db.get_completed_batches')
+@patch('pygeoapi.scripts.main.edit_db.drop_table')
+@patch('pygeoapi.scripts.main.edit_db.to_db', return_value=0)
+@patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
+def test_load_and_process_data_resumes_completed_batches(mock_get_occurrence_data, mock_to_db, mock_drop_table, mock_get_completed_batches, mock_mark_batch_completed, mock_has_rows, mock_maintenance_executor):
+    # Pages 1-2 were loaded before the previous run was interrupted
+    mock_get_completed_batches.return_value = {main.batch_name(1, 2)}
+    mock_get_occurrence_data.return_value = (gpd.GeoDataFrame(), 0)
+    config = {"multiprocessing": False, "batch_size": 2}
+
+    main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 5, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame(), drop_tables=True, run_id=1
+    )
+
+    # Tables of a partially loaded province must not be dropped
+    mock_drop_table.assert_not_called()
+    requested_pages = [(c.kwargs['startpage'], c.kwargs['endpage']) for c in mock_get_occurrence_data.call_args_list]
+    assert requested_pages == [(3, 4), (5, 5)]
+    # Nothing new was loaded, but the earlier batches still need maintenance
+    mock_maintenance_executor.submit.assert_called_once()
+
+    # Staging tables emptied by a database crash are loaded again from the start
+    mock_get_occurrence_data.reset_mock()
+    mock_has_rows.return_value = False
+    main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 5, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame(), drop_tables=True, run_id=1
+    )
+    requested_pages = [(c.kwargs['startpage'], c.kwargs['endpage']) for c in mock_get_occurrence_data.call_args_list]
+    assert requested_pages == [(1, 2), (3, 4), (5, 5)]
+
+    # Nothing was loaded at all: the live tables are still served, and only removed when the run is published
+    live_tables = ['uusimaa_points', 'uusimaa_lines', 'uusimaa_polygons']
+    assert not [c for c in mock_drop_table.call_args_list if c.args[0] == live_tables and c.kwargs.get('schema', 'public') == 'public']
+    assert main.removed_tables[-3:] == live_tables
+    del main.removed_tables[-3:]
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.drop_table')
+@patch('pygeoapi.scripts.main.edit_db.to_db', return_value=1)
+@patch('scripts.main.transform_batch')
+@patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
+def test_load_and_process_data_pipeline(mock_get_occurrence_data, mock_transform_batch, mock_to_db, mock_drop_table, mock_maintenance_executor):
+    def fake_download(url, params, headers, startpage, endpage, **kwargs):
+        gdf = gpd.GeoDataFrame({'page': list(range(startpage, endpage + 1))}, geometry=[Point(0, 0)] * (endpage - startpage + 1))
+        return gdf, 0
+    mock_get_occurrence_data.side_effect = fake_download
+    mock_transform_batch.side_effect = lambda gdf, *args: (gdf, 0, 1)
+    config = {"multiprocessing": False, "batch_size": 2, "pipeline_queue_size": 1}
+
+    results = main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 7, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame(), drop_tables=True
+    )
+
+    # All batches are written to the staging tables in order and counted once
+    written_pages = [list(c.args[0]['page']) for c in mock_to_db.call_args_list]
+    assert written_pages == [[1, 2], [3, 4], [5, 6], [7]]
+    assert mock_to_db.call_args.args[1] == ['uusimaa_points_staging', 'uusimaa_lines_staging', 'uusimaa_polygons_staging']
+    assert mock_to_db.call_args.kwargs['unlogged'] is True
+    assert mock_to_db.call_args.kwargs['partition_by_year'] is False
+
+    # The staging tables are finalized and indexed in the shadow schema, to be published later
+    job, *args = mock_maintenance_executor.submit.call_args.args
+    with patch('pygeoapi.scripts.main.edit_db.finalize_tables', return_value=(1, 2)) as mock_finalize_tables, \
+         patch('pygeoapi.scripts.main.edit_db.update_indexes') as mock_update_indexes:
+        assert job(*args) == (1, 2)
+    assert mock_finalize_tables.call_args.kwargs['schema'] == main.edit_db.SHADOW_SCHEMA
+    assert mock_update_indexes.call_args.kwargs['schema'] == main.edit_db.SHADOW_SCHEMA
+    assert results == (7, 4, 0, 0, 4, 0)
+    mock_maintenance_executor.submit.assert_called_once()
+
+    # Failures in a background stage are raised to the caller
+    mock_to_db.reset_mock()
+    mock_get_occurrence_data.side_effect = RuntimeError("download failed")
+    with pytest.raises(RuntimeError, match="download failed"):
+        main.load_and_process_data(
+            "occurrence_url", {}, {}, "uusimaa", 7, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame()
+        )
+    mock_to_db.assert_not_called()
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.to_db', return_value=0)
+@patch('scripts.main.transform_batch')
+@patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
+def test_load_and_process_data_drops_duplicates_across_batches(mock_get_occurrence_data, mock_transform_batch, mock_to_db, mock_maintenance_executor):
+    def fake_download(url, params, headers, startpage, endpage, **kwargs):
+        # Every batch has the occurrence 'dup' again, with the same load date
+        ids = ['dup'] + [f'id{page}' for page in range(startpage, endpage + 1)]
+        gdf = gpd.GeoDataFrame({'Havainnon_tunniste': ids, 'Lataus_pvm': ['2024-01-01'] * len(ids)}, geometry=[Point(0, 0)] * len(ids))
+        return gdf, 0
+    mock_get_occurrence_data.side_effect = fake_download
+    mock_transform_batch.side_effect = lambda gdf, *args: (gdf, 0, 0)
+    config = {"multiprocessing": False, "batch_size": 2}
+
+    results = main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 4, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame()
+    )
+
+    written = [list(c.args[0]['Havainnon_tunniste']) for c in mock_to_db.call_args_list]
+    assert written == [['dup', 'id1', 'id2'], ['id3', 'id4']]
+    # 6 occurrences processed, 1 duplicate dropped
+    assert results[0] == 6
+    assert results[3] == 1
+
+    # Premerged batches are written with the number of merged occurrences
+    mock_to_db.reset_mock()
+    lookup_df = pd.DataFrame({'virva': ['Havainnon_tunniste', 'Lataus_pvm'], 'merge_option': ['AGGREGATE', 'GROUPBY']})
+    main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 4, {**config, "premerge_batches": True}, {}, pd.DataFrame(), {}, {}, {}, lookup_df
+    )
+    written = [(list(c.args[0]['Havainnon_tunniste']), list(c.args[0]['Yhdistetty'])) for c in mock_to_db.call_args_list]
+    assert written == [(['dup, id1, id2'], [3]), (['id3, id4'], [2])]
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.to_db', return_value=0)
+@patch('scripts.main.transform_batch')
+@patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
+def test_load_and_process_data_premerges_newer_versions_separately(mock_get_occurrence_data, mock_transform_batch, mock_to_db, mock_maintenance_executor):
+    batches = {
+        1: (['a', 'b', 'c'], ['2024-01-01', '2024-01-01', '2024-01-01'], ['A', 'A', 'C']),
+        # Newer versions of an occurrence folded into a premerged row and of one written on its own row
+        3: (['a', 'c', 'd'], ['2024-02-01', '2024-02-01', '2024-01-01'], ['A', 'C', 'C']),
+    }
+    def fake_download(url, params, headers, startpage, endpage, **kwargs):
+        ids, load_dates, municipalities = batches[startpage]
+        gdf = gpd.GeoDataFrame({'Havainnon_tunniste': ids, 'Lataus_pvm': load_dates, 'Kunta': municipalities}, geometry=[Point(0, 0)] * 3)
+        return gdf, 0
+    mock_get_occurrence_data.side_effect = fake_download
+    mock_transform_batch.side_effect = lambda gdf, *args: (gdf, 0, 0)
+    config = {"multiprocessing": False, "batch_size": 2, "premerge_batches": True}
+    lookup_df = pd.DataFrame({'virva': ['Havainnon_tunniste', 'Kunta'], 'merge_option': ['AGGREGATE', 'GROUPBY']})
+
+    results = main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 4, config, {}, pd.DataFrame(), {}, {}, {}, lookup_df
+    )
+
+    # 'a' keeps its folded version. 'c' is written on its own row, so finalize_tables replaces the older 'c' with it.
+    written = [(list(c.args[0]['Havainnon_tunniste']), list(c.args[0]['Yhdistetty'])) for c in mock_to_db.call_args_list]
+    assert written == [(['a, b', 'c'], [2, 1]), (['c', 'd'], [1, 1])]
+    assert results[3] == 1
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.discard_completed_batches')
+@patch('pygeoapi.scripts.main.edit_db.drop_table')
+def test_wait_for_maintenance(mock_drop_table, mock_discard_completed_batches, mock_maintenance_executor):
+    succeeded = Future()
+    succeeded.set_result((1, 2))
+    failed = Future()
+    failed.set_exception(RuntimeError("index build failed"))
+
+    with patch.object(main, 'maintenance_futures', [(succeeded, 'uusimaa', ['uusimaa_points_staging'])]):
+        assert main.wait_for_maintenance(run_id=1) == (1, 2)
+    mock_drop_table.assert_not_called()
+
+    # A failed job stops the run before the tables are published, and its dataset is loaded again on resume
+    futures = [(succeeded, 'uusimaa', ['uusimaa_points_staging']), (failed, 'satakunta', ['satakunta_points_staging'])]
+    with patch.object(main, 'maintenance_futures', futures), pytest.raises(RuntimeError, match="satakunta"):
+        main.wait_for_maintenance(run_id=1)
+    mock_drop_table.assert_called_once_with(['satakunta_points_staging'])
+    mock_discard_completed_batches.assert_called_once_with(1, 'satakunta')
+    mock_maintenance_executor.shutdown.assert_called_with(wait=True)
+
+@patch('scripts.main.load_and_process_data')
+@patch('pygeoapi.scripts.main.load_data.get_pages')
+def test_load_datasets_in_parallel(mock_get_pages, mock_load_and_process_data):
+    pages = {'ahvenanmaa': 1, 'uusimaa': 30, 'invasive_species': 5}
+    mock_get_pages.side_effect = lambda pages_env, url, params, headers, page_size: pages[params['name']]
+    mock_load_and_process_data.side_effect = lambda *args: (args[4], 0, 0, 0, 0, 0)
+    datasets = [(name, {'name': name, 'pageSize': '10000'}) for name in pages]
+    config = {"pages_env": "all", "province_workers": 1}
+
+    results = main.load_datasets_in_parallel(datasets, "occurrence_url", {}, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame(), True, 1)
+
+    # Largest datasets are started first and the counters are summed
+    started = [c.args[3] for c in mock_load_and_process_data.call_args_list]
+    assert started == ['uusimaa', 'invasive_species', 'ahvenanmaa']
+    assert results == (36, 0, 0, 0, 0, 0)
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.mark_batch_completed')
+@patch('pygeoapi.scripts.main.edit_db.get_completed_batches')
+@patch('pygeoapi.scripts.main.edit_db.to_db', return_value=0)
+@patch('scripts.main.transform_batch')
+@patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
+def test_load_and_process_data_time_windows(mock_get_occurrence_data, mock_transform_batch, mock_to_db, mock_get_completed_batches, mock_mark_batch_completed, mock_maintenance_executor):
+    windows = [('1990-01-01/2005-12-31', 3), ('2006-01-01/2024-12-31', 2)]
+    mock_get_completed_batches.return_value = {main.batch_name(1, 2, windows[0][0])}
+    mock_get_occurrence_data.return_value = (gpd.GeoDataFrame({'a': [1]}, geometry=[Point(0, 0)]), 0)
+    mock_transform_batch.side_effect = lambda gdf, *args: (gdf, 0, 0)
+    config = {"multiprocessing": False, "batch_size": 2}
+
+    main.load_and_process_data(
+        "occurrence_url", {'time': '1990-01-01/'}, {}, "uusimaa", 5, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame(), run_id=1, time_windows=windows
+    )
+
+    # Every window is paged from the first page with its own time filter
+    requested = [(c.args[1]['time'], c.kwargs['startpage'], c.kwargs['endpage']) for c in mock_get_occurrence_data.call_args_list]
+    assert requested == [('1990-01-01/2005-12-31', 3, 3), ('2006-01-01/2024-12-31', 1, 2)]
+    completed = [c.args[2] for c in mock_mark_batch_completed.call_args_list]
+    assert completed == ['1990-01-01/2005-12-31 pages 3-3', '2006-01-01/2024-12-31 pages 1-2']
+
+@patch('scripts.main.maintenance_executor')
+@patch('pygeoapi.scripts.main.edit_db.update_indexes')
+@patch('pygeoapi.scripts.main.edit_db.apply_staged_changes', return_value=(2, 3))
+@patch('pygeoapi.scripts.main.edit_db.drop_table')
+@patch('pygeoapi.scripts.main.edit_db.to_db')
+@patch('pygeoapi.scripts.main.edit_db.upsert_to_db', return_value=0)
+@patch('scripts.main.transform_batch')
+@patch('pygeoapi.scripts.main.load_data.get_occurrence_data')
+def test_load_and_process_data_incremental(mock_get_occurrence_data, mock_transform_batch, mock_upsert_to_db, mock_to_db, mock_drop_table, mock_apply_staged_changes, mock_update_indexes, mock_maintenance_executor):
+    mock_get_occurrence_data.return_value = (gpd.GeoDataFrame({'a': [1]}, geometry=[Point(0, 0)]), 0)
+    mock_transform_batch.side_effect = lambda gdf, *args: (gdf, 0, 0)
+    config = {"multiprocessing": False, "batch_size": 2, "incremental": True}
+
+    main.load_and_process_data(
+        "occurrence_url", {}, {}, "uusimaa", 2, config, {}, pd.DataFrame(), {}, {}, {}, pd.DataFrame()
+    )
+
+    # The delta goes to the staging tables, which are emptied first, and the live tables are left alone
+    staging = ['uusimaa_points_staging', 'uusimaa_lines_staging', 'uusimaa_polygons_staging']
+    mock_drop_table.assert_called_once_with(staging)
+    mock_upsert_to_db.assert_called_once()
+    assert mock_upsert_to_db.call_args.args[1] == staging
+    mock_to_db.assert_not_called()
+
+    # Maintenance applies the staged changes instead of rebuilding the tables
+    job, *args = mock_maintenance_executor.submit.call_args.args
+    assert job(*args) == (2, 3)
+    mock_apply_staged_changes.assert_called_once_with(['uusimaa_points', 'uusimaa_lines', 'uusimaa_polygons'], args[1])
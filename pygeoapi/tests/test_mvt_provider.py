@@ -0,0 +1,119 @@
+from unittest.mock import Mock, patch
+import sys
+# Imported before the pygeoapi mocks, so that patch.dict does not remove them from sys.modules afterwards
+import geoalchemy2.functions
+import sqlalchemy.orm
+
+# Create a mock MVTPostgreSQLProvider class that we can inherit from
+class MockMVTPostgreSQLProvider:
+    def __init__(self, provider_def):
+        self.table = provider_def['table']
+        self.fields = {'Paikallinen_tunniste': 'id_column', 'Kunta': 'kunta_column', 'Tieteellinen_nimi': 'name_column'}
+
+class MockProviderTileNotFoundError(Exception):
+    pass
+
+# Mock the pygeoapi modules while importing the provider
+with patch.dict(sys.modules, {
+    'pygeoapi.provider.mvt_postgresql': Mock(MVTPostgreSQLProvider=MockMVTPostgreSQLProvider),
+    'pygeoapi.provider.tile': Mock(ProviderTileNotFoundError=MockProviderTileNotFoundError),
+    'pygeoapi.util': Mock()
+}):
+    from plugins import mvt_provider
+
+# run with:
+# cd pygeoapi
+# python -m pytest tests/test_mvt_provider.py -v
+
+
+def create_test_provider(table='test_points', **provider_def):
+    mvt_provider._tile_caches.clear()
+    return mvt_provider.CachedMVTPostgreSQLProvider({'table': table, **provider_def})
+
+
+def test_tile_cache_evicts_least_recently_used():
+    cache = mvt_provider.TileCache(max_size=2, ttl=60)
+    cache.set('a', b'1')
+    cache.set('b', b'2')
+    assert cache.get('a') == b'1'
+    cache.set('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1'
+    assert len(cache) == 2
+
+
+def test_tile_cache_expires_tiles():
+    cache = mvt_provider.TileCache(max_size=2, ttl=10)
+    with patch.object(mvt_provider.time, 'monotonic', side_effect=[0, 5, 20]):
+        cache.set('a', b'1')
+        assert cache.get('a') == b'1'
+        assert cache.get('a') is None
+
+
+def test_options():
+    provider = create_test_provider(options={'mvt': {'max_features': 5, 'cache_size': 3, 'cache_ttl': 7}})
+    assert provider.max_features == 5
+    assert provider.tile_cache.max_size == 3
+    assert provider.tile_cache.ttl == 7
+
+
+def test_get_tile_columns():
+    provider = create_test_provider(properties=['Tieteellinen_nimi', 'Puuttuva'])
+    assert provider.get_tile_columns() == ['name_column']
+    assert len(create_test_provider().get_tile_columns()) == 3
+
+
+def test_get_tiles_uses_cache():
+    provider = create_test_provider()
+    with patch.object(provider, '_render_tile', return_value=b'tile') as mock_render:
+        assert provider.get_tiles('layer', 'WebMercatorQuad', '3', '2', '1') == b'tile'
+        assert provider.get_tiles('layer', 'WebMercatorQuad', 3, 2, 1) == b'tile'
+        # Providers are created per request, but share the cache of the table
+        other = mvt_provider.CachedMVTPostgreSQLProvider({'table': 'test_points'})
+        with patch.object(other, '_render_tile') as other_render:
+            assert other.get_tiles('layer', 'WebMercatorQuad', 3, 2, 1) == b'tile'
+            other_render.assert_not_called()
+    mock_render.assert_called_once_with('layer', 'WebMercatorQuad', 3, 2, 1)
+
+
+def test_get_tiles_caches_empty_tiles():
+    provider = create_test_provider()
+    with patch.object(provider, '_render_tile', return_value=None) as mock_render:
+        assert provider.get_tiles('layer', 'WebMercatorQuad', 3, 2, 1) is None
+        assert provider.get_tiles('layer', 'WebMercatorQuad', 3, 2, 1) is None
+    mock_render.assert_called_once()
+
+
+def test_get_tiles_does_not_cache_missing_tiles():
+    provider = create_test_provider()
+    with patch.object(provider, '_render_tile', return_value=MockProviderTileNotFoundError) as mock_render:
+        provider.get_tiles('layer', 'WebMercatorQuad', 30, 2, 1)
+        provider.get_tiles('layer', 'WebMercatorQuad', 30, 2, 1)
+    assert mock_render.call_count == 2
+    assert len(provider.tile_cache) == 0
+
+
+def test_render_tile_orders_features_before_limit():
+    from geoalchemy2 import Geometry
+    from sqlalchemy import Column, Integer, MetaData, String, Table
+    from sqlalchemy.dialects import postgresql
+    table = Table('test_points', MetaData(),
+                  Column('Paikallinen_tunniste', String, primary_key=True), Column('Kunta', String),
+                  Column('geometry', Geometry('POINT', srid=3067)), Column('Yhdistetty', Integer))
+    provider = create_test_provider(options={'mvt': {'max_features': 5}})
+    provider.table_model, provider.geom, provider.id_field = table.c, 'geometry', 'Paikallinen_tunniste'
+    provider.fields = {'Kunta': table.c.Kunta}
+    provider._engine = Mock()
+    provider.storage_crs = provider.get_envelope = Mock()
+    provider.get_tiling_schemes = lambda: [Mock(tileMatrixSet='WebMercatorQuad')]
+    provider.is_in_limits = lambda *args: True
+
+    with patch.object(mvt_provider, 'get_crs_from_uri', return_value=Mock(to_string=lambda: 3067)), \
+         patch.object(mvt_provider, 'Session') as mock_session:
+        mock_session.return_value.__enter__.return_value.execute.return_value.scalar.return_value = b'tile'
+        assert provider._render_tile('layer', 'WebMercatorQuad', 3, 2, 1) == b'tile'
+
+    statement = mock_session.return_value.__enter__.return_value.execute.call_args.args[0]
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+    assert 'ORDER BY test_points."Paikallinen_tunniste"' in sql
+    assert sql.index('ORDER BY') < sql.index('LIMIT')
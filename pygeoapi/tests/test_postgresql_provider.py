@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+import sys
+from geoalchemy2 import Geometry
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+class OccurrenceModel(Base):
+    __tablename__ = 'test_polygons'
+    Paikallinen_tunniste = Column(Integer, primary_key=True)
+    Kunta = Column(String)
+    geometry = Column(Geometry('GEOMETRY', 4326))
+    geometry_simplified_100m = Column(Geometry('GEOMETRY', 4326))
+    geometry_simplified_1km = Column(Geometry('GEOMETRY', 4326))
+    geometry_3067 = Column(Geometry('GEOMETRY', 3067))
+
+# Create a mock PostgreSQLProvider class that we can inherit from
+class MockPostgreSQLProvider:
+    def __init__(self, provider_def):
+        self.table = provider_def['table']
+        self.geom = provider_def.get('geom_field', 'geometry')
+        self.properties = provider_def.get('properties', [])
+        self.table_model = OccurrenceModel
+        self._fields = {}
+        self.get_fields()
+
+    @property
+    def fields(self):
+        return self.get_fields()
+
+    def get_fields(self):
+        if not self._fields:
+            self._fields = {column.name: {'type': 'string'} for column in self.table_model.__table__.columns if column.name != self.geom}
+        return self._fields
+
+    def query(self, bbox=[], crs_transform_spec=None, **kwargs):
+        return {'output_geom': self.output_geom, 'transform': self._get_crs_transform(crs_transform_spec)}
+
+    def get(self, identifier, crs_transform_spec=None, **kwargs):
+        return {'output_geom': self.output_geom, 'transform': self._get_crs_transform(crs_transform_spec)}
+
+    def _get_crs_transform(self, crs_transform_spec=None):
+        return 'transform' if crs_transform_spec else None
+
+    def _select_properties_clause(self, select_properties, skip_geometry):
+        return 'full geometry clause'
+
+    def _sqlalchemy_to_feature(self, item, crs_transform_out=None):
+        properties = dict(item.__dict__)
+        return {'geometry': properties.pop(self.geom), 'properties': properties}
+
+# Mock the pygeoapi modules while importing the provider
+with patch.dict(sys.modules, {
+    'pygeoapi.provider.sql': Mock(PostgreSQLProvider=MockPostgreSQLProvider),
+    'pygeoapi.util': Mock()
+}):
+    from plugins import postgresql_provider
+
+# run with:
+# cd pygeoapi
+# python -m pytest tests/test_postgresql_provider.py -v
+
+THRESHOLDS = {'geometry_simplified_100m': 0.3, 'geometry_simplified_1km': 2, 'geometry_simplified_10km': 10}
+
+def create_test_provider(thresholds=THRESHOLDS):
+    return postgresql_provider.SimplifiedPostgreSQLProvider({'table': 'test_polygons', 'options': {'simplify': thresholds}})
+
+
+def test_fields_exclude_simplified_columns():
+    provider = create_test_provider()
+    assert set(provider.get_fields()) == {'Paikallinen_tunniste', 'Kunta'}
+
+
+def test_get_geometry_column():
+    provider = create_test_provider()
+    assert provider.get_geometry_column([]) == 'geometry'
+    assert provider.get_geometry_column([24.0, 60.0, 24.1, 60.1]) == 'geometry'
+    assert provider.get_geometry_column([24.0, 60.0, 24.1, 60.5]) == 'geometry_simplified_100m'
+    assert provider.get_geometry_column([20.0, 60.0, 24.0, 61.0]) == 'geometry_simplified_1km'
+    # The table has no 10 km column
+    assert provider.get_geometry_column([19.0, 59.0, 32.0, 70.0]) == 'geometry_simplified_1km'
+    # Three-dimensional bbox
+    assert provider.get_geometry_column([20.0, 60.0, 0, 24.0, 61.0, 10]) == 'geometry_simplified_1km'
+    # Without thresholds the full geometries are served
+    assert create_test_provider({}).get_geometry_column([19.0, 59.0, 32.0, 70.0]) == 'geometry'
+
+
+def test_query_serves_simplified_column_for_large_bbox():
+    provider = create_test_provider()
+    assert provider.query(bbox=[20.0, 60.0, 24.0, 61.0])['output_geom'] == 'geometry_simplified_1km'
+    assert provider.output_geom == 'geometry'
+    assert provider.query()['output_geom'] == 'geometry'
+
+
+def test_query_serves_projected_column():
+    provider = create_test_provider()
+    crs_3067 = SimpleNamespace(target_crs_uri='http://www.opengis.net/def/crs/EPSG/0/3067')
+    crs_3857 = SimpleNamespace(target_crs_uri='http://www.opengis.net/def/crs/EPSG/0/3857')
+
+    def get_crs_from_uri(uri):
+        return Mock(to_epsg=Mock(return_value=int(uri.rsplit('/', 1)[1])))
+
+    with patch.object(postgresql_provider, 'get_crs_from_uri', side_effect=get_crs_from_uri):
+        # The stored geometries are not transformed
+        assert provider.query(crs_transform_spec=crs_3067) == {'output_geom': 'geometry_3067', 'transform': None}
+        assert provider.get(1, crs_transform_spec=crs_3067) == {'output_geom': 'geometry_3067', 'transform': None}
+        assert provider.query(crs_transform_spec=crs_3857) == {'output_geom': 'geometry', 'transform': 'transform'}
+        # Simplified geometries are transformed
+        result = provider.query(bbox=[20.0, 60.0, 24.0, 61.0], crs_transform_spec=crs_3067)
+        assert result == {'output_geom': 'geometry_simplified_1km', 'transform': 'transform'}
+    assert provider.output_geom == 'geometry'
+
+
+def test_select_properties_clause():
+    provider = create_test_provider()
+    assert provider._select_properties_clause([], False) == 'full geometry clause'
+
+    provider.output_geom = 'geometry_simplified_1km'
+    assert provider._select_properties_clause([], True) == 'full geometry clause'
+    with patch.object(postgresql_provider, 'load_only') as mock_load_only:
+        provider._select_properties_clause(['Kunta'], False)
+    loaded = {column.key for column in mock_load_only.call_args.args}
+    assert loaded == {'Kunta', 'geometry_simplified_1km'}
+
+
+def test_sqlalchemy_to_feature_uses_simplified_geometry():
+    provider = create_test_provider()
+    item = SimpleNamespace(Kunta='Helsinki', geometry='full', geometry_simplified_100m='100m', geometry_simplified_1km='1km', geometry_3067='3067')
+    feature = provider._sqlalchemy_to_feature(item)
+    assert feature == {'geometry': 'full', 'properties': {'Kunta': 'Helsinki'}}
+
+    provider.output_geom = 'geometry_simplified_1km'
+    item = SimpleNamespace(Kunta='Helsinki', geometry_simplified_1km='1km')
+    feature = provider._sqlalchemy_to_feature(item)
+    assert feature == {'geometry': '1km', 'properties': {'Kunta': 'Helsinki'}}
@@ -1,9 +1,11 @@
+import json
 import pandas as pd
+import numpy as np
 import geopandas as gpd
 from shapely.geometry import Point, Polygon, LineString, GeometryCollection, MultiPolygon
 from pandas.testing import assert_frame_equal
 
-from scripts import process_data
+from scripts import process_data, load_data
 
 # run with:
 # cd pygeoapi
@@ -57,6 +59,20 @@ def test_combine_similar_columns():
     result_gdf = process_data.combine_similar_columns(gdf.copy())
     assert_frame_equal(result_gdf, expected_gdf)
 
+def test_translate_column_names_of_decoded_page():
+    lookup_df = pd.read_csv('scripts/resources/lookup_table_columns.csv', sep=';', header=0)
+    features = [
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [24.9, 60.1]}, 'properties': {'unit.unitId': 'id1', 'unit.linkings.taxon.scientificName': 'Parus major'}},
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [25.0, 60.2]}, 'properties': {'unit.unitId': 'id2'}},
+    ]
+    text = json.dumps({'type': 'FeatureCollection', 'features': features})
+
+    # A property missing from a feature is translated like with GeoDataFrame.from_features, not to 'None'
+    decoded = process_data.translate_column_names(load_data.decode_feature_collection(text), lookup_df, style='virva')
+    expected = process_data.translate_column_names(gpd.GeoDataFrame.from_features(features, crs="EPSG:4326"), lookup_df, style='virva')
+    assert list(decoded['Tieteellinen_nimi']) == list(expected['Tieteellinen_nimi'])
+    assert 'None' not in set(decoded['Tieteellinen_nimi'])
+
 def test_translate_column_names():
     lookup_df = pd.read_csv('scripts/resources/lookup_table_columns.csv', sep=';', header=0)
     gdf = gpd.GeoDataFrame({
@@ -89,4 +105,96 @@ def test_convert_geometry_collection_to_multipolygon():
     assert isinstance(gdf_converted.loc[2, 'geometry'], MultiPolygon)
     assert gdf_converted.loc[3, 'geometry'] is None
     assert isinstance(gdf_converted.loc[4, 'geometry'], Polygon)
-    assert count == 3
\ No newline at end of file
+    assert count == 3
+
+def test_seen_occurrences():
+    seen = process_data.SeenOccurrences()
+    batch = gpd.GeoDataFrame({
+        'Havainnon_tunniste': ['a', 'b', 'a', 'c', 'c'],
+        'Lataus_pvm': ['2024-01-01', '2024-01-01', '2024-02-01', None, '2023-01-01']
+    }, geometry=[Point(0, 0)] * 5)
+
+    # The latest version of every occurrence in the batch is kept, also over a missing load date
+    filtered, dropped, superseding = seen.filter(batch)
+    assert list(filtered.index) == [1, 2, 4]
+    assert not superseding.any()
+    assert dropped == 2
+    assert len(seen) == 3
+
+    # Occurrences written by earlier batches are dropped unless the version is newer
+    batch = gpd.GeoDataFrame({
+        'Havainnon_tunniste': ['a', 'b', 'd'],
+        'Lataus_pvm': pd.to_datetime(['2024-02-01', '2024-03-01', '2024-01-01'])
+    }, geometry=[Point(0, 0)] * 3)
+    filtered, dropped, superseding = seen.filter(batch)
+    assert list(filtered['Havainnon_tunniste']) == ['b', 'd']
+    assert list(superseding) == [True, False]
+    assert dropped == 1
+    assert len(seen) == 4
+
+    # Occurrences folded into premerged rows keep the folded version
+    seen.mark_folded(gpd.GeoDataFrame({'Havainnon_tunniste': ['c, d', 'b'], 'Yhdistetty': [2, 1]}, geometry=[Point(0, 0)] * 2))
+    batch = gpd.GeoDataFrame({
+        'Havainnon_tunniste': ['b', 'c', 'd'],
+        'Lataus_pvm': pd.to_datetime(['2024-04-01', '2024-04-01', '2024-04-01'])
+    }, geometry=[Point(0, 0)] * 3)
+    filtered, dropped, superseding = seen.filter(batch)
+    assert list(filtered['Havainnon_tunniste']) == ['b']
+    assert list(superseding) == [True]
+    assert dropped == 2
+
+    # Frames without IDs are not filtered
+    filtered, dropped, superseding = seen.filter(gpd.GeoDataFrame({'a': [1, 1]}, geometry=[Point(0, 0)] * 2))
+    assert len(filtered) == 2 and dropped == 0 and len(superseding) == 2
+
+def test_premerge_occurrences():
+    lookup_df = pd.DataFrame({
+        'virva': ['Havainnon_tunniste', 'Tieteellinen_nimi', 'Aika', 'Paikan_tarkkuus_metreina_max', 'Maara', 'geometry', 'Yhdistetty'],
+        'merge_option': ['AGGREGATE', 'FIRST', 'GROUPBY', 'MAX', 'SUM', None, None]
+    })
+    gdf = gpd.GeoDataFrame({
+        'Havainnon_tunniste': ['a', 'b', 'c', 'd', 'e'],
+        'Tieteellinen_nimi': ['x', None, 'z', 'w', 'v'],
+        'Aika': ['t1', 't1', None, None, 't1'],
+        'Paikan_tarkkuus_metreina_max': [1, 5, None, 2, 3],
+        'Maara': [1, 2, None, None, 4]
+    }, geometry=[Point(0, 0), Point(1, 1), Point(2, 2), Point(3, 3), LineString([(0, 0), (1, 1)])])
+
+    merged, merged_count = process_data.premerge_occurrences(gdf, lookup_df)
+
+    # Rows with a missing GROUPBY value are merged too, but different geometry types are not
+    assert merged_count == 2
+    assert list(merged['Havainnon_tunniste']) == ['a, b', 'c, d', 'e']
+    assert list(merged['Tieteellinen_nimi']) == ['x', 'z', 'v']
+    assert list(merged['Paikan_tarkkuus_metreina_max']) == [5, 2, 3]
+    assert merged['Maara'].tolist()[0] == 3 and pd.isna(merged['Maara'].tolist()[1])
+    assert list(merged['Yhdistetty']) == [2, 2, 1]
+    assert list(merged.geometry) == [Point(0, 0), Point(2, 2), LineString([(0, 0), (1, 1)])]
+
+    # Premerged rows count their occurrences when merged again
+    remerged, _ = process_data.premerge_occurrences(pd.concat([merged, merged]), lookup_df)
+    assert list(remerged['Yhdistetty']) == [4, 4, 2]
+    assert list(remerged['Havainnon_tunniste']) == ['a, b, a, b', 'c, d, c, d', 'e, e']
+
+def test_premerge_occurrences_without_merges():
+    lookup_df = pd.DataFrame({'virva': ['Havainnon_tunniste', 'Aika'], 'merge_option': ['AGGREGATE', 'GROUPBY']})
+    gdf = gpd.GeoDataFrame({'Havainnon_tunniste': ['a', 'b'], 'Aika': ['t1', 't2']}, geometry=[Point(0, 0), Point(1, 1)])
+
+    # Batches that merge nothing have the same columns as merged batches
+    merged, merged_count = process_data.premerge_occurrences(gdf, lookup_df)
+    assert merged_count == 0
+    assert list(merged['Yhdistetty']) == [1, 1]
+    assert list(merged['Havainnon_tunniste']) == ['a', 'b']
+
+    merged, _ = process_data.premerge_occurrences(gdf, pd.DataFrame({'virva': ['Havainnon_tunniste'], 'merge_option': ['AGGREGATE']}))
+    assert list(merged['Yhdistetty']) == [1, 1]
+
+    merged, _ = process_data.premerge_occurrences(gdf.assign(Yhdistetty=[3, None]), lookup_df)
+    assert list(merged['Yhdistetty']) == [3, 1]
+
+    # Rows passed in separate are not merged
+    gdf = gpd.GeoDataFrame({'Havainnon_tunniste': ['a', 'b', 'c'], 'Aika': ['t1'] * 3}, geometry=[Point(0, 0)] * 3)
+    merged, merged_count = process_data.premerge_occurrences(gdf, lookup_df, separate=np.array([False, True, False]))
+    assert merged_count == 1
+    assert list(merged['Havainnon_tunniste']) == ['a, c', 'b']
+    assert list(merged['Yhdistetty']) == [2, 1]
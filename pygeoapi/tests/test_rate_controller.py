@@ -0,0 +1,82 @@
+import threading
+import time
+
+from scripts.rate_controller import AdaptiveRateController
+
+# run with:
+# cd pygeoapi
+# python -m pytest tests/test_rate_controller.py -v
+
+def test_additive_increase_and_multiplicative_decrease():
+    controller = AdaptiveRateController(max_concurrency=8)
+    assert controller.limit == 4
+
+    # Fast successful requests grow the limit by about one per round
+    for _ in range(4):
+        controller.acquire()
+        controller.release(1.0, 200)
+    assert 4.9 < controller.limit < 5
+
+    # A throttled request halves the limit
+    controller.acquire()
+    controller.release(1.0, 429, failed=True)
+    assert 2.4 < controller.limit < 2.5
+
+    # Client errors do not change the limit
+    controller.acquire()
+    controller.release(1.0, 404, failed=True)
+    assert 2.4 < controller.limit < 2.5
+
+    # The limit never goes above the maximum or below the minimum
+    controller.set_max_concurrency(2)
+    assert controller.limit == 2
+    controller.limit = 1
+    controller._last_decrease = 0
+    controller.acquire()
+    controller.release(1.0, None, failed=True)
+    assert controller.limit == 1
+
+def test_slow_requests_do_not_increase_limit():
+    controller = AdaptiveRateController(max_concurrency=8)
+    controller.acquire()
+    controller.release(1.0, 200)
+    limit = controller.limit
+    controller.acquire()
+    controller.release(10.0, 200)
+    assert controller.limit == limit
+
+def test_acquire_blocks_at_limit():
+    controller = AdaptiveRateController(max_concurrency=2)
+    assert controller.limit == 1
+    controller.acquire()
+
+    acquired = threading.Event()
+    def worker():
+        controller.acquire()
+        acquired.set()
+    thread = threading.Thread(target=worker)
+    thread.start()
+    time.sleep(0.1)
+    assert not acquired.is_set()
+
+    controller.release(1.0, 200)
+    thread.join(timeout=1)
+    assert acquired.is_set()
+
+def test_retry_budget():
+    controller = AdaptiveRateController(retry_budget_ratio=0.5, min_retry_budget=1)
+    assert controller.allow_retry()
+    assert not controller.allow_retry()
+    for _ in range(2):
+        controller.acquire()
+        controller.release(1.0, 200)
+    assert controller.allow_retry()
+    assert not controller.allow_retry()
+
+def test_backoff_delay():
+    controller = AdaptiveRateController(max_delay=60)
+    for attempt in range(1, 10):
+        delay = controller.backoff_delay(attempt, 5)
+        assert 0 <= delay <= min(60, 5 * 2 ** (attempt - 1))
+    assert controller.backoff_delay(1, 5, retry_after=30) >= 30
+    assert controller.backoff_delay(1, 5, retry_after=600) <= 60